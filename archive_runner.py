@@ -0,0 +1,163 @@
+"""
+ run the gtfs extension and the station statistics on every snapshot in an archive of nightly gtfs files.
+
+ The archive is a folder with a sub folder for each snapshot, named gtfs_<yyyy>_<mm>_<dd> (like
+ data/gtfs/gtfs_2016_05_25) and containing israel-public-transportation.zip. Snapshots are processed in parallel, and
+ the per-station hourly statistics of all the snapshots are merged into time series tables in the archive folder. A
+ snapshot that fails (a corrupt zip...) is reported and left out of the tables, and the run exits with status 1.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import re
+import sys
+import traceback
+from multiprocessing import Pool
+
+from extender_pipeline import is_up_to_date, run_pipeline
+import station_service_statistics
+from route_story_store import MappedExtendedGTFS
+from instrumentation import stage, count, message
+
+snapshot_folder_pattern = re.compile(r'gtfs_(\d{4})_(\d{2})_(\d{2})$')
+
+# number of days, starting from the snapshot date, used for the station statistics
+default_statistics_days = 14
+
+# the extender stages a snapshot needs for the statistics (and for query_service)
+snapshot_targets = ['extend_routes', 'extend_stops', 'build_frequency_blocks', 'build_route_story_store']
+
+
+def find_snapshots(archive_folder):
+    """Returns a sorted list of (snapshot date, snapshot folder) of the snapshots in the archive"""
+    res = []
+    for name in os.listdir(archive_folder):
+        match = snapshot_folder_pattern.match(name)
+        folder = os.path.join(archive_folder, name)
+        if match is None or not os.path.isfile(os.path.join(folder, 'israel-public-transportation.zip')):
+            continue
+        res.append((datetime.date(*(int(x) for x in match.groups())), folder))
+    return sorted(res)
+
+
+def statistics_filenames(g, start_date, end_date):
+    """Returns the files written by station_service_statistics.export_bus_station_visits and
+    export_train_station_visits"""
+    dates = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    return (g.at_path('hourly_bus_station_visit_sun_thur_%s_%s.txt' % dates),
+            g.at_path('hourly_train_arrivals_sun_thur_%s_%s.txt' % dates))
+
+
+def extend_snapshot(folder):
+    """Runs the extender stages the snapshot needs, and returns its MappedExtendedGTFS: the route stories are mapped
+    from the route story store instead of parsed from the csv files, unless a stage has just loaded them"""
+    return run_pipeline(folder, targets=snapshot_targets, gtfs=MappedExtendedGTFS(folder))
+
+
+def process_snapshot(snapshot_date, folder, statistics_days=default_statistics_days):
+    """Extends the snapshot gtfs and exports its station statistics, skipping steps that are up to date.
+    Returns the snapshot date and the bus and train statistics file names."""
+    g = extend_snapshot(folder)
+
+    start_date = snapshot_date
+    end_date = snapshot_date + datetime.timedelta(days=statistics_days - 1)
+    bus_filename, train_filename = statistics_filenames(g, start_date, end_date)
+    extended_files = [g.at_path(g.route_story_stops_files), g.at_path(g.route_story_services_filename),
+                      g.at_path(g.trip_frequencies_filename), g.at_path(g.full_routes_filename),
+                      g.full_stops_filename()]
+    if not is_up_to_date([bus_filename, train_filename], extended_files):
+        g.load_stops()
+        # the statistics only count trips, so they don't need a trip object for every trip
+        g.load_frequency_blocks()
+        station_service_statistics.export_bus_station_visits(
+            g, station_service_statistics.bus_station_visits(g, start_date, end_date), start_date, end_date)
+        station_service_statistics.export_train_station_visits(
+            g, station_service_statistics.train_station_visits(g, start_date, end_date), start_date, end_date)
+    return snapshot_date, bus_filename, train_filename
+
+
+def _process_snapshot_star(args):
+    """Returns process_snapshot's result, or (snapshot date, None, the traceback) if it failed, so one bad snapshot
+    doesn't stop the others"""
+    try:
+        return process_snapshot(*args)
+    except Exception:
+        return args[0], None, traceback.format_exc()
+
+
+def merge_time_series(results, output_filename):
+    """Concatenates station hourly data files (as written by export_station_hourly_data) into one file, adding
+    the snapshot date as the first column. results is a list of (snapshot_date, filename)."""
+    with stage('merge %s' % os.path.basename(output_filename)), open(output_filename, 'w', encoding='utf8') as outf:
+        writer = csv.writer(outf, lineterminator='\n')
+        header_written = False
+        for snapshot_date, filename in sorted(results):
+            with open(filename, encoding='utf8') as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if not header_written:
+                    writer.writerow(['snapshot_date'] + header)
+                    header_written = True
+                for row in reader:
+                    writer.writerow([snapshot_date.strftime('%Y-%m-%d')] + row)
+                count('snapshots')
+
+
+def run_archive(archive_folder, processes=None, statistics_days=default_statistics_days, start_date=None,
+                end_date=None):
+    """Processes all the snapshots in archive_folder (optionally only between start_date and end_date) in a
+    process pool, and writes the time series tables of the snapshots that succeeded to archive_folder. Returns the
+    list of (snapshot date, traceback) of the snapshots that failed."""
+    snapshots = [(snapshot_date, folder) for snapshot_date, folder in find_snapshots(archive_folder)
+                 if (start_date is None or snapshot_date >= start_date) and
+                 (end_date is None or snapshot_date <= end_date)]
+    message("Processing %d snapshots" % len(snapshots))
+
+    tasks = [(snapshot_date, folder, statistics_days) for snapshot_date, folder in snapshots]
+    results = []
+    failed = []
+    # maxtasksperchild=1: every snapshot gets a fresh process, so memory is returned to the os between snapshots
+    with stage('process snapshots'), Pool(processes, maxtasksperchild=1) as pool:
+        for snapshot_date, bus_filename, train_filename in pool.imap_unordered(_process_snapshot_star, tasks):
+            if bus_filename is None:
+                # train_filename is the traceback of the failure
+                message("Snapshot %s failed: %s" % (snapshot_date, train_filename))
+                count('failed_snapshots')
+                failed.append((snapshot_date, train_filename))
+                continue
+            message("Snapshot %s done" % snapshot_date)
+            count('snapshots')
+            results.append((snapshot_date, bus_filename, train_filename))
+
+    merge_time_series([(r[0], r[1]) for r in results],
+                      os.path.join(archive_folder, 'hourly_bus_station_visit_sun_thur_by_snapshot.txt'))
+    merge_time_series([(r[0], r[2]) for r in results],
+                      os.path.join(archive_folder, 'hourly_train_arrivals_sun_thur_by_snapshot.txt'))
+    if len(failed) > 0:
+        message("Done, %d snapshots failed: %s" % (len(failed), ', '.join(str(d) for d, _ in sorted(failed))))
+    else:
+        message("Done.")
+    return failed
+
+
+def main():
+    def parse_date(s):
+        return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+    parser = argparse.ArgumentParser(description='Extend and compute station statistics for a gtfs archive')
+    parser.add_argument('archive_folder')
+    parser.add_argument('--processes', type=int, default=None, help='default: number of cpus')
+    parser.add_argument('--days', type=int, default=default_statistics_days,
+                        help='number of days from the snapshot date to compute statistics for')
+    parser.add_argument('--start-date', type=parse_date, default=None)
+    parser.add_argument('--end-date', type=parse_date, default=None)
+    args = parser.parse_args()
+    failed = run_archive(args.archive_folder, args.processes, args.days, args.start_date, args.end_date)
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+ time and memory-profile the pipeline stages on synthetic gtfs files of growing size.
+
+ Every scale runs in its own process (so the peak rss of one scale doesn't hide the next), on a network generated by
+ synthetic_gtfs. The results are saved as json, named by date and git commit, so runs on different commits can be
+ compared.
+
+ The peak rss is the high-water mark of the process, so a stage's process_peak_rss_kb is the peak of that stage and
+ all the stages before it in the scale. --trace-memory also records traced_peak_kb, the peak of the python
+ allocations during the stage itself.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from multiprocessing import get_context
+
+import gtfs_extender
+import result_cache
+import station_service_statistics
+import synthetic_gtfs
+import train_to_bus
+from ilgtfs import GTFS, ExtendedGTFS
+from instrumentation import peak_rss_kb
+
+default_scales = (1, 10, 100)
+
+
+class StageTimer:
+    """Runs pipeline stages and records their time, the process peak rss so far (None where it isn't available) and
+    (optionally) the peak of python allocations during the stage"""
+
+    def __init__(self, scale, trace_memory):
+        self.scale = scale
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, stage, fn, *args):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        # the stages print their progress; we don't want it in the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = fn(*args)
+        seconds = time.perf_counter() - start
+        result = {'scale': self.scale, 'stage': stage, 'seconds': round(seconds, 3),
+                  'process_peak_rss_kb': peak_rss_kb()}
+        memory = 'process peak %s kb' % ('-' if result['process_peak_rss_kb'] is None
+                                         else result['process_peak_rss_kb'])
+        if self.trace_memory:
+            result['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+            memory = 'stage peak %d kb, %s' % (result['traced_peak_kb'], memory)
+        print("  %dx %-26s %8.3fs  %s" % (self.scale, stage, seconds, memory))
+        self.results.append(result)
+        return res
+
+
+def run_scale(folder, scale, trace_memory):
+    """Generates the scale's network in folder and runs all the stages on it. Returns the list of stage results."""
+    # time the stages, not reading their cached results
+    result_cache.set_cache(None)
+    timer = StageTimer(scale, trace_memory)
+    config = synthetic_gtfs.scaled_config(scale)
+    start_date = synthetic_gtfs.default_start_date
+    end_date = start_date + datetime.timedelta(days=config.days - 1)
+    stop_times = timer.run('generate', synthetic_gtfs.generate_gtfs, folder, config)
+
+    def read_stop_times():
+        g = GTFS(folder)
+        g.load_routes()
+        g.load_trips()
+        g.load_stop_times()
+
+    def load_extended():
+        g = ExtendedGTFS(folder)
+        g.load_stops()
+        g.load_trips()
+        return g
+
+    timer.run('read_stop_times', read_stop_times)
+    timer.run('build_route_stories', gtfs_extender.build_route_stories, ExtendedGTFS(folder))
+    timer.run('extend_routes', gtfs_extender.extend_routes, ExtendedGTFS(folder))
+    timer.run('extend_stops', gtfs_extender.extend_stops, ExtendedGTFS(folder))
+    g = timer.run('load_extended', load_extended)
+    timer.run('bus_station_visits', station_service_statistics.bus_station_visits, g, start_date, end_date)
+    stop_ids = {stop.stop_id for stop in g.stops.values() if stop.train_station_distance < 300}
+    visits = timer.run('visits_at_stop', train_to_bus.visits_at_stop, g, stop_ids, start_date,
+                       start_date + datetime.timedelta(days=6))
+    timer.run('train_arrival_to_bus_visit', train_to_bus.train_arrival_to_bus_visit, g, visits)
+
+    for result in timer.results:
+        result['stop_times'] = stop_times
+    return timer.results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(output_folder, scales=default_scales, trace_memory=False):
+    """Runs all the scales and writes the results json to output_folder. Returns the json file name."""
+    commit = git_commit()
+    results = []
+    # spawn: every scale starts from a fresh interpreter
+    context = get_context('spawn')
+    for scale in scales:
+        print("Running %dx" % scale)
+        with context.Pool(1) as pool:
+            results += pool.apply(run_scale, (os.path.join(output_folder, 'gtfs_%dx' % scale), scale, trace_memory))
+
+    output_filename = os.path.join(output_folder, 'benchmark_%s_%s.json' %
+                                   (datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'), commit))
+    with open(output_filename, 'w', encoding='utf8') as f:
+        json.dump({'commit': commit,
+                   'date': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'cpus': os.cpu_count(),
+                   'base_config': synthetic_gtfs.default_config._asdict(),
+                   'trace_memory': trace_memory,
+                   'results': results}, f, indent=2)
+    print("Results saved to %s" % output_filename)
+    return output_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic gtfs files')
+    parser.add_argument('--output', default='data/benchmark')
+    parser.add_argument('--scales', type=int, nargs='+', default=list(default_scales))
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also record the peak python allocations of every stage (slows the stages down)')
+    args = parser.parse_args()
+    run_benchmark(args.output, args.scales, args.trace_memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+ run the gtfs extender stages in dependency order, skipping the ones that are up to date.
+
+ Every stage declares the files it reads and the files it writes. A stage runs only if one of its outputs is missing
+ or older than one of its inputs, or if an earlier stage in the same run rewrote one of its inputs. All the stages of a
+ run share one ExtendedGTFS, so a table loaded by one stage (services, trips, route stories...) is not read again by
+ the next one; tables that are loaded from a file a stage rewrites are dropped after that stage.
+
+ An output that lacks a column the current code reads (written by an older version of the extender, like a
+ full_stops.txt without nearest_stations) is out of date too, so the stage writes it again.
+
+ Input and output names without a folder are files in the gtfs folder; other paths are relative to the working
+ directory (like data/kavrazif_lines.txt).
+
+   python extender_pipeline.py data/gtfs/gtfs_2016_05_25                  rebuild what changed
+   python extender_pipeline.py data/gtfs/gtfs_2016_05_25 --targets extend_stops --force
+   python extender_pipeline.py data/gtfs/gtfs_2016_05_25 --targets export_map       also export the map
+
+ The optional stages only run when they're targets: export_map takes a while and replaces the tiles folder, and most
+ runs don't need a new map.
+"""
+
+import argparse
+import csv
+import os
+from collections import namedtuple
+
+import gtfs_extender
+import map_export
+import route_story_families
+import route_story_store
+from ilgtfs import ExtendedGTFS, FullRoute, FullStop, FullTrip, FrequencyBlock, RouteStoryStop
+from instrumentation import stage, message
+
+gtfs_zip = 'israel-public-transportation.zip'
+
+PipelineStage = namedtuple('PipelineStage', ['name', 'function', 'inputs', 'outputs'])
+
+stages = [
+    PipelineStage('build_route_stories', gtfs_extender.build_route_stories,
+                  inputs=[gtfs_zip],
+                  outputs=[ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename,
+                           'full_trips.txt', gtfs_extender.validation_report_filename]),
+    PipelineStage('extend_routes', gtfs_extender.extend_routes,
+                  inputs=[gtfs_zip, ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename,
+                          'full_trips.txt'],
+                  outputs=[ExtendedGTFS.full_routes_filename]),
+    PipelineStage('extend_stops', gtfs_extender.extend_stops,
+                  inputs=[gtfs_zip, ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename,
+                          'full_trips.txt', ExtendedGTFS.full_routes_filename],
+                  outputs=['full_stops.txt']),
+    PipelineStage('find_kavrazif_routes', gtfs_extender.find_kavrazif_routes,
+                  inputs=[gtfs_extender.kavrazif_lines_filename, ExtendedGTFS.route_story_stops_files,
+                          ExtendedGTFS.full_routes_filename, 'full_stops.txt'],
+                  outputs=['kavrazif_routes.txt']),
+    PipelineStage('build_frequency_blocks', gtfs_extender.build_frequency_blocks,
+                  inputs=[ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename,
+                          'full_trips.txt', ExtendedGTFS.full_routes_filename],
+                  outputs=[ExtendedGTFS.trip_frequencies_filename]),
+    PipelineStage('find_route_story_families', route_story_families.find_route_story_families,
+                  inputs=[ExtendedGTFS.route_story_stops_files],
+                  outputs=[route_story_families.route_story_families_filename]),
+    PipelineStage('build_route_story_store', route_story_store.build_route_story_store,
+                  inputs=[ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename],
+                  outputs=[route_story_store.route_story_store_filename]),
+    PipelineStage('export_map', map_export.export_map,
+                  inputs=[gtfs_zip, ExtendedGTFS.route_story_stops_files, ExtendedGTFS.route_story_services_filename,
+                          ExtendedGTFS.full_routes_filename, 'full_stops.txt', ExtendedGTFS.trip_frequencies_filename],
+                  outputs=[map_export.stops_filename, map_export.stations_filename,
+                           map_export.route_stories_filename]),
+]
+
+# the stages that don't run unless they're targets
+optional_stages = ['export_map']
+
+# the ExtendedGTFS tables that are read from each of the extender's output files
+table_sources = {
+    ExtendedGTFS.route_story_stops_files: ['route_stories'],
+    ExtendedGTFS.route_story_services_filename: ['route_stories'],
+    'full_trips.txt': ['trips'],
+    ExtendedGTFS.trip_frequencies_filename: ['frequency_blocks'],
+    ExtendedGTFS.full_routes_filename: ['routes'],
+    'full_stops.txt': ['stops'],
+}
+
+# the columns ExtendedGTFS reads from each of the extender's csv outputs
+output_fields = {
+    ExtendedGTFS.route_story_stops_files: RouteStoryStop.csv_fields,
+    'full_trips.txt': FullTrip.csv_fields,
+    ExtendedGTFS.trip_frequencies_filename: FrequencyBlock.csv_fields,
+    ExtendedGTFS.full_routes_filename: FullRoute.csv_fields,
+    'full_stops.txt': FullStop.csv_fields,
+}
+
+
+def has_fields(filename, fields):
+    """Returns True if the header of the csv file has all of fields"""
+    with open(filename, encoding='utf8') as f:
+        header = next(csv.reader(f), [])
+    return all(field in header for field in fields)
+
+
+def is_up_to_date(outputs, inputs):
+    """Returns True if all the output files exist, have the columns in output_fields, and are newer than all the input
+    files"""
+    if not all(os.path.exists(f) for f in outputs):
+        return False
+    if not all(has_fields(f, output_fields[os.path.basename(f)]) for f in outputs
+               if os.path.basename(f) in output_fields):
+        return False
+    return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in inputs)
+
+
+def resolve(g, name):
+    return g.at_path(name) if os.path.dirname(name) == '' else name
+
+
+def required_stages(targets):
+    """Returns the stages needed to build the target stages (by name), in pipeline order"""
+    by_name = {s.name: s for s in stages}
+    unknown = [target for target in targets if target not in by_name]
+    if len(unknown) > 0:
+        raise ValueError("Unknown stages %s, the stages are %s" % (unknown, list(by_name)))
+    producers = {output: s for s in stages for output in s.outputs}
+    needed = set()
+    pending = list(targets)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        pending += [producers[f].name for f in by_name[name].inputs if f in producers]
+    return [s for s in stages if s.name in needed]
+
+
+def run_pipeline(folder, targets=None, force=False, gtfs=None):
+    """Runs the target stages (default: all but the optional stages) and the stages they depend on, on the gtfs in
+    folder. Stages that are up to date are skipped; force runs the target stages anyway (but not their dependencies).
+    Returns the ExtendedGTFS the stages ran on, with the tables that are still valid loaded."""
+    g = gtfs or ExtendedGTFS(folder)
+    targets = targets or [s.name for s in stages if s.name not in optional_stages]
+    rewritten = set()
+    with stage('extender pipeline'):
+        for s in required_stages(targets):
+            inputs = [resolve(g, f) for f in s.inputs]
+            outputs = [resolve(g, f) for f in s.outputs]
+            missing = [f for f in inputs if not os.path.exists(f)]
+            if len(missing) > 0:
+                raise FileNotFoundError("%s: missing inputs %s" % (s.name, missing))
+            # a stage that left a checkpoint didn't complete, even if some of its outputs were written
+            interrupted = os.path.exists(g.at_path(s.name + gtfs_extender.checkpoint_suffix))
+            if not (force and s.name in targets) and not interrupted and rewritten.isdisjoint(inputs) and \
+                    is_up_to_date(outputs, inputs):
+                message("%s is up to date" % s.name)
+                continue
+            s.function(g)
+            rewritten.update(outputs)
+            # tables read from the files we've just written are stale (or were loaded in their basic form by the stage)
+            for output in s.outputs:
+                g.unload(*table_sources.get(output, []))
+    return g
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the gtfs extender stages that are not up to date')
+    parser.add_argument('folder', help='the folder with israel-public-transportation.zip')
+    parser.add_argument('--targets', nargs='+', choices=[s.name for s in stages], default=None,
+                        help='stages to build, with the stages they depend on (default: all but %s)' %
+                             ', '.join(optional_stages))
+    parser.add_argument('--force', action='store_true', help='run the target stages even if they are up to date')
+    args = parser.parse_args()
+    run_pipeline(args.folder, args.targets, args.force)
+
+
+if __name__ == '__main__':
+    main()
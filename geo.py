@@ -490,6 +490,105 @@ class ShapeFile:
                     xyf.write('\t'.join(xy_fields) + '\n')
 
 
+class GeoPointIndex:
+    """A grid index of GeoPoints, for finding the points near a location without measuring the distance to all the
+    points. The grid cells are cell_size meters high and (about) cell_size meters wide."""
+
+    METERS_PER_DEGREE = R_EARTH * math.pi / 180
+
+    def __init__(self, points, cell_size=5000):
+        """Initializes the index
+
+        :param points: list[(object, GeoPoint)]    # the points to index, with their keys
+        :param cell_size: float     # in meters
+        :return: None
+        """
+        self.cell_size = cell_size
+        self.lat_step = cell_size / self.METERS_PER_DEGREE
+        # the width of a cell in degrees is fixed by the latitude of the first point; queries take the actual
+        # longitude degree length into account
+        lat0 = points[0][1].lat if len(points) > 0 else 0
+        self.long_step = self.lat_step / max(math.cos(math.radians(lat0)), 0.01)
+        self.cells = collections.defaultdict(list)
+        for key, point in points:
+            self.cells[self.cell(point)].append((key, point))
+
+    def cell(self, point):
+        return int(math.floor(point.lat / self.lat_step)), int(math.floor(point.long / self.long_step))
+
+    def near(self, point, radius):
+        """Returns the (key, point) pairs of the points whose cells are within radius of point (a superset of the
+        points within radius)
+
+        :param point: GeoPoint
+        :param radius: float    # in meters
+        :return: list[(object, GeoPoint)]
+        """
+        d_lat = radius / self.METERS_PER_DEGREE
+        # a degree of longitude is shortest at the latitude farthest from the equator
+        d_long = d_lat / max(math.cos(math.radians(min(abs(point.lat) + d_lat, 89.9))), 0.01)
+        south, west = self.cell(GeoPoint(point.lat - d_lat, point.long - d_long))
+        north, east = self.cell(GeoPoint(point.lat + d_lat, point.long + d_long))
+        return [item for y in range(south, north + 1) for x in range(west, east + 1)
+                for item in self.cells.get((y, x), [])]
+
+    def nearest(self, point, k, radius):
+        """Returns up to k (distance, key) pairs of the points nearest to point within radius, sorted by distance (and
+        by key for equal distances)
+
+        :param point: GeoPoint
+        :param k: int
+        :param radius: float    # in meters
+        :return: list[(float, object)]
+        """
+        candidates = ((point.distance_to(candidate), key) for key, candidate in self.near(point, radius))
+        return sorted(candidate for candidate in candidates if candidate[0] <= radius)[:k]
+
+    def within(self, point, radius):
+        """Returns the keys of the points within radius of point (including point itself, if it's indexed)
+
+        :param point: GeoPoint
+        :param radius: float    # in meters
+        :return: list[object]
+        """
+        return [key for key, candidate in self.near(point, radius) if point.distance_to(candidate) <= radius]
+
+
+def density_clusters(points, radius, min_points):
+    """Groups points into clusters of dense areas (DBSCAN): a point with at least min_points points (including
+    itself) within radius is a core point; core points within radius of each other are in the same cluster, and
+    other points join the cluster of a core point within radius.
+
+    :param points: list[(object, GeoPoint)]    # the points, with their keys
+    :param radius: float    # in meters
+    :param min_points: int
+    :return: list[list[object]]   # the keys of the points in each cluster. Points not in any cluster are omitted.
+    """
+    index = GeoPointIndex(points, cell_size=radius)
+    neighbours = {key: index.within(point, radius) for key, point in points}
+    core = {key for key, near in neighbours.items() if len(near) >= min_points}
+    cluster_of = {}
+    clusters = []
+    for key, _ in points:
+        if key not in core or key in cluster_of:
+            continue
+        # a new cluster: all the core points reachable from key, and their neighbours
+        cluster = []
+        cluster_of[key] = len(clusters)
+        pending = [key]
+        while len(pending) > 0:
+            current = pending.pop()
+            cluster.append(current)
+            if current not in core:
+                continue
+            for neighbour in neighbours[current]:
+                if neighbour not in cluster_of:
+                    cluster_of[neighbour] = len(clusters)
+                    pending.append(neighbour)
+        clusters.append(cluster)
+    return clusters
+
+
 class GeoGrid:
     def __init__(self, box, size):
         self.box = box
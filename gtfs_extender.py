@@ -1,20 +1,78 @@
 import zipfile
 import csv
 import io
-import datetime
+import os
+import pickle
+from array import array
 from collections import defaultdict, namedtuple
 
-from ilgtfs import StopTime, RouteStory, RouteStoryStop, ExtendedGTFS
+from ilgtfs import StopTime, RouteStory, RouteStoryStop, ExtendedGTFS, StopTimesValidator, read_fields, \
+    read_stop_ids, times_decrease, parse_timestamp, gc_paused, format_timestamp
+from instrumentation import stage, count, message, progress
 import geo
 
-
-def progenum(iterable, freq):
-    i = 0
-    for i, r in enumerate(iterable):
-        yield r
-        if i % freq == 0:
-            print("  ", i, datetime.datetime.now())
-    print('Total number of iterations: %d' % i)
+# the list of "official" kavrazif lines, used by find_kavrazif_routes
+kavrazif_lines_filename = 'data/kavrazif_lines.txt'
+
+# extend_stops lists, for every stop, up to this number of nearest train stations within the radius (in meters)
+nearest_stations_count = 8
+nearest_stations_radius = 15000
+
+# stops within this distance (in meters) of each other are grouped into one complex (a station, a terminal or an
+# interchange hub), if there are at least complex_min_stops of them
+complex_radius = 100
+complex_min_stops = 3
+
+# build_route_stories saves the problems it finds in the feed to this file, in the gtfs folder
+validation_report_filename = 'validation_report.json'
+
+# a stage that saves a checkpoint saves it to <stage name><checkpoint_suffix> in the gtfs folder
+checkpoint_suffix = '.checkpoint'
+
+# build_frequency_blocks makes a block of a series of at least this number of trips at a fixed headway
+min_block_trips = 3
+
+
+class StageCheckpoint:
+    """The state of an extender stage after its expensive part, saved to the gtfs folder, so a run that fails later
+    (or is killed) resumes from there. A checkpoint is only used with the same versions (size and mtime) of the input
+    files it was made from; the stage removes it when it completes."""
+
+    # bump with any change to the saved state (checkpoint_state() of the stages), so old checkpoints aren't resumed
+    version = 1
+
+    def __init__(self, gtfs, name, inputs):
+        self.path = gtfs.at_path(name + checkpoint_suffix)
+        self.key = (self.version, [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in inputs])
+
+    def load(self):
+        """Returns the saved state, or None if there's no checkpoint for these inputs"""
+        try:
+            with open(self.path, 'rb') as f:
+                key, state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            message('ignoring corrupt checkpoint %s' % self.path)
+            return None
+        if key != self.key:
+            message('ignoring checkpoint %s of other input files' % self.path)
+            return None
+        return state
+
+    def save(self, state):
+        # written under another name and renamed, so a run killed while saving leaves the previous checkpoint
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump((self.key, state), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+        count('checkpoint_bytes', os.path.getsize(self.path))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 
 # Trip stories are a list of stops with arrival and departure time as offset from the beginning of the trip
@@ -27,70 +85,111 @@ def build_route_stories(gtfs: ExtendedGTFS):
     trip_id_to_route_story_id = {}
     trip_id_to_start_time = {}
     route_stories = {}
+    validator = StopTimesValidator(gtfs.validation)
 
     def read_trip_id_to_stop_times():
-        """Returns dictionary from trip_id to a list of csv records"""
+        """Returns dictionary from trip_id to a list of csv records (tuples of StopTime.csv_fields)"""
         with zipfile.ZipFile(gtfs.filename) as z:
             with z.open('stop_times.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                print("Reading stop_times file")
-                for record in progenum(reader, 500000):
-                    trip_id_to_stop_times_csv_records[record['trip_id']].append(record)
-                print("Total number of trips in stop times file %d " % len(trip_id_to_stop_times_csv_records))
-
-    def find_missing_trips():
-        missing = [trip_id for trip_id in gtfs.trips if trip_id not in trip_id_to_stop_times_csv_records]
-        if len(missing) > 0:
-            print("%s trips have no route story" % len(missing))
-            print("trips with no route stories are: %s" % missing)
-
-    def sort_and_verify_csv_records():
-        print("Sorting and verifying csv records")
-        bad_trip_sequences = set()
-        for trip_id, csv_records in progenum(trip_id_to_stop_times_csv_records.items(), 10000):
-            csv_records.sort(key=lambda r: int(r['stop_sequence']))
-            if csv_records[0]['stop_sequence'] != '1' or int(csv_records[-1]['stop_sequence']) != len(csv_records):
-                bad_trip_sequences.add(trip_id)
-        if len(bad_trip_sequences) > 0:
-            print("There are %d trips with bad sequences of stops in route story" % len(bad_trip_sequences))
-            for trip_id in bad_trip_sequences:
-                print("  Trip %s, sequence %s" % (trip_id, trip_id_to_stop_times_csv_records[trip_id]))
-                del (trip_id_to_stop_times_csv_records[trip_id])
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), StopTime.csv_fields)
+                trip_id_to_stop_times_csv_records.update(validator.group(progress(rows, 500000)))
+                count('trips', len(trip_id_to_stop_times_csv_records))
+
+    def verify_csv_records():
+        """Sorts the records of the trips that weren't in stop_sequence order, and drops the trips with bad sequences
+        and the trips that aren't in trips.txt"""
+        dropped = validator.finish(trip_id_to_stop_times_csv_records, lambda r: int(r[4]), set(gtfs.trips))
+        for trip_id in dropped:
+            del trip_id_to_stop_times_csv_records[trip_id]
 
     def build():
         route_story_to_id = {}
-        print("Building route stories")
-        for trip_id, csv_records in progenum(trip_id_to_stop_times_csv_records.items(), 10000):
+        for trip_id, csv_records in progress(trip_id_to_stop_times_csv_records.items(), 100000, 'trips'):
             # get the formatted start time from the first record; we will print it to the trips file
-            trip_id_to_start_time[trip_id] = csv_records[0]['arrival_time']
-            # convert to ilgtfs.StopTime objects
-            gtfs_stop_times = [StopTime.from_csv(record) for record in csv_records]
+            trip_id_to_start_time[trip_id] = csv_records[0][1]
             # get the start time in seconds since the start of the day
-            start_time = gtfs_stop_times[0].arrival_time
-            # convert the StopTime object to RouteStoryStop object; use a tuple because it's hashable
-            route_story_tuple = tuple(RouteStoryStop(record.arrival_time - start_time,
-                                                     record.departure_time - start_time,
-                                                     record.stop_id,
-                                                     record.pickup_type,
-                                                     record.drop_off_type) for record in gtfs_stop_times)
+            start_time = parse_timestamp(csv_records[0][1])
+            # convert the records (in StopTime.csv_fields order) to RouteStoryStop objects; use a tuple because it's
+            # hashable
+            route_story_tuple = tuple(RouteStoryStop(parse_timestamp(arrival_time) - start_time,
+                                                     parse_timestamp(departure_time) - start_time,
+                                                     int(stop_id),
+                                                     pickup_type,
+                                                     drop_off_type)
+                                      for _, arrival_time, departure_time, stop_id, _, pickup_type, drop_off_type
+                                      in csv_records)
             # is it a new trip story? if yes, allocate an id and write to the trip stories file
             if route_story_tuple not in route_story_to_id:
                 route_story_id = len(route_story_to_id) + 1
                 route_story_to_id[route_story_tuple] = route_story_id
             trip_id_to_route_story_id[trip_id] = route_story_to_id[route_story_tuple]
-
-        # convert the route_story_tuples to RouteStory objects
+            # the records aren't needed anymore; dropping them as we go keeps down the peak memory
+            trip_id_to_stop_times_csv_records[trip_id] = None
+        trip_id_to_stop_times_csv_records.clear()
+
+        add_route_stories((route_story_id, route_story_tuple)
+                          for route_story_tuple, route_story_id in route_story_to_id.items())
+
+        # the trips of a route story have the same stops and offsets, so they're checked once per route story
+        bad_times = {route_story_id for route_story_id, route_story in route_stories.items()
+                     if times_decrease([(stop.arrival_offset, stop.departure_offset) for stop in route_story.stops])}
+        gtfs.validation.add('decreasing_times', [trip_id for trip_id, route_story_id
+                                                 in trip_id_to_route_story_id.items() if route_story_id in bad_times])
+        gtfs.validation.add('unknown_stop', {stop.stop_id for route_story in route_stories.values()
+                                             for stop in route_story.stops} - read_stop_ids(gtfs.filename))
+
+        count('route_stories', len(route_stories))
+        count('route_story_stops', sum(len(story.stops) for story in route_stories.values()))
+
+    def add_route_stories(route_story_tuples):
+        """Adds RouteStory objects for (route_story_id, tuple of RouteStoryStop), by route_story_id order, and adds
+        their services"""
         route_stories.update({route_story_id: RouteStory.from_tuple(route_story_id, route_story_tuple)
-                              for route_story_tuple, route_story_id in route_story_to_id.items()})
-        # add services to route_stories
+                              for route_story_id, route_story_tuple in route_story_tuples})
         for trip_id, route_story_id in trip_id_to_route_story_id.items():
             route_stories[route_story_id].services.add(gtfs.trips[trip_id].service)
 
-        print("Total number of route stories %d" % len(route_stories))
-        print("Total number of route story stops%d" % sum(len(story.stops) for story in route_stories.values()))
+    def checkpoint_state():
+        """Returns what build() built, in compact form: arrays of numbers, and the texts (start times, pickup and drop
+        off types) they refer to by index"""
+        texts = {}
+        stories = [route_stories[route_story_id] for route_story_id in range(1, len(route_stories) + 1)]
+        stops = [stop for story in stories for stop in story.stops]
+        stops_start = array('i', [0])
+        for story in stories:
+            stops_start.append(stops_start[-1] + len(story.stops))
+        return {
+            'trip_ids': list(trip_id_to_route_story_id),
+            'trip_route_story': array('i', trip_id_to_route_story_id.values()),
+            'trip_start_time': array('i', (texts.setdefault(trip_id_to_start_time[trip_id], len(texts))
+                                           for trip_id in trip_id_to_route_story_id)),
+            'stops_start': stops_start,
+            'arrival_offset': array('i', (stop.arrival_offset for stop in stops)),
+            'departure_offset': array('i', (stop.departure_offset for stop in stops)),
+            'stop_id': array('i', (stop.stop_id for stop in stops)),
+            'pickup_type': array('i', (texts.setdefault(stop.pickup_type, len(texts)) for stop in stops)),
+            'drop_off_type': array('i', (texts.setdefault(stop.drop_off_type, len(texts)) for stop in stops)),
+            'texts': list(texts),
+            'validation': (gtfs.validation.counts, gtfs.validation.samples),
+        }
+
+    def resume(state):
+        texts = state['texts']
+        for trip_id, route_story_id, start_time in zip(state['trip_ids'], state['trip_route_story'],
+                                                       state['trip_start_time']):
+            trip_id_to_route_story_id[trip_id] = route_story_id
+            trip_id_to_start_time[trip_id] = texts[start_time]
+        stops_start = state['stops_start']
+        arrival_offset, departure_offset, stop_id = state['arrival_offset'], state['departure_offset'], state['stop_id']
+        pickup_type, drop_off_type = state['pickup_type'], state['drop_off_type']
+        add_route_stories((i + 1, tuple(RouteStoryStop(arrival_offset[j], departure_offset[j], stop_id[j],
+                                                       texts[pickup_type[j]], texts[drop_off_type[j]])
+                                        for j in range(stops_start[i], stops_start[i + 1])))
+                          for i in range(len(stops_start) - 1))
+        gtfs.validation.counts, gtfs.validation.samples = state['validation']
+        count('route_stories', len(route_stories))
 
     def export_route_story_stops():
-        print("Exporting route story stops")
         with open(gtfs.at_path(gtfs.route_story_stops_files), 'w') as f:
             f.write("route_story_id,arrival_offset,departure_offset,stop_id,pickup_type,drop_off_type\n")
             for route_story_id, route_story in route_stories.items():
@@ -103,22 +202,24 @@ def build_route_stories(gtfs: ExtendedGTFS):
                                                       stop.drop_off_type]) + '\n')
 
     def export_route_story_services():
-        print("Exporting route story services")
         with open(gtfs.at_path(gtfs.route_story_services_filename), 'w') as f:
             f.write("route_story_id,service_id\n")
             for route_story_id, route_story in route_stories.items():
                 for service in route_story.services:
                     f.write('%s,%s\n' % (route_story_id, service.service_id))
-        print("Route story services export done.")
 
     def export_full_trips():
-        print("exporting %d full trips" % len(gtfs.trips))
+        count('trips', len(gtfs.trips))
         with open(gtfs.full_trips_filename(), 'w') as f2:
             fields = ["route_id", "service_id", "trip_id", "direction_id", "shape_id",
                       "start_time", "route_story"]
             writer = csv.DictWriter(f2, fieldnames=fields, lineterminator='\n')
             writer.writeheader()
             for trip in gtfs.trips.values():
+                # trips without (valid) stop times have no start time and no route story; they're in the validation
+                # report
+                if trip.trip_id not in trip_id_to_route_story_id:
+                    continue
                 writer.writerow({
                     "route_id": trip.route.route_id,
                     "service_id": trip.service.service_id,
@@ -127,54 +228,121 @@ def build_route_stories(gtfs: ExtendedGTFS):
                     "shape_id": trip.shape_id,
                     "start_time": trip_id_to_start_time[trip.trip_id],
                     "route_story": str(trip_id_to_route_story_id[trip.trip_id])
-                    if trip.trip_id in trip_id_to_route_story_id else ''
                 })
-        print("Trips export done.")
-
-    gtfs.load_basic_routes()
-    gtfs.load_basic_trips()
-    assert gtfs.trips is not None
-    read_trip_id_to_stop_times()
-    sort_and_verify_csv_records()  # sort the route stories by stop sequence, and make sure they are consistent
-    find_missing_trips()  # this would just print the ids of trips without route story
-    build()
-    export_route_story_stops()
-    export_route_story_services()
-    export_full_trips()
-    print("Done.")
-
-
-def extend_stops(gtfs):
-    """Adds nearest train station, train station distance and lines numbers"""
-    if gtfs.trips is None:
+
+    with stage('build_route_stories'):
+        gtfs.load_basic_routes()
+        gtfs.load_basic_trips()
+        assert gtfs.is_loaded('trips')
+        # reading the stop times and building the route stories takes most of the time, so what they build is saved
+        # before the export
+        checkpoint = StageCheckpoint(gtfs, 'build_route_stories', [gtfs.filename])
+        state = checkpoint.load()
+        if state is None:
+            with stage('read stop times'), gc_paused():
+                read_trip_id_to_stop_times()
+            with stage('verify'):
+                verify_csv_records()
+            with stage('build'), gc_paused():
+                build()
+            with stage('save checkpoint'):
+                checkpoint.save(checkpoint_state())
+        else:
+            with stage('resume from checkpoint'), gc_paused():
+                resume(state)
+        gtfs.validation.log()
+        gtfs.validation.save(gtfs.at_path(validation_report_filename))
+        with stage('export'):
+            export_route_story_stops()
+            export_route_story_services()
+            export_full_trips()
+        checkpoint.remove()
+
+
+def build_frequency_blocks(gtfs: ExtendedGTFS):
+    """Finds series of trips with the same route, service, route story, direction and shape, and a fixed headway,
+    and exports them as frequency blocks to trip_frequencies.txt (trips that aren't part of a series are blocks of
+    their own)"""
+
+    def find_blocks():
+        series = defaultdict(lambda: [])
+        for trip in gtfs.trips.values():
+            series[(trip.route.route_id, trip.service.service_id, trip.route_story.route_story_id, trip.direction_id,
+                    trip.shape_id)].append(trip)
+        blocks = []
+        for key, trips in series.items():
+            trips.sort(key=lambda t: (t.start_time, t.trip_id))
+            i = 0
+            while i < len(trips):
+                # extend the block from trip i while the headway stays the same
+                j, headway = i, 0
+                if i + 1 < len(trips):
+                    headway = trips[i + 1].start_time - trips[i].start_time
+                    while j + 1 < len(trips) and trips[j + 1].start_time - trips[j].start_time == headway:
+                        j += 1
+                if j + 1 - i < min_block_trips or headway == 0:
+                    j, headway = i, 0
+                blocks.append(key + (trips[i].start_time, trips[j].start_time, headway,
+                                     [trip.trip_id for trip in trips[i:j + 1]]))
+                i = j + 1
+        count('trips', len(gtfs.trips))
+        count('frequency_blocks', len(blocks))
+        return blocks
+
+    def export(blocks):
+        with open(gtfs.at_path(gtfs.trip_frequencies_filename), 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['route_id', 'service_id', 'route_story', 'direction_id', 'shape_id', 'start_time',
+                             'end_time', 'headway_secs', 'trip_ids'])
+            for route_id, service_id, route_story_id, direction_id, shape_id, start, end, headway, trip_ids in blocks:
+                writer.writerow([route_id, service_id, route_story_id, direction_id, shape_id, format_timestamp(start),
+                                 format_timestamp(end), headway, ' '.join(trip_ids)])
+
+    with stage('build_frequency_blocks'):
         gtfs.load_trips()
+        export(find_blocks())
 
-    if gtfs.stops is None:
+
+def extend_stops(gtfs, stations_count=nearest_stations_count, stations_radius=nearest_stations_radius,
+                 stops_complex_radius=complex_radius, complex_min=complex_min_stops):
+    """Adds nearest train station, train station distance, the nearest train stations (up to stations_count, within
+    stations_radius meters), lines numbers and the complex of the stop"""
+    gtfs.load_trips()
+
+    if not gtfs.is_loaded('stops'):
         gtfs.load_basic_stops()
 
     def find_train_stations():
-        print("Finding train stations")
         train_trips = (trip for trip in gtfs.trips.values() if trip.route.route_type == 2)
-        train_trip_story_ids = set(trip.trip_story_id for trip in train_trips)
+        train_trip_story_ids = set(trip.route_story.route_story_id for trip in train_trips)
         train_station_stops = set()
         for trip_story_id in train_trip_story_ids:
-            for trip_story_stop in gtfs.trip_stories[trip_story_id]:
+            for trip_story_stop in gtfs.route_stories[trip_story_id].stops:
                 train_station_stops.add(trip_story_stop.stop_id)
-        print("%d train stations found" % len(train_station_stops))
+        count('train_stations', len(train_station_stops))
         return train_station_stops
 
     def find_distance_from_train_station(train_stations):
+        """Returns a map from stop_id to (distance, station_id) of the nearest train station, and a map from stop_id
+        to a list of (distance, station_id) of the nearest stations"""
         train_stations_stops = (stop for stop in gtfs.stops.values() if stop.stop_id in train_stations)
         train_station_points = [(stop.stop_id, geo.GeoPoint(stop.stop_lat, stop.stop_lon))
                                 for stop in train_stations_stops]
+        index = geo.GeoPointIndex(train_station_points, cell_size=stations_radius)
 
-        print("finding distance from train stations")
         result = {}
+        nearest_stations = {}
+        far_stops = 0
         for stop in gtfs.stops.values():
+            stop_point = geo.GeoPoint(stop.stop_lat, stop.stop_lon)
+            nearest_stations[stop.stop_id] = index.nearest(stop_point, stations_count, stations_radius)
             if stop.stop_id in train_stations:
                 result[stop.stop_id] = (0, stop.stop_id)
+            elif len(nearest_stations[stop.stop_id]) > 0:
+                result[stop.stop_id] = nearest_stations[stop.stop_id][0]
             else:
-                stop_point = geo.GeoPoint(stop.stop_lat, stop.stop_lon)
+                # no station within the radius
+                far_stops += 1
                 min_distance, nearest_station = None, None
                 for train_station, train_station_point in train_station_points:
                     distance = train_station_point.distance_to(stop_point)
@@ -182,20 +350,37 @@ def extend_stops(gtfs):
                         nearest_station = train_station
                         min_distance = distance
                 result[stop.stop_id] = (min_distance, nearest_station)
+        count('stops_without_stations_in_radius', far_stops)
+        return result, nearest_stations
+
+    def find_stop_complexes(train_stations):
+        """Returns a map from stop_id to complex id: the stop_id of the train station in the complex (the one with the
+        lowest id if there are several), or of the lowest stop_id in the complex. Stops that are not in a complex
+        are a complex of their own."""
+        points = [(stop.stop_id, geo.GeoPoint(stop.stop_lat, stop.stop_lon)) for stop in gtfs.stops.values()]
+        clusters = geo.density_clusters(points, stops_complex_radius, complex_min)
+        result = {stop.stop_id: stop.stop_id for stop in gtfs.stops.values()}
+        for cluster in clusters:
+            stations = [stop_id for stop_id in cluster if stop_id in train_stations]
+            complex_id = min(stations) if len(stations) > 0 else min(cluster)
+            for stop_id in cluster:
+                result[stop_id] = complex_id
+        count('complexes', len(clusters))
+        count('stops_in_complexes', sum(len(cluster) for cluster in clusters))
         return result
 
     def find_stop_routes():
-        print("Finding routes for stops")
         result = defaultdict(lambda: set())
         for trip in gtfs.trips.values():
-            for trip_story_stop in trip.trip_story:
+            for trip_story_stop in trip.route_story.stops:
                 result[trip_story_stop.stop_id].add(trip.route)
         return result
 
-    def export_full_stops(train_station_distance, stop_routes):
+    def export_full_stops(train_station_distance, nearest_stations, stop_complexes, stop_routes):
+        count('stops', len(gtfs.stops))
         with open(gtfs.full_stops_filename(), 'w', encoding='utf8') as outf:
             outf.write('stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,zone_id,' +
-                       'nearest_train_station,train_station_distance,routes_here\n')
+                       'nearest_train_station,train_station_distance,routes_here,nearest_stations,complex_id\n')
             for stop in gtfs.stops.values():
                 line = ','.join([
                     str(stop.stop_id),
@@ -209,23 +394,33 @@ def extend_stops(gtfs):
                     stop.zone_id,
                     str(train_station_distance[stop.stop_id][1]),
                     str(int(train_station_distance[stop.stop_id][0])),
-                    ' '.join(route.line_number for route in stop_routes[stop.stop_id])
+                    ' '.join(route.line_number for route in stop_routes[stop.stop_id]),
+                    ' '.join('%d:%d' % (station_id, distance)
+                             for distance, station_id in nearest_stations[stop.stop_id]),
+                    str(stop_complexes[stop.stop_id])
                 ])
                 outf.write(line + '\n')
 
-    export_full_stops(find_distance_from_train_station(find_train_stations()), find_stop_routes())
+    with stage('extend_stops'):
+        with stage('find train stations'):
+            train_stations = find_train_stations()
+        with stage('find distance from train stations'):
+            train_station_distance, nearest_stations = find_distance_from_train_station(train_stations)
+        with stage('find stop complexes'):
+            stop_complexes = find_stop_complexes(train_stations)
+        with stage('find stop routes'):
+            stop_routes = find_stop_routes()
+        with stage('export'):
+            export_full_stops(train_station_distance, nearest_stations, stop_complexes, stop_routes)
 
 
 def extend_routes(gtfs: ExtendedGTFS):
-    print("Extending routes")
-    gtfs.load_basic_routes()
-    gtfs.load_trips()
 
     def find_route_trip_stories():
         result = defaultdict(lambda: set())
         for trip in gtfs.trips.values():
             result[trip.route].add(trip.route_story)
-        print("Trip stories found for %d routes" % len(result))
+        count('routes_with_stories', len(result))
         return result
 
     def export(route_stories):
@@ -241,16 +436,15 @@ def extend_routes(gtfs: ExtendedGTFS):
                 str_values = [str(v) for v in values]
                 f.write(','.join(str_values) + '\n')
 
-    export(find_route_trip_stories())
+    with stage('extend_routes'):
+        gtfs.load_basic_routes()
+        gtfs.load_trips()
+        export(find_route_trip_stories())
 
 
 # There's a file called kavrazif_lines that contains the list of "official" kavrazif routes
 # we want to find the gtfs routes that match those lines
 def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500):
-    print("stating find_kavrazif_routes")
-    gtfs.load_route_stories()
-    gtfs.load_routes()
-    gtfs.load_stops()
 
     # a single record in the input file
     KavRazif = namedtuple('KavRazif', 'id line_number station_id')
@@ -266,7 +460,7 @@ def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500
         # (with different stop id) and the same stop id. But we are only really interested in train stations,
         # so we don't care about that
         stop_codes = {stop.stop_code: stop.stop_id for stop in gtfs.stops.values()}
-        with open('data/kavrazif_lines.txt', encoding='utf8') as f:
+        with open(kavrazif_lines_filename, encoding='utf8') as f:
             return [KavRazif(record['kavrazif_id'],
                              record['line_number'].strip(),
                              stop_codes[record['stop_code']])
@@ -276,8 +470,8 @@ def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500
         found = set(r.kavrazif_record for r in routes)
         missing_records = [record for record in kavrazif_records if record not in found]
         if len(missing_records) > 0:
-            print("  %d kavrazif records weren't found, missing records: %s" %
-                  (len(missing_records), missing_records))
+            count('unmatched_kavrazif_records', len(missing_records))
+            message("kavrazif records weren't found, missing records: %s" % missing_records)
 
     def routes_story_stops_near_stations(route_story):
         stops_by_nearest_station_id = defaultdict(lambda: [])
@@ -298,7 +492,7 @@ def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500
         line_numbers = set(record.line_number for record in kavrazif_records)
         # routes with the correct line number
         line_number_matching = [route for route in gtfs.routes.values() if route.line_number in line_numbers]
-        print("  there are %d routes with a line number match" % len(line_number_matching))
+        count('line_number_matching_routes', len(line_number_matching))
         for route in line_number_matching:
             # find train stations that have route with this name nearby as a kavrazif route
             possible_train_stations = {record.station_id: record for record in kavrazif_records
@@ -309,7 +503,7 @@ def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500
                     if station_id in possible_train_stations:
                         r = Result(route, route_story, route_story_stop, possible_train_stations[station_id])
                         result.append(r)
-        print("  found %d route_id and train_station pairs" % len(result))
+        count('route_and_station_pairs', len(result))
         return result
 
     def export(data):
@@ -340,10 +534,14 @@ def find_kavrazif_routes(gtfs: ExtendedGTFS, max_distance_from_train_station=500
                 }
                 writer.writerow(record)
 
-    kavrazif_records = load_kavrazif_records()
-    routes = load_route_id_and_station_id()
-    log_unmatched_kavrazif()
-    export(routes)
+    with stage('find_kavrazif_routes'):
+        gtfs.load_route_stories()
+        gtfs.load_routes()
+        gtfs.load_stops()
+        kavrazif_records = load_kavrazif_records()
+        routes = load_route_id_and_station_id()
+        log_unmatched_kavrazif()
+        export(routes)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+"""
+ headways (time between consecutive departures) of every route at every stop or train station.
+"""
+
+import csv
+import heapq
+from array import array
+from collections import defaultdict
+from datetime import date
+
+from ilgtfs import ExtendedGTFS
+from instrumentation import stage, count
+from station_service_statistics import train_station_stops
+
+# percentiles of the headway distribution that are exported
+headway_percentiles = (50, 90)
+
+
+def trips_start_times(g, start_date, end_date):
+    """Returns a map from (route_story_id, route_id, day) to a sorted array of the distinct trip start times on that
+    weekday, for trips active between the specified dates. Uses the frequency blocks if they are loaded, otherwise the
+    trips.
+
+    The arrays are the timetable of a typical day: services that overlap the dates and run on the same weekday (like
+    the same timetable in two date ranges, when it changes during the window) are merged, and a start time that
+    several of them have appears once."""
+    res = defaultdict(lambda: array('i'))
+    for block in g.trip_blocks():
+        if block.service.end_date < start_date or block.service.start_date > end_date:
+            continue
+        for day in block.service.days:
+            res[(block.route_story.route_story_id, block.route.route_id, day)].extend(block.start_times)
+    for start_times in res.values():
+        start_times[:] = array('i', sorted(set(start_times)))
+    return res
+
+
+def departure_times(g, start_date, end_date, by_station=False, max_distance_from_station=500):
+    """Returns a map from (stop_id, route_id, day) to a sorted array of departure times (seconds since start of day).
+
+    If by_station is True, the key is the train station instead of the stop; for every route story only the stop
+    nearest to the station is taken (like in station_service_statistics.train_station_stops).
+    """
+    with stage('departure_times'):
+        start_times = trips_start_times(g, start_date, end_date)
+        count('start_time_arrays', len(start_times))
+
+        # for each route story, the (key, departure_offset) pairs in which passengers can board
+        story_offsets = {}
+
+        def offsets(route_story):
+            if by_station:
+                station_to_stop = train_station_stops(g, route_story, max_distance_from_station)
+                stop_to_station = {stop_id: station_id for station_id, stop_id in station_to_stop.items()}
+                return [(stop_to_station[stop.stop_id], stop.departure_offset) for stop in route_story.stops
+                        if stop.stop_id in stop_to_station and stop.pickup_type != 1]
+            return [(stop.stop_id, stop.departure_offset) for stop in route_story.stops if stop.pickup_type != 1]
+
+        # a trip start time array shifted by a constant offset is still sorted, so the departures of each route story
+        # are sorted by construction; departures of several route stories of the same key are merged
+        sorted_runs = defaultdict(lambda: [])
+        for (route_story_id, route_id, day), times in start_times.items():
+            if route_story_id not in story_offsets:
+                story_offsets[route_story_id] = offsets(g.route_stories[route_story_id])
+            for key_id, offset in story_offsets[route_story_id]:
+                sorted_runs[(key_id, route_id, day)].append(array('i', [t + offset for t in times]))
+
+        res = {}
+        for key, runs in sorted_runs.items():
+            res[key] = runs[0] if len(runs) == 1 else array('i', heapq.merge(*runs))
+        count('keys', len(res))
+        return res
+
+
+def headway_statistics(times):
+    """Returns the headway statistics of a sorted array of departure times, as a dictionary:
+    departures, first, last, mean, max and the headway_percentiles (in seconds), and expected_wait: the expected wait
+    of a passenger arriving at a random time between the first and last departure.
+    Headway values are None if there's less than two departures.
+    """
+    res = {'departures': len(times), 'first': times[0], 'last': times[-1]}
+    gaps = sorted(map(int.__sub__, times[1:], times[:-1]))
+    if len(gaps) == 0:
+        res.update({'mean': None, 'max': None, 'expected_wait': None})
+        res.update({'p%d' % p: None for p in headway_percentiles})
+        return res
+    total = res['last'] - res['first']
+    res['mean'] = total / len(gaps)
+    res['max'] = gaps[-1]
+    for p in headway_percentiles:
+        # nearest rank percentile
+        res['p%d' % p] = gaps[max(0, -(-p * len(gaps) // 100) - 1)]
+    # a passenger arriving at random waits h/2 on average in a gap of length h, and falls in that gap with
+    # probability h/total
+    res['expected_wait'] = sum(gap * gap for gap in gaps) / (2 * total) if total > 0 else 0
+    return res
+
+
+def stop_headways(g, start_date, end_date, by_station=False, max_distance_from_station=500):
+    """Returns a map from (stop_id, route_id, day) to a pair (departure times array, headway statistics dict)"""
+    departures = departure_times(g, start_date, end_date, by_station, max_distance_from_station)
+    return {key: (times, headway_statistics(times)) for key, times in departures.items()}
+
+
+def export_headways(g, headways, start_date, end_date, by_station=False):
+    """Exports the result of stop_headways.
+
+    The statistics go to a csv file, one line for (stop, route, day). The departure times of all the keys are
+    written, one after the other in the csv order, as a single binary array of 32 bit integers;
+    departures_offset is the index in that array of the first departure of the line.
+    """
+    name = 'headways_%s_%s_%s' % ('station' if by_station else 'stop',
+                                  start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    stats_fields = ['departures', 'first', 'last', 'mean', 'max'] + \
+                   ['p%d' % p for p in headway_percentiles] + ['expected_wait']
+    fields = ['station_id' if by_station else 'stop_id', 'stop_name', 'route_id', 'line_number', 'day',
+              'departures_offset'] + stats_fields
+
+    all_times = array('i')
+    with stage('export_headways'), open(g.at_path(name + '.txt'), 'w', encoding='utf8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(fields)
+        for (stop_id, route_id, day) in sorted(headways):
+            times, stats = headways[(stop_id, route_id, day)]
+            row = [stop_id, g.stops[stop_id].stop_name, route_id, g.routes[route_id].line_number, day, len(all_times)]
+            row += ['' if stats[field] is None else
+                    ('%.1f' % stats[field] if isinstance(stats[field], float) else stats[field])
+                    for field in stats_fields]
+            writer.writerow(row)
+            all_times.extend(times)
+
+        with open(g.at_path(name + '_departures.bin'), 'wb') as departures_file:
+            all_times.tofile(departures_file)
+        count('keys', len(headways))
+        count('departures', len(all_times))
+
+
+def load_departures(filename):
+    """Reads the binary departures file written by export_headways"""
+    times = array('i')
+    with open(filename, 'rb') as f:
+        times.frombytes(f.read())
+    return times
+
+
+if __name__ == '__main__':
+    gtfs = ExtendedGTFS(r'data/gtfs/gtfs_2016_05_25')
+    gtfs.load_stops()
+    gtfs.load_trips()
+    start = date(2016, 6, 1)
+    end = date(2016, 6, 14)
+    export_headways(gtfs, stop_headways(gtfs, start, end, by_station=True), start, end, by_station=True)
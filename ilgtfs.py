@@ -1,22 +1,98 @@
+import bisect
+import contextlib
 import csv
+import functools
+import gc
+import threading
 import zipfile
 import io
 import datetime
+import json
+import operator
 import os
-from typing import Dict, Optional
+from typing import Dict, List
 from collections import defaultdict
 
+from instrumentation import stage, count, message, progress
+
 route_types = {0: 'LightRailway', 2: 'IsraelRail', 3: 'Bus', 4: 'Monish'}
 
+# seconds since start of day by timestamp text; a feed has only a few tens of thousands of distinct timestamps, and
+# stop_times.txt has millions of them
+_parsed_timestamps = {}
+
+
+def parse_timestamp(timestamp):
+    """Returns second since start of day"""
+    seconds = _parsed_timestamps.get(timestamp)
+    if seconds is None:
+        # We need to manually parse because there's hours >= 24; but ain't Python doing it beautifully?
+        hour, minute, second = timestamp.split(':')
+        seconds = _parsed_timestamps[timestamp] = int(hour) * 60 * 60 + int(minute) * 60 + int(second)
+    return seconds
+
+
+# the exporters format the same few thousand times over and over
+_formatted_timestamps = {}
+
+
+def format_timestamp(seconds):
+    """Returns seconds since start of day as hh:mm:ss (hours can be >= 24)"""
+    timestamp = _formatted_timestamps.get(seconds)
+    if timestamp is None:
+        minutes, second = divmod(seconds, 60)
+        hour, minute = divmod(minutes, 60)
+        timestamp = _formatted_timestamps[seconds] = '%02d:%02d:%02d' % (hour, minute, second)
+    return timestamp
+
+
+def read_fields(f, fields):
+    """Returns an iterator over the rows of the csv file f, as tuples of the values of fields (in that order).
+
+    The classes below list the fields they are created from in csv_fields, and create objects from these tuples with
+    from_row. That's much faster than csv.DictReader and from_csv, which build a dict for every row.
+    """
+    reader = csv.reader(f)
+    header = next(reader)
+    missing = [field for field in fields if field not in header]
+    if len(missing) > 0:
+        raise ValueError("Fields %s are missing from the csv header %s" % (missing, header))
+    positions = [header.index(field) for field in fields]
+    if len(positions) == 1:
+        # itemgetter with a single item returns the bare value, not a tuple
+        position = positions[0]
+        return ((row[position],) for row in reader)
+    return map(operator.itemgetter(*positions), reader)
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pauses the garbage collector while loading a large table. Creating millions of objects triggers many full
+    collections, which find nothing to collect (the objects are all alive), and take a third of the loading time."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 
 class Agency:
     def __init__(self, agency_id, agency_name):
         self.agency_id = agency_id
         self.agency_name = agency_name
 
+    csv_fields = ('agency_id', 'agency_name')
+
+    @classmethod
+    def from_row(cls, row):
+        agency_id, agency_name = row
+        return cls(int(agency_id), agency_name)
+
     @classmethod
     def from_csv(cls, csv_record):
-        return cls(int(csv_record['agency_id']), csv_record['agency_name'])
+        return cls.from_row([csv_record[field] for field in cls.csv_fields])
 
 
 class Route:
@@ -39,13 +115,17 @@ class Route:
     def __hash__(self):
         return hash(self.route_id)
 
+    csv_fields = ('route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type')
+
+    @classmethod
+    def from_row(cls, row, agencies):
+        route_id, agency_id, route_short_name, route_long_name, route_desc, route_type = row
+        return cls(int(route_id), agencies[int(agency_id)], route_short_name, route_long_name, route_desc,
+                   int(route_type))
+
     @classmethod
     def from_csv(cls, csv_record, agencies):
-        agency_id = int(csv_record['agency_id'])
-        return cls(int(csv_record['route_id']),
-                   agencies[agency_id],
-                   csv_record['route_short_name'], csv_record['route_long_name'],
-                   csv_record['route_desc'], int(csv_record['route_type']))
+        return cls.from_row([csv_record[field] for field in cls.csv_fields], agencies)
 
 
 class FullRoute(Route):
@@ -54,15 +134,14 @@ class FullRoute(Route):
         super().__init__(route_id, agency, line_number, route_long_name, route_desc, route_type)
         self.route_story_ids = route_story_ids
 
+    csv_fields = Route.csv_fields + ('route_stories',)
+
     @classmethod
-    def from_csv(cls, csv_record, agencies):
-        agency_id = int(csv_record['agency_id'])
-        route_story_ids = [int(story) for story in csv_record['route_stories'].split(' ') if story != '']
-        return cls(int(csv_record['route_id']),
-                   agencies[agency_id],
-                   csv_record['route_short_name'], csv_record['route_long_name'],
-                   csv_record['route_desc'], int(csv_record['route_type']),
-                   route_story_ids)
+    def from_row(cls, row, agencies):
+        route_id, agency_id, route_short_name, route_long_name, route_desc, route_type, route_stories = row
+        route_story_ids = [int(story) for story in route_stories.split(' ') if story != '']
+        return cls(int(route_id), agencies[int(agency_id)], route_short_name, route_long_name, route_desc,
+                   int(route_type), route_story_ids)
 
 
 class Trip:
@@ -75,15 +154,20 @@ class Trip:
         self.stop_times_ids = None
         self.stop_times = None
 
+    csv_fields = ('route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id')
+
+    @classmethod
+    def from_row(cls, row, routes, services, shapes):
+        route_id, service_id, trip_id, direction_id, shape_id = row
+        return cls(routes[int(route_id)],
+                   services[int(service_id)],
+                   trip_id,
+                   int(direction_id),
+                   int(shape_id) if shape_id != '' else -1)
+
     @classmethod
     def from_csv(cls, csv_record, routes, services, shapes):
-        route = routes[int(csv_record['route_id'])]
-        service = services[int(csv_record['service_id'])]
-        return cls(route,
-                   service,
-                   csv_record['trip_id'],
-                   int(csv_record['direction_id']),
-                   int(csv_record['shape_id']) if csv_record['shape_id'] != '' else -1)
+        return cls.from_row([csv_record[field] for field in cls.csv_fields], routes, services, shapes)
 
 
 class FullTrip(Trip):
@@ -92,30 +176,92 @@ class FullTrip(Trip):
         self.route_story = route_story
         self.start_time = start_time
 
+    csv_fields = Trip.csv_fields + ('start_time', 'route_story')
+
+    @classmethod
+    def from_row(cls, row, routes, services, route_stories):
+        route_id, service_id, trip_id, direction_id, shape_id, start_time, route_story_id = row
+        return cls(routes[int(route_id)],
+                   services[int(service_id)],
+                   trip_id,
+                   int(direction_id),
+                   int(shape_id) if shape_id != '' else -1,
+                   route_stories[int(route_story_id)],
+                   parse_timestamp(start_time))
+
     @classmethod
     def from_csv(cls, csv_record, routes, services, route_stories):
-        route_id = int(csv_record['route_id'])
-        route = routes[route_id]
+        return cls.from_row([csv_record[field] for field in cls.csv_fields], routes, services, route_stories)
+
 
-        service_id = int(csv_record['service_id'])
-        service = services[service_id]
+def hourly_counts(start_time, end_time, headway, offset=0):
+    """Returns a map from hour to the number of trips of a frequency block (trips starting every headway seconds from
+    start_time to end_time) that are at offset seconds from their start in that hour"""
+    start_times = range(start_time, end_time + 1, headway or 1)
+    res = {}
+    for hour in range((start_time + offset) // 3600, (end_time + offset) // 3600 + 1):
+        # the start times in [hour * 3600 - offset, (hour + 1) * 3600 - offset)
+        trips = (bisect.bisect_left(start_times, (hour + 1) * 3600 - offset) -
+                 bisect.bisect_left(start_times, hour * 3600 - offset))
+        if trips > 0:
+            res[hour] = trips
+    return res
 
-        route_story_id = int(csv_record['route_story'])
-        route_story = route_stories[route_story_id]
 
-        def parse_timestamp(timestamp):
-            """Returns second since start of day"""
-            # We need to manually parse because there's hours >= 24; but ain't Python doing it beautifully?
-            (hour, minute, second) = (int(f) for f in timestamp.split(':'))
-            return hour * 60 * 60 + minute * 60 + second
+class FrequencyBlock:
+    """Trips of the same route, service, route story, direction and shape that start every headway seconds, from
+    start_time to end_time (the start time of the last trip), like a gtfs frequencies.txt record. A trip that isn't
+    part of a series is a block of its own, with headway 0. trip_ids are the ids of the trips, by start time."""
 
-        return cls(route,
-                   service,
-                   csv_record['trip_id'],
-                   int(csv_record['direction_id']),
-                   int(csv_record['shape_id']) if csv_record['shape_id'] != '' else -1,
-                   route_story,
-                   parse_timestamp(csv_record['start_time']))
+    def __init__(self, route, service, route_story, direction_id, shape_id, start_time, end_time, headway, trip_ids):
+        self.route = route
+        self.service = service
+        self.route_story = route_story
+        self.direction_id = direction_id
+        self.shape_id = shape_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.headway = headway
+        self.trip_ids = trip_ids
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+    @property
+    def start_times(self):
+        """The start times of the trips, as a range"""
+        return range(self.start_time, self.end_time + 1, self.headway or 1)
+
+    def trips(self):
+        """Yields the FullTrip objects of the block"""
+        for trip_id, start_time in zip(self.trip_ids, self.start_times):
+            yield FullTrip(self.route, self.service, trip_id, self.direction_id, self.shape_id, self.route_story,
+                           start_time)
+
+    def hourly_counts(self, offset=0):
+        """Returns a map from hour to the number of trips that are at offset seconds from their start in that hour"""
+        return hourly_counts(self.start_time, self.end_time, self.headway, offset)
+
+    csv_fields = ('route_id', 'service_id', 'route_story', 'direction_id', 'shape_id', 'start_time', 'end_time',
+                  'headway_secs', 'trip_ids')
+
+    @classmethod
+    def from_row(cls, row, routes, services, route_stories):
+        route_id, service_id, route_story_id, direction_id, shape_id, start_time, end_time, headway, trip_ids = row
+        return cls(routes[int(route_id)],
+                   services[int(service_id)],
+                   route_stories[int(route_story_id)],
+                   int(direction_id),
+                   int(shape_id),
+                   parse_timestamp(start_time),
+                   parse_timestamp(end_time),
+                   int(headway),
+                   trip_ids.split(' '))
+
+    @classmethod
+    def from_trip(cls, trip):
+        return cls(trip.route, trip.service, trip.route_story, trip.direction_id, trip.shape_id, trip.start_time,
+                   trip.start_time, 0, [trip.trip_id])
 
 
 class Service:
@@ -133,14 +279,22 @@ class Service:
     def __hash__(self):
         return hash(self.service_id)
 
+    # the day fields are in weekday order, so their position is the weekday
+    csv_fields = ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                  'start_date', 'end_date')
+
     @classmethod
-    def from_csv(cls, csv_record):
-        service_id = int(csv_record['service_id'])
-        days = {Service.weekday_names[day] for day in Service.weekday_names.keys() if csv_record[day] == '1'}
-        start_date = datetime.datetime.strptime(csv_record['start_date'], "%Y%m%d").date()
-        end_date = datetime.datetime.strptime(csv_record['end_date'], "%Y%m%d").date()
+    def from_row(cls, row):
+        service_id = int(row[0])
+        days = {day for day, flag in enumerate(row[1:8]) if flag == '1'}
+        start_date = datetime.datetime.strptime(row[8], "%Y%m%d").date()
+        end_date = datetime.datetime.strptime(row[9], "%Y%m%d").date()
         return cls(service_id, days, start_date, end_date)
 
+    @classmethod
+    def from_csv(cls, csv_record):
+        return cls.from_row([csv_record[field] for field in cls.csv_fields])
+
 
 class StopTime:
     # trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type
@@ -152,21 +306,19 @@ class StopTime:
         self.departure_time = departure_time
         self.arrival_time = arrival_time
 
+    # trip_id isn't a StopTime field, but it's read with every row to group the stop times by trip
+    csv_fields = ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'pickup_type',
+                  'drop_off_type')
+
     @classmethod
-    def from_csv(cls, csv_record):
-        def parse_timestamp(timestamp):
-            """Returns second since start of day"""
-            # We need to manually parse because there's hours >= 24; but ain't Python doing it beautifully?
-            (hour, minute, second) = (int(f) for f in timestamp.split(':'))
-            return hour * 60 * 60 + minute * 60 + second
+    def from_row(cls, row):
+        _, arrival_time, departure_time, stop_id, stop_sequence, pickup_type, drop_off_type = row
+        return cls(parse_timestamp(arrival_time), parse_timestamp(departure_time), int(stop_id), int(stop_sequence),
+                   pickup_type, drop_off_type)
 
-        arrival_time = parse_timestamp(csv_record['arrival_time'])
-        departure_time = parse_timestamp(csv_record['departure_time'])
-        stop_id = int(csv_record['stop_id'])
-        stop_sequence = int(csv_record['stop_sequence'])
-        pickup_type = csv_record['pickup_type']
-        drop_off_type = csv_record['drop_off_type']
-        return cls(arrival_time, departure_time, stop_id, stop_sequence, pickup_type, drop_off_type)
+    @classmethod
+    def from_csv(cls, csv_record):
+        return cls.from_row([csv_record[field] for field in cls.csv_fields])
 
 
 class Stop:
@@ -188,31 +340,57 @@ class Stop:
     def __hash__(self):
         return hash(self.stop_id)
 
+    csv_fields = ('stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon', 'location_type',
+                  'parent_station', 'zone_id')
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(int(row[0]), *row[1:])
+
     @classmethod
     def from_csv(cls, csv_record):
-        stop_id = int(csv_record['stop_id'])
-        field_names = "stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,zone_id".split(',')
-        fields = [csv_record[field] for field in field_names]
-        return cls(stop_id, *fields)
+        return cls.from_row([csv_record[field] for field in cls.csv_fields])
 
 
 class FullStop(Stop):
     def __init__(self, stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, location_type, parent_station,
-                 zone_id, nearest_train_station_id, train_station_distance, routes_stopping_here):
+                 zone_id, nearest_train_station_id, train_station_distance, routes_stopping_here, nearest_stations,
+                 complex_id):
         super().__init__(stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, location_type, parent_station,
                          zone_id)
         self.nearest_train_station_id = nearest_train_station_id
         self.train_station_distance = train_station_distance
         self.routes_stopping_here = routes_stopping_here
+        # station_id -> distance in meters, nearest first, for the train stations near the stop (see
+        # gtfs_extender.extend_stops); stations that are further than all of them aren't listed
+        self.nearest_stations = nearest_stations
+        # the stop_id that represents the complex of stops (station, terminal) this stop is part of; the stop's own id
+        # if it isn't part of one
+        self.complex_id = complex_id
+
+    @property
+    def is_train_station(self):
+        return self.nearest_train_station_id == self.stop_id
+
+    def nearest_of_stations(self, station_ids):
+        """Returns the nearest of station_ids to the stop, or None if none of them is in nearest_stations"""
+        for station_id in self.nearest_stations:
+            if station_id in station_ids:
+                return station_id
+        return None
+
+    csv_fields = Stop.csv_fields + ('nearest_train_station', 'train_station_distance', 'routes_here',
+                                    'nearest_stations', 'complex_id')
 
     @classmethod
-    def from_csv(cls, csv_record):
-        stop_id = int(csv_record['stop_id'])
-        field_names = "stop_code,stop_name,stop_desc,stop_lat,stop_lon,location_type,parent_station,zone_id".split(',')
-        fields = [csv_record[field] for field in field_names]
-        fields += [int(csv_record['nearest_train_station']), int(csv_record['train_station_distance'])]
-        fields += [csv_record['routes_here'].split(' ')]
-        return cls(stop_id, *fields)
+    def from_row(cls, row):
+        nearest_stations = {}
+        for station in row[12].split(' '):
+            if station != '':
+                station_id, distance = station.split(':')
+                nearest_stations[int(station_id)] = int(distance)
+        return cls(int(row[0]), *row[1:9], int(row[9]), int(row[10]), row[11].split(' '), nearest_stations,
+                   int(row[13]))
 
 
 class Shape:
@@ -223,14 +401,20 @@ class Shape:
     def add_coordinate(self, point, sequence):
         self.coordinates[sequence] = point
 
-    # shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence
+    csv_fields = ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence')
+
+    @classmethod
+    def from_row(cls, row, current_shapes):
+        shape_id, lat, lon, sequence = row
+        shape_id = int(shape_id)
+        shape = current_shapes.get(shape_id)
+        if shape is None:
+            shape = current_shapes[shape_id] = Shape(shape_id)
+        shape.add_coordinate((float(lat), float(lon)), int(sequence))
+
     @classmethod
     def from_csv(cls, csv_record, current_shapes):
-        shape_id = int(csv_record['shape_id'])
-        point = (float(csv_record['shape_pt_lat']), float(csv_record['shape_pt_lon']))
-        sequence = int(csv_record['shape_pt_sequence'])
-        shape = current_shapes.setdefault(shape_id, Shape(shape_id))
-        shape.add_coordinate(point, sequence)
+        cls.from_row([csv_record[field] for field in cls.csv_fields], current_shapes)
 
 
 class RouteStoryStop:
@@ -257,13 +441,17 @@ class RouteStoryStop:
     def __repr__(self):
         return 'stop_id=%s,stop_sequence=%s' % (self.stop_id, self.stop_sequence)
 
+    csv_fields = ('route_story_id', 'arrival_offset', 'departure_offset', 'stop_id', 'pickup_type', 'drop_off_type')
+
+    @classmethod
+    def from_row(cls, row):
+        """Returns the route story id and the RouteStoryStop"""
+        fields = [int(field) if field != '' else 0 for field in row]
+        return fields[0], cls(*fields[1:])
+
     @classmethod
     def from_csv(cls, csv_record):
-        route_story_id = int(csv_record['route_story_id'])
-        field_names = "arrival_offset,departure_offset,stop_id,pickup_type,drop_off_type".split(',')
-        fields = [csv_record[field] for field in field_names]
-        fields = [int(field) if field != '' else 0 for field in fields]
-        return route_story_id, cls(*fields)
+        return cls.from_row([csv_record[field] for field in cls.csv_fields])
 
 
 class RouteStory:
@@ -283,25 +471,140 @@ class RouteStory:
         return RouteStory(route_story_id, route_story_stops, set())
 
 
-def read_stop_times(reader, trips):
-    print("  reading records from file")
-    records_by_trip_id = {}
-    for i, record in enumerate(reader):
-        records_by_trip_id.setdefault(record['trip_id'], []).append(StopTime.from_csv(record))
-        if i % 100000 == 0:
-            print(datetime.datetime.now())
+class ValidationReport:
+    """The problems found while reading a feed: for every kind of problem, the number found and a few sample ids"""
 
-    print("  %d records read for %d trips" %
-          (sum(len(x) for x in records_by_trip_id.values()), len(records_by_trip_id)))
+    def __init__(self, max_samples=10):
+        self.max_samples = max_samples
+        self.counts = {}
+        self.samples = {}
 
-    stop_times_to_trips = {}
-    for trip_id, records in records_by_trip_id.items():
-        records.sort(key=lambda stop_time: stop_time.stop_sequence)
-        if records[0].stop_sequence != 1 or records[-1].stop_sequence != len(records):
-            print("Bad stop time sequence %s" % records)
-            continue
-        stop_times_to_trips.setdefault(tuple(records), []).append(trip_id)
-    print("There are %d stop time sequences" % len(stop_times_to_trips))
+    def add(self, problem, ids):
+        """Adds the ids (trips, stops...) that have a problem"""
+        if len(ids) == 0:
+            return
+        self.counts[problem] = self.counts.get(problem, 0) + len(ids)
+        samples = self.samples.setdefault(problem, [])
+        samples += sorted(ids, key=str)[:self.max_samples - len(samples)]
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def as_dict(self):
+        return {problem: {'count': self.counts[problem], 'samples': self.samples[problem]}
+                for problem in sorted(self.counts)}
+
+    def log(self):
+        for problem, found in self.as_dict().items():
+            count(problem, found['count'])
+            message('%s: %d, like %s' % (problem, found['count'], ' '.join(str(i) for i in found['samples'])))
+
+    def save(self, filename):
+        with open(filename, 'w', encoding='utf8') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class SequenceTexts(dict):
+    """The text of every stop_sequence value, so rows can be checked without parsing their stop_sequence"""
+
+    def __missing__(self, sequence):
+        self[sequence] = text = str(sequence)
+        return text
+
+
+class StopTimesValidator:
+    """Checks the rows of stop_times.txt (tuples of StopTime.csv_fields) as they're read.
+
+    The rows of a trip come together and in stop_sequence order in the feeds we get, so every row is only compared
+    with the row before it, by text, while the rows are grouped by trip; that costs much less than parsing the row.
+    Trips whose rows aren't together and in order are sorted and checked again by finish(). The problems found:
+      non_contiguous_sequence   the stop_sequence values of the trip aren't 1 to the number of its stops
+      unknown_trip              stop times of a trip that's not in trips.txt
+      trip_without_stop_times   a trip in trips.txt that has no stop times
+    The stop times of trips that make the same stops at the same offsets are the same, so the callers check the times
+    (decreasing_times, see times_decrease) and the stop_ids (unknown_stop) once per distinct sequence of stops.
+    """
+
+    sequence_texts = SequenceTexts()
+
+    def __init__(self, report):
+        self.report = report
+        self.unordered = set()
+
+    def group(self, rows, make_record=None):
+        """Returns a map from trip_id to the list of the records of its rows (make_record(row), or the rows themselves),
+        checking the rows on the way"""
+        res = {}
+        unordered, sequence_texts = self.unordered, self.sequence_texts
+        last_trip_id, sequence, records = None, 0, None
+        for row in rows:
+            trip_id = row[0]
+            if trip_id == last_trip_id:
+                sequence += 1
+                if row[4] != sequence_texts[sequence]:
+                    unordered.add(trip_id)
+            else:
+                records = res.get(trip_id)
+                if records is None:
+                    records = res[trip_id] = []
+                    if row[4] != '1':
+                        unordered.add(trip_id)
+                else:
+                    unordered.add(trip_id)
+                last_trip_id, sequence = trip_id, 1
+            records.append(row if make_record is None else make_record(row))
+        return res
+
+    def finish(self, records_by_trip_id, stop_sequence, known_trip_ids):
+        """Sorts the records of the trips whose rows weren't in order (by stop_sequence(record)), checks them and the
+        references, and adds the problems to the report. Returns the ids of the trips that should be dropped: trips
+        with a bad sequence, and unknown trips."""
+        bad_sequences = set()
+        for trip_id in self.unordered:
+            records = records_by_trip_id[trip_id]
+            records.sort(key=stop_sequence)
+            if [stop_sequence(record) for record in records] != list(range(1, len(records) + 1)):
+                bad_sequences.add(trip_id)
+        unknown_trips = records_by_trip_id.keys() - known_trip_ids
+        self.report.add('non_contiguous_sequence', bad_sequences)
+        self.report.add('unknown_trip', unknown_trips)
+        self.report.add('trip_without_stop_times', known_trip_ids - records_by_trip_id.keys())
+        return bad_sequences | unknown_trips
+
+
+def times_decrease(times):
+    """Returns True if a list of the (arrival, departure) times (or offsets) at the stops of a trip goes back in time"""
+    return any(departure < arrival for arrival, departure in times) or \
+        any(arrival < departure for (_, departure), (arrival, _) in zip(times, times[1:]))
+
+
+def read_stop_ids(filename):
+    """Returns the stop_ids in the stops.txt of a gtfs zip"""
+    with zipfile.ZipFile(filename) as z:
+        with z.open('stops.txt') as f:
+            return {int(stop_id) for stop_id, in read_fields(io.TextIOWrapper(f, 'utf8'), ('stop_id',))}
+
+
+def read_stop_times(rows, trips, validation, known_stop_ids):
+    """Sets the stop times of trips, from rows of StopTime.csv_fields. The problems found are added to validation (a
+    ValidationReport); trips with bad stop sequences don't get stop times."""
+    validator = StopTimesValidator(validation)
+    with stage('read records'), gc_paused():
+        records_by_trip_id = validator.group(progress(rows, 100000), StopTime.from_row)
+        count('trips', len(records_by_trip_id))
+
+    with stage('verify'):
+        dropped = validator.finish(records_by_trip_id, operator.attrgetter('stop_sequence'), set(trips))
+        stop_times_to_trips = {}
+        for trip_id, records in records_by_trip_id.items():
+            if trip_id not in dropped:
+                stop_times_to_trips.setdefault(tuple(records), []).append(trip_id)
+        validation.add('decreasing_times', [trip_id for stop_times, trip_ids in stop_times_to_trips.items()
+                                            if times_decrease([(s.arrival_time, s.departure_time) for s in stop_times])
+                                            for trip_id in trip_ids])
+        validation.add('unknown_stop', {s.stop_id for stop_times in stop_times_to_trips for s in stop_times} -
+                       known_stop_ids)
+        count('stop_time_sequences', len(stop_times_to_trips))
 
     for i, (stop_times, stop_time_trip_ids) in enumerate(stop_times_to_trips.items()):
         for trip_id in stop_time_trip_ids:
@@ -309,192 +612,301 @@ def read_stop_times(reader, trips):
             trips[trip_id].stop_times = stop_times
 
 
+class Table:
+    """A table of the gtfs (g.stops, g.trips...) that's loaded by its load method the first time it's read. The load
+    method sets the instance attribute, which hides the table from then on, so reading a loaded table costs nothing."""
+
+    def __init__(self, load_method):
+        self.load_method = load_method
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, gtfs, owner=None):
+        if gtfs is None:
+            return self
+        getattr(gtfs, self.load_method)()
+        try:
+            return gtfs.__dict__[self.name]
+        except KeyError:
+            raise AttributeError("%s didn't load %s" % (self.load_method, self.name)) from None
+
+
+def loads(table, *dependencies):
+    """Decorates the method that loads a table. The method does nothing if the table is loaded already; otherwise it
+    loads the tables the table is built from (which are loaded the same way) and then the table. The loading is done
+    under the gtfs's load lock, so threads that read a table at the same time load it once."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self):
+            with self.load_lock:
+                if self.is_loaded(table):
+                    return
+                if table in self.loading:
+                    raise RuntimeError("%s is read while it's being loaded" % table)
+                self.loading.add(table)
+                try:
+                    for dependency in dependencies:
+                        getattr(self, dependency)
+                    method(self)
+                finally:
+                    self.loading.discard(table)
+
+        wrapper.table = table
+        wrapper.dependencies = dependencies
+        return wrapper
+
+    return decorator
+
+
 class GTFS:
+    """The tables are loaded when they're first read (g.stops loads the stops, g.trips loads the services, the
+    routes and the trips), or by calling their load method, and each is loaded once."""
+
+    agencies = Table('load_agencies')  # type: Dict[int, Agency]
+    routes = Table('load_routes')  # type: Dict[int, Route]
+    shapes = Table('load_shapes')  # type: Dict[int, Shape]
+    services = Table('load_services')  # type: Dict[int, Service]
+    trips = Table('load_trips')  # type: Dict[int, Trip]
+    stops = Table('load_stops')  # type: Dict[int, Stop]
+
     def __init__(self, folder):
         """Initialize with the folder that contains israel-public-transportation.zip"""
         self.filename = os.path.join(folder, 'israel-public-transportation.zip') # type: str
-        self.agencies = None  # type: Optional[Dict[int, Agency]]
-        self.routes = None  # type: Optional[Dict[int, Route]]
-        self.shapes = None  # type: Optional[Dict[int, Shape]]
-        self.services = None  # type: Optional[Dict[int, Service]]
-        self.trips = None  # type: Optional[Dict[int, Trip]]
-        self.stops = None  # type: Optional[Dict[int, Stop]]
+        self.load_lock = threading.RLock()
+        self.loading = set()  # the tables being loaded, by the thread that holds the lock
+        self.validation = ValidationReport()  # the problems found in the feed files while loading them
+
+    def is_loaded(self, table):
+        return table in self.__dict__
 
+    def unload(self, *tables):
+        """Drops tables, so they're loaded again when they're next read"""
+        with self.load_lock:
+            for table in tables:
+                self.__dict__.pop(table, None)
+
+    @loads('agencies')
     def load_agencies(self):
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading agencies")
+        with stage('load agencies'), zipfile.ZipFile(self.filename) as z:
             with z.open('agency.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                self.agencies = {agency.agency_id: agency for agency in (Agency.from_csv(record) for record in reader)}
-            print("%d agencies loaded" % len(self.agencies))
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Agency.csv_fields)
+                self.agencies = {agency.agency_id: agency for agency in (Agency.from_row(row) for row in rows)}
+            count('agencies', len(self.agencies))
 
+    @loads('routes', 'agencies')
     def load_routes(self):
-        if self.agencies is None:
-            self.load_agencies()
-
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading routes")
+        with stage('load routes'), zipfile.ZipFile(self.filename) as z:
             with z.open('routes.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                self.routes = {route.route_id: route for route in (Route.from_csv(record, self.agencies)
-                                                                   for record in reader)}
-            print("%d routes loaded" % len(self.routes))
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Route.csv_fields)
+                self.routes = {route.route_id: route for route in (Route.from_row(row, self.agencies) for row in rows)}
+            count('routes', len(self.routes))
 
+    @loads('shapes')
     def load_shapes(self):
-        self.shapes = {}
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading shapes")
+        shapes = {}
+        with stage('load shapes'), gc_paused(), zipfile.ZipFile(self.filename) as z:
             with z.open('shapes.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                for record in reader:
-                    Shape.from_csv(record, self.shapes)
-            print("%d shapes loaded" % len(self.shapes))
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Shape.csv_fields)
+                for row in progress(rows, 1000000):
+                    Shape.from_row(row, shapes)
+            self.shapes = shapes
+            count('shapes', len(self.shapes))
 
+    @loads('services')
     def load_services(self):
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading services")
+        with stage('load services'), zipfile.ZipFile(self.filename) as z:
             with z.open('calendar.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                self.services = {service.service_id: service for service in
-                                 (Service.from_csv(record) for record in reader)}
-            print("%d services loaded" % len(self.services))
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Service.csv_fields)
+                self.services = {service.service_id: service for service in (Service.from_row(row) for row in rows)}
+            count('services', len(self.services))
 
+    @loads('trips', 'services', 'routes')
     def load_trips(self):
-        if self.services is None:
-            self.load_services()
-
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading trips")
+        # the trips don't need the shapes, so they aren't loaded for them
+        shapes = self.shapes if self.is_loaded('shapes') else None
+        with stage('load trips'), zipfile.ZipFile(self.filename) as z:
             with z.open('trips.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                self.trips = {trip.trip_id: trip for trip in (Trip.from_csv(record,
-                                                                            self.routes,
-                                                                            self.services,
-                                                                            self.shapes) for record in reader)}
-            print("%d trips loaded" % len(self.trips))
-
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Trip.csv_fields)
+                trips = {}
+                unknown_routes, unknown_services = set(), set()
+                for row in rows:
+                    try:
+                        trip = Trip.from_row(row, self.routes, self.services, shapes)
+                    except KeyError:
+                        route_id, _, trip_id, _, _ = row
+                        (unknown_routes if int(route_id) not in self.routes else unknown_services).add(trip_id)
+                        continue
+                    trips[trip.trip_id] = trip
+                self.trips = trips
+            # trips that refer to a route or a service that doesn't exist are left out
+            self.validation.add('unknown_route', unknown_routes)
+            self.validation.add('unknown_service', unknown_services)
+            count('trips', len(self.trips))
+
+    @loads('stops')
     def load_stops(self):
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading stops")
+        with stage('load stops'), zipfile.ZipFile(self.filename) as z:
             with z.open('stops.txt') as f:
-                reader = csv.DictReader(io.TextIOWrapper(f, 'utf8'))
-                self.stops = {stop.stop_id: stop for stop in (Stop.from_csv(record) for record in reader)}
-            print("%d stops loaded" % len(self.stops))
+                rows = read_fields(io.TextIOWrapper(f, 'utf8'), Stop.csv_fields)
+                self.stops = {stop.stop_id: stop for stop in (Stop.from_row(row) for row in rows)}
+            count('stops', len(self.stops))
 
     def load_stop_times(self):
-        print("Loading stop times. This will be verrrrry slow.")
-        if self.trips is None:
-            self.load_trips()
-        with zipfile.ZipFile(self.filename) as z:
-            print("Loading stop times")
+        # this will be verrrrry slow
+        with stage('load stop times'), gc_paused(), zipfile.ZipFile(self.filename) as z:
             with z.open('stop_times.txt') as f:
-                read_stop_times(csv.DictReader(io.TextIOWrapper(f, 'utf8')), self.trips)
+                read_stop_times(read_fields(io.TextIOWrapper(f, 'utf8'), StopTime.csv_fields), self.trips,
+                                self.validation, read_stop_ids(self.filename))
+            self.validation.log()
 
 
 class ExtendedGTFS(GTFS):
     full_routes_filename = 'full_routes.txt'
+    trip_frequencies_filename = 'trip_frequencies.txt'
     route_story_services_filename = 'route_story_services.txt'
     route_story_stops_files = 'route_story_stops.txt'
 
+    route_stories = Table('load_route_stories')  # type: Dict[int, RouteStory]
+    frequency_blocks = Table('load_frequency_blocks')  # type: List[FrequencyBlock]
+
     def __init__(self, filename):
         super().__init__(filename)
-        self.route_stories = None
+        self._single_trip_blocks = None
 
     def at_path(self, filename):
-        return os.path.join(self.filename, os.pardir, filename)
+        return os.path.join(os.path.dirname(self.filename), filename)
 
     def full_trips_filename(self):
         return self.at_path('full_trips.txt')
 
     def full_stops_filename(self):
-        return os.path.join(self.filename, os.pardir, 'full_stops.txt')
-
-    def load_route_stories(self):
-        if self.services is None:
-            self.load_services()
-
-        if self.route_stories is not None:
-            return
-
-        print("Loading route stories")
-        route_story_id_to_stops = defaultdict(lambda: [])
-        with open(self.at_path(self.route_story_stops_files), encoding='utf8') as f:
-            for record in csv.DictReader(f):
-                trip_story_id, trip_story_stop = RouteStoryStop.from_csv(record)
-                route_story_id_to_stops[trip_story_id].append(trip_story_stop)
-
-        # make sure the trip stories are sorted correctly, and assign stop_sequence values
-        for story in route_story_id_to_stops.values():
-            story.sort(key=lambda s: s.arrival_offset)
-            for stop_sequence, stop in enumerate(story):
-                stop.stop_sequence = stop_sequence + 1
+        return self.at_path('full_stops.txt')
 
-        self.route_stories = {}
-        for route_story_id, stops in route_story_id_to_stops.items():
-            self.route_stories[route_story_id] = RouteStory.from_tuple(route_story_id, stops)
+    def open_extended_file(self, filename):
+        """Opens one of the extended csv files for reading"""
+        return open(filename, encoding='utf8')
 
-        # now add services
-        with open(self.at_path(self.route_story_services_filename), encoding='utf8') as f:
-            for record in csv.DictReader(f):
-                route_story_id, service_id = int(record['route_story_id']), int(record['service_id'])
-                self.route_stories[route_story_id].services.add(self.services[service_id])
+    def has_extended_file(self, filename):
+        """Returns whether one of the extended csv files exists"""
+        return os.path.exists(filename)
 
-        print("%d route_stories loaded" % len(self.route_stories))
+    @loads('route_stories', 'services')
+    def load_route_stories(self):
+        self.load_csv_route_stories()
+
+    def load_csv_route_stories(self):
+        """Loads (or reloads) the route stories from route_story_stops.txt and route_story_services.txt"""
+        with stage('load route stories'), gc_paused():
+            route_story_id_to_stops = defaultdict(lambda: [])
+            with open(self.at_path(self.route_story_stops_files), encoding='utf8') as f:
+                for row in progress(read_fields(f, RouteStoryStop.csv_fields), 1000000):
+                    trip_story_id, trip_story_stop = RouteStoryStop.from_row(row)
+                    route_story_id_to_stops[trip_story_id].append(trip_story_stop)
+
+            # make sure the trip stories are sorted correctly, and assign stop_sequence values
+            for story in route_story_id_to_stops.values():
+                story.sort(key=lambda s: s.arrival_offset)
+                for stop_sequence, stop in enumerate(story):
+                    stop.stop_sequence = stop_sequence + 1
+
+            route_stories = {}
+            for route_story_id, stops in route_story_id_to_stops.items():
+                route_stories[route_story_id] = RouteStory.from_tuple(route_story_id, stops)
+
+            # now add services
+            with open(self.at_path(self.route_story_services_filename), encoding='utf8') as f:
+                for route_story_id, service_id in read_fields(f, ('route_story_id', 'service_id')):
+                    route_story_id, service_id = int(route_story_id), int(service_id)
+                    route_stories[route_story_id].services.add(self.services[service_id])
+
+            self.route_stories = route_stories
+            count('route_stories', len(self.route_stories))
 
     def load_basic_trips(self):
+        """Loads (or reloads) the trips from the gtfs zip, without the route stories"""
+        self.unload('trips')
         super().load_trips()
 
+    @loads('trips', 'services', 'routes', 'route_stories')
     def load_trips(self):
-        if self.trips is not None:
-            return
-
-        if self.services is None:
-            self.load_services()
-
-        if self.routes is None:
-            self.load_routes()
-
-        if self.route_stories is None:
-            self.load_route_stories()
-
-        print("Loading full trips")
-        with open(self.full_trips_filename(), encoding='utf8') as f:
-            reader = csv.DictReader(f)
-            self.trips = {trip.trip_id: trip for trip in (FullTrip.from_csv(record,
+        with stage('load full trips'), gc_paused(), self.open_extended_file(self.full_trips_filename()) as f:
+            rows = read_fields(f, FullTrip.csv_fields)
+            self.trips = {trip.trip_id: trip for trip in (FullTrip.from_row(row,
                                                                             self.routes, self.services,
                                                                             self.route_stories)
-                                                          for record in reader)}
-        print("%d full trips loaded" % len(self.trips))
+                                                          for row in progress(rows, 1000000))}
+
+    @loads('frequency_blocks', 'services', 'routes', 'route_stories')
+    def load_frequency_blocks(self):
+        """Loads the trips as frequency blocks (see gtfs_extender.build_frequency_blocks), instead of a FullTrip object
+        for each trip"""
+        with stage('load frequency blocks'), self.open_extended_file(self.at_path(self.trip_frequencies_filename)) as f:
+            rows = read_fields(f, FrequencyBlock.csv_fields)
+            self.frequency_blocks = [FrequencyBlock.from_row(row, self.routes, self.services, self.route_stories)
+                                     for row in rows]
+            count('frequency_blocks', len(self.frequency_blocks))
+            count('trips', sum(len(block) for block in self.frequency_blocks))
+
+    def trip_blocks(self):
+        """Returns the frequency blocks, or a single trip block for every trip if the trips are loaded and the frequency
+        blocks aren't, or if there are no frequency blocks (a snapshot_store snapshot keeps only the trips)"""
+        if self._use_frequency_blocks():
+            return self.frequency_blocks
+        # the single trip blocks are kept as long as the trips table isn't replaced
+        if self._single_trip_blocks is None or self._single_trip_blocks[0] is not self.trips:
+            self._single_trip_blocks = (self.trips, [FrequencyBlock.from_trip(trip) for trip in self.trips.values()])
+        return self._single_trip_blocks[1]
+
+    def iter_trips(self):
+        """Yields the trips: from the trips table if it's loaded (or if there are no frequency blocks), otherwise by
+        expanding the frequency blocks"""
+        if self.is_loaded('trips') or not self._use_frequency_blocks():
+            yield from self.trips.values()
+        else:
+            for block in self.frequency_blocks:
+                yield from block.trips()
+
+    def _use_frequency_blocks(self):
+        if self.is_loaded('frequency_blocks'):
+            return True
+        return not self.is_loaded('trips') and self.has_extended_file(self.at_path(self.trip_frequencies_filename))
 
     def load_basic_stops(self):
+        """Loads (or reloads) the stops from the gtfs zip"""
+        self.unload('stops')
         super().load_stops()
 
     def load_extended_stops(self):
-        if self.stops is not None:
-            return
-        with open(self.full_stops_filename(), encoding='utf8') as f:
-            print("Loading stops")
-            reader = csv.DictReader(f)
-            self.stops = {stop.stop_id: stop for stop in (FullStop.from_csv(record) for record in reader)}
-            print("%d stops loaded" % len(self.stops))
+        with stage('load full stops'), open(self.full_stops_filename(), encoding='utf8') as f:
+            rows = read_fields(f, FullStop.csv_fields)
+            self.stops = {stop.stop_id: stop for stop in (FullStop.from_row(row) for row in rows)}
+            count('stops', len(self.stops))
 
+    @loads('stops')
     def load_stops(self):
-        if self.stops is not None:
-            return
         self.load_extended_stops()
 
     def load_basic_routes(self):
+        """Loads (or reloads) the routes from the gtfs zip"""
+        self.unload('routes')
         super().load_routes()
 
+    @loads('routes', 'agencies')
     def load_routes(self):
-        if self.agencies is None:
-            self.load_agencies()
-
-        print("Loading full routes")
-        with open(self.at_path(self.full_routes_filename), 'r', encoding='utf8') as f:
-            reader = csv.DictReader(f)
-            self.routes = {route.route_id: route for route in (FullRoute.from_csv(record, self.agencies)
-                                                               for record in reader)}
+        with stage('load full routes'), self.open_extended_file(self.at_path(self.full_routes_filename)) as f:
+            rows = read_fields(f, FullRoute.csv_fields)
+            self.routes = {route.route_id: route for route in (FullRoute.from_row(row, self.agencies)
+                                                               for row in rows)}
+            count('routes', len(self.routes))
+
+    def stops_by_complex(self):
+        """Returns a map from complex_id to the list of the stop_ids in the complex"""
+        res = defaultdict(lambda: [])
+        for stop in self.stops.values():
+            res[stop.complex_id].append(stop.stop_id)
+        return res
 
     @property
     def train_stations(self):
@@ -0,0 +1,179 @@
+"""
+ timing and metrics for the pipeline stages.
+
+ Code wraps its stages with `with stage('name'):`, counts what it processes with count('rows', n) (or by iterating
+ with progress()) and reports anything else with message(). Stages nest; when a stage ends, its time, counts,
+ throughput and the process peak rss are sent to the current sink:
+
+   PrintSink      human readable lines on stdout (the default)
+   LogSink        the same lines, to the logging module
+   JsonLinesSink  one json object per event, for collecting metrics from batch runs
+   None           disabled; stage(), count() and progress() do (almost) nothing
+
+ set_sink() replaces the sink for the whole process.
+"""
+
+import contextlib
+import datetime
+import gc
+import json
+import logging
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not on windows; the stages are reported without the peak rss
+    resource = None
+
+
+class PrintSink:
+    def __init__(self, track_objects=False):
+        self.track_objects = track_objects
+
+    @staticmethod
+    def format(event):
+        # nested stages are indented, so only the last part of the stage path is shown
+        indent = '  ' * event['depth']
+        name = event['stage'].split('/')[-1]
+        if event['event'] == 'stage_start':
+            return '%s%s' % (indent, name)
+        if event['event'] == 'message':
+            return '%s%s' % (indent, event['text'])
+        if event['event'] == 'progress':
+            return '%s  %d %s' % (indent, event['rows'], event['time'])
+        counts = ''.join(', %s=%d' % (counter, value) for counter, value in event['counts'].items())
+        throughput = ', %d rows/s' % event['rows_per_second'] if 'rows_per_second' in event else ''
+        rss = ', peak rss %d MB' % (event['peak_rss_kb'] // 1024) if event['peak_rss_kb'] is not None else ''
+        return '%s%s done: %.2fs%s%s%s' % (indent, name, event['seconds'], counts, throughput, rss)
+
+    def emit(self, event):
+        print(self.format(event))
+
+
+class LogSink(PrintSink):
+    def __init__(self, logger=None, level=logging.INFO, track_objects=False):
+        super().__init__(track_objects)
+        self.logger = logger or logging.getLogger('kavrazif')
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, self.format(event))
+
+
+class JsonLinesSink:
+    def __init__(self, filename, track_objects=False):
+        self.track_objects = track_objects
+        self.lock = threading.Lock()
+        self.f = open(filename, 'a', encoding='utf8')
+
+    def emit(self, event):
+        with self.lock:
+            self.f.write(json.dumps(event) + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class _Stage:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.counts = {}
+        self.start = time.perf_counter()
+
+
+_sink = PrintSink()
+_local = threading.local()
+
+
+def set_sink(sink):
+    """Sets the sink for all the following events. None disables the instrumentation."""
+    global _sink
+    _sink = sink
+
+
+def get_sink():
+    return _sink
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _emit(sink, event_type, **fields):
+    event = {'event': event_type, 'depth': len(_stack()), 'time': datetime.datetime.now().isoformat()}
+    event.update(fields)
+    sink.emit(event)
+
+
+def peak_rss_kb():
+    """Returns the peak rss of the process, or None where it isn't available"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times the enclosed code as a (possibly nested) stage. Yields the stage (its counts are in stage.counts)."""
+    # the sink the stage started with gets its end too, even if set_sink() is called inside it
+    sink = _sink
+    if sink is None:
+        yield _Stage(name, name)
+        return
+    stack = _stack()
+    current = _Stage(name, '/'.join([s.name for s in stack] + [name]))
+    _emit(sink, 'stage_start', stage=current.path)
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        stack.pop()
+        seconds = time.perf_counter() - current.start
+        fields = {'stage': current.path, 'seconds': round(seconds, 4), 'counts': current.counts,
+                  'peak_rss_kb': peak_rss_kb()}
+        if 'rows' in current.counts and seconds > 0:
+            fields['rows_per_second'] = int(current.counts['rows'] / seconds)
+        if getattr(sink, 'track_objects', False):
+            fields['objects'] = len(gc.get_objects())
+        _emit(sink, 'stage_end', **fields)
+
+
+def count(name, value=1):
+    """Adds value to the named counter of the current stage"""
+    if _sink is None:
+        return
+    stack = _stack()
+    if len(stack) > 0:
+        counts = stack[-1].counts
+        counts[name] = counts.get(name, 0) + value
+
+
+def message(text):
+    """Reports a free text message (e.g. about bad records in the data)"""
+    sink = _sink
+    if sink is None:
+        return
+    _emit(sink, 'message', text=text, stage='/'.join(s.name for s in _stack()))
+
+
+def progress(iterable, freq, name='rows'):
+    """Yields the items of iterable, counting them as name in the current stage, and reporting progress every
+    freq items"""
+    sink = _sink
+    if sink is None:
+        yield from iterable
+        return
+    i = 0
+    stack = _stack()
+    current = stack[-1] if len(stack) > 0 else None
+    for i, item in enumerate(iterable, 1):
+        yield item
+        if i % freq == 0:
+            _emit(sink, 'progress', stage=current.path if current else '', rows=i)
+    if current is not None:
+        current.counts[name] = current.counts.get(name, 0) + i
@@ -0,0 +1,414 @@
+"""
+ export the stops, the train stations and the route story lines of an extended gtfs, with their metrics, to GeoJSON
+ files and to pre-tiled GeoJSON tiles for web maps, instead of exporting csv files with lat/lon and uploading them to a
+ map by hand.
+
+ stops.geojson, stations.geojson and route_stories.geojson (in the gtfs folder) are written a feature at a time, one
+ feature per line. A route story line follows the shape of its trips (from the frequency blocks) if the feed has
+ shapes, otherwise its stops. Stop features have the stop's fields from full_stops and the columns of the metrics
+ files (csv files with a stop_id column, like 30_min_to_station.txt or the catchment exports of
+ station_travel_times.py; the first row of each stop); route story features have the route and the number of weekly
+ trips.
+
+ The tiles are tiles/<zoom>/<x>/<y>.geojson, in the usual web map (slippy map) tile grid: at zoom z the world (in web
+ mercator) is a 2^z by 2^z grid of 256 pixel tiles, and every tile is a FeatureCollection with the features in it (the
+ layer property tells stops, stations and route stories apart). At each zoom the lines are simplified to a pixel
+ (a radial distance filter, then Douglas-Peucker, starting from the simplified line of the next zoom), cut into the
+ runs of segments that pass through each tile, and their coordinates rounded to what a pixel can show; stops are only
+ in the tiles of stops_min_zoom and above. Tile features are buffered up to max_buffered_bytes and then appended to
+ their files, and the shapes are read from shapes.txt a shape at a time (the route stories of a shape are exported
+ together, and its simplified lines dropped after them), so memory doesn't grow with the size of the export. The tiles
+ folder is removed and written again on every export.
+
+   python map_export.py data/gtfs/gtfs_2016_06_09 [--metrics data/gtfs/gtfs_2016_06_09/30_min_to_station.txt]
+"""
+
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import shutil
+import zipfile
+from collections import defaultdict
+from itertools import groupby
+
+from ilgtfs import ExtendedGTFS, Shape, read_fields
+from instrumentation import stage, count, progress
+
+stops_filename = 'stops.geojson'
+stations_filename = 'stations.geojson'
+route_stories_filename = 'route_stories.geojson'
+tiles_folder = 'tiles'
+
+default_zooms = range(8, 14)
+stops_min_zoom = 12
+tile_pixels = 256
+max_buffered_bytes = 32 << 20
+
+feature_collection_start = '{"type":"FeatureCollection","features":[\n'
+feature_collection_end = '\n]}\n'
+
+
+def world_xy(lat, lon):
+    """Returns the web mercator coordinates of a point, from 0 to 1 (x from west to east, y from north to south)"""
+    return world_points([(lat, lon)])[0]
+
+
+def world_points(lat_lons):
+    """Returns the web mercator coordinates of a list of (lat, lon), away from the poles"""
+    log, tan, radians, pi = math.log, math.tan, math.radians, math.pi
+    return [((lon + 180) / 360, (1 - log(tan(pi / 4 + radians(lat) / 2)) / pi) / 2)
+            for lat, lon in lat_lons]
+
+
+def world_lon_lats(points):
+    """Returns the (lon, lat) of a list of web mercator coordinates"""
+    degrees, atan, sinh, pi = math.degrees, math.atan, math.sinh, math.pi
+    return [(x * 360 - 180, degrees(atan(sinh(pi * (1 - 2 * y))))) for x, y in points]
+
+
+def simplify(points, tolerance):
+    """Returns the points of a line (a list of (x, y)) that are kept when it's simplified to tolerance: a radial
+    distance filter, then Douglas-Peucker. The first and last points are always kept."""
+    if len(points) <= 2:
+        return points
+    # points closer than tolerance to the last kept point add nothing, and it's much cheaper to drop them first
+    squared_tolerance = tolerance * tolerance
+    kept = [points[0]]
+    for x, y in points[1:-1]:
+        last_x, last_y = kept[-1]
+        if (x - last_x) ** 2 + (y - last_y) ** 2 > squared_tolerance:
+            kept.append((x, y))
+    kept.append(points[-1])
+    if len(kept) <= 2:
+        return kept
+    keep = [False] * len(kept)
+    keep[0] = keep[-1] = True
+    pending = [(0, len(kept) - 1)]
+    while len(pending) > 0:
+        first, last = pending.pop()
+        if last - first < 2:
+            continue
+        (x1, y1), (x2, y2) = kept[first], kept[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        if length > 0:
+            # the distance from the line through the first and last points, times the length of the segment
+            distances = [abs((x - x1) * dy - (y - y1) * dx) for x, y in kept[first + 1:last]]
+            limit = squared_tolerance * length
+        else:
+            # a closed line
+            distances = [(x - x1) ** 2 + (y - y1) ** 2 for x, y in kept[first + 1:last]]
+            limit = squared_tolerance
+        farthest_distance = max(distances)
+        if (farthest_distance * farthest_distance if length > 0 else farthest_distance) > limit:
+            farthest = first + 1 + distances.index(farthest_distance)
+            keep[farthest] = True
+            pending += [(first, farthest), (farthest, last)]
+    return [point for point, kept_point in zip(kept, keep) if kept_point]
+
+
+def segment_tiles(p1, p2, tiles_per_side):
+    """Returns the tiles (x, y) a segment between two world points passes through: the tiles of points along it, half
+    a tile or less apart"""
+    steps = max(1, int(max(abs(p2[0] - p1[0]), abs(p2[1] - p1[1])) * tiles_per_side * 2) + 1)
+    res = set()
+    for i in range(steps + 1):
+        x = p1[0] + (p2[0] - p1[0]) * i / steps
+        y = p1[1] + (p2[1] - p1[1]) * i / steps
+        res.add((min(int(x * tiles_per_side), tiles_per_side - 1), min(int(y * tiles_per_side), tiles_per_side - 1)))
+    return res
+
+
+def coordinate_digits(zoom):
+    """The number of decimal digits of the coordinates that a pixel at zoom can show"""
+    return min(6, max(0, math.ceil(math.log10((1 << zoom) * tile_pixels / 360))) + 1)
+
+
+# the features are formatted by hand: a feature is written to several tiles, and json.dumps is most of the time of the
+# export. Coordinates are written with a fixed number of decimal digits (6 is about 10cm).
+def properties_text(properties):
+    return json.dumps(properties, ensure_ascii=False, separators=(',', ':'))
+
+
+def feature_text(geometry, properties):
+    """Returns a feature with a geometry (from point_text or line_text) and properties (from properties_text)"""
+    return '{"type":"Feature","geometry":%s,"properties":%s}' % (geometry, properties)
+
+
+def point_text(lon, lat, digits=6):
+    return '{"type":"Point","coordinates":[%.*f,%.*f]}' % (digits, lon, digits, lat)
+
+
+def coordinates_text(lon_lats, digits):
+    coordinate_format = '[%.{0}f,%.{0}f]'.format(digits)
+    return '[%s]' % ','.join([coordinate_format % lon_lat for lon_lat in lon_lats])
+
+
+def line_text(lines, digits=6):
+    """Returns a LineString, or a MultiLineString if there's more than one line (a list of (lon, lat))"""
+    if len(lines) == 1:
+        return '{"type":"LineString","coordinates":%s}' % coordinates_text(lines[0], digits)
+    return '{"type":"MultiLineString","coordinates":[%s]}' % ','.join(coordinates_text(line, digits)
+                                                                       for line in lines)
+
+
+class FeatureCollectionWriter:
+    """Writes a GeoJSON FeatureCollection to a file a feature at a time"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.features = 0
+        self.f = open(filename, 'w', encoding='utf8')
+        self.f.write(feature_collection_start)
+
+    def write(self, feature):
+        if self.features > 0:
+            self.f.write(',\n')
+        self.f.write(feature)
+        self.features += 1
+
+    def close(self):
+        self.f.write(feature_collection_end)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TileWriter:
+    """Writes features to tiles/<zoom>/<x>/<y>.geojson files, buffering up to max_buffered_bytes of features in
+    memory"""
+
+    def __init__(self, folder, max_bytes=max_buffered_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.buffered = defaultdict(list)
+        self.buffered_bytes = 0
+        self.started = set()
+        self.features = 0
+
+    def path(self, tile):
+        zoom, x, y = tile
+        return os.path.join(self.folder, str(zoom), str(x), '%d.geojson' % y)
+
+    def write(self, tile, feature):
+        self.buffered[tile].append(feature)
+        self.buffered_bytes += len(feature)
+        self.features += 1
+        if self.buffered_bytes > self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        for tile, features in self.buffered.items():
+            path = self.path(tile)
+            if tile not in self.started:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='utf8') as f:
+                    f.write(feature_collection_start + ',\n'.join(features))
+                self.started.add(tile)
+            else:
+                with open(path, 'a', encoding='utf8') as f:
+                    f.write(',\n' + ',\n'.join(features))
+        count('tile_flushes')
+        self.buffered = defaultdict(list)
+        self.buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        for tile in self.started:
+            with open(self.path(tile), 'a', encoding='utf8') as f:
+                f.write(feature_collection_end)
+        count('tiles', len(self.started))
+        count('tile_features', self.features)
+
+
+def parse_value(value):
+    if value == '':
+        return None
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_metrics(filename):
+    """Returns a map from stop_id to a dictionary of the other columns of a csv file with a stop_id column (of the
+    first row of the stop)"""
+    res = {}
+    with open(filename, encoding='utf8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            stop_id = int(row.pop('stop_id'))
+            if stop_id not in res:
+                res[stop_id] = {name: parse_value(value) for name, value in row.items()}
+    return res
+
+
+def stop_properties(stop, layer):
+    return {'layer': layer, 'stop_id': stop.stop_id, 'stop_code': stop.stop_code, 'stop_name': stop.stop_name,
+            'line_numbers': ' '.join(line_number for line_number in stop.routes_stopping_here if line_number != ''),
+            'nearest_train_station_id': stop.nearest_train_station_id,
+            'train_station_distance': stop.train_station_distance}
+
+
+def route_story_lines(g, use_shapes):
+    """Yields (route story, shape_id or None, properties) for the route stories with trips; the shape_id is the shape
+    of the route story's first trip with one, if use_shapes"""
+    route_story_route = {route_story_id: route for route in g.routes.values()
+                         for route_story_id in route.route_story_ids}
+    weekly_trips = defaultdict(int)
+    shape_ids = {}
+    for block in g.trip_blocks():
+        route_story_id = block.route_story.route_story_id
+        weekly_trips[route_story_id] += len(block) * len(block.service.days)
+        if block.shape_id != -1:
+            shape_ids.setdefault(route_story_id, block.shape_id)
+    for route_story_id in sorted(weekly_trips):
+        route = route_story_route[route_story_id]
+        shape_id = shape_ids.get(route_story_id) if use_shapes else None
+        yield g.route_stories[route_story_id], shape_id, {
+            'layer': 'route_stories', 'route_story_id': route_story_id, 'route_id': route.route_id,
+            'line_number': route.line_number, 'agency': route.agency.agency_name, 'route_type': route.route_type,
+            'stops': len(g.route_stories[route_story_id].stops), 'weekly_trips': weekly_trips[route_story_id]}
+
+
+def iter_shapes(g, shape_ids):
+    """Yields the Shape objects of shape_ids, in the shapes.txt order. The shapes are read a shape at a time (the points
+    of a shape are together in shapes.txt), unless they're loaded already."""
+    if g.is_loaded('shapes'):
+        yield from (g.shapes[shape_id] for shape_id in sorted(shape_ids) if shape_id in g.shapes)
+        return
+    if len(shape_ids) == 0:
+        return
+    read = set()
+    with zipfile.ZipFile(g.filename) as z, z.open('shapes.txt') as f:
+        rows = read_fields(io.TextIOWrapper(f, 'utf8'), Shape.csv_fields)
+        for shape_id, shape_rows in groupby(rows, key=lambda row: int(row[0])):
+            if shape_id in read:
+                raise ValueError("The points of shape %d aren't together in shapes.txt" % shape_id)
+            read.add(shape_id)
+            if shape_id not in shape_ids:
+                continue
+            shapes = {}
+            for row in shape_rows:
+                Shape.from_row(row, shapes)
+            yield shapes[shape_id]
+
+
+def export_map(g: ExtendedGTFS, metrics_filenames=(), zooms=default_zooms, use_shapes=True):
+    """Exports the stops, train stations and route story lines to GeoJSON files and tiles in the gtfs folder"""
+    zooms = sorted(zooms, reverse=True)
+    with zipfile.ZipFile(g.filename) as z:
+        use_shapes = use_shapes and 'shapes.txt' in z.namelist()
+    with stage('export_map'):
+        metrics = {}
+        for filename in metrics_filenames:
+            for stop_id, values in read_metrics(filename).items():
+                metrics.setdefault(stop_id, {}).update(values)
+
+        # tiles of an earlier export may be left out of this one
+        shutil.rmtree(g.at_path(tiles_folder), ignore_errors=True)
+        tiles = TileWriter(g.at_path(tiles_folder))
+
+        def write_point(writer, stop, layer, min_zoom):
+            properties = stop_properties(stop, layer)
+            properties.update(metrics.get(stop.stop_id, {}))
+            properties = properties_text(properties)
+            lat, lon = float(stop.stop_lat), float(stop.stop_lon)
+            writer.write(feature_text(point_text(lon, lat), properties))
+            x, y = world_xy(lat, lon)
+            for zoom in zooms:
+                if zoom >= min_zoom:
+                    tiles.write((zoom, int(x * (1 << zoom)), int(y * (1 << zoom))),
+                                feature_text(point_text(lon, lat, coordinate_digits(zoom)), properties))
+
+        with stage('stops'), FeatureCollectionWriter(g.at_path(stops_filename)) as stops_writer, \
+                FeatureCollectionWriter(g.at_path(stations_filename)) as stations_writer:
+            for stop in progress(g.stops.values(), 10000):
+                if stop.is_train_station:
+                    write_point(stations_writer, stop, 'stations', min(zooms))
+                else:
+                    write_point(stops_writer, stop, 'stops', stops_min_zoom)
+            count('stops', stops_writer.features)
+            count('stations', stations_writer.features)
+
+        def write_lines(writer, lat_lons, properties_list):
+            """Writes the route stories that follow the line lat_lons; it's simplified once for all of them (route
+            stories of different routes may share a shape)"""
+            coordinates = line_text([[(lon, lat) for lat, lon in lat_lons]])
+            by_zoom = {}
+            points = world_points(lat_lons)
+            for zoom in zooms:
+                # each zoom starts from the (more detailed) line of the zoom above it
+                points = by_zoom[zoom] = simplify(points, 1 / ((1 << zoom) * tile_pixels))
+            for properties in properties_list:
+                properties = properties_text(properties)
+                writer.write(feature_text(coordinates, properties))
+                for zoom in zooms:
+                    write_line_tiles(tiles, zoom, by_zoom[zoom], properties)
+
+        with stage('route stories'), FeatureCollectionWriter(g.at_path(route_stories_filename)) as writer:
+            # the route stories by shape_id, so the ones of each shape are written when the shape is read
+            shape_lines = defaultdict(list)
+            for route_story, shape_id, properties in route_story_lines(g, use_shapes):
+                shape_lines[shape_id].append((route_story, properties))
+            for shape in progress(iter_shapes(g, set(shape_lines) - {None}), 1000, 'shapes'):
+                lat_lons = [shape.coordinates[sequence] for sequence in sorted(shape.coordinates)]
+                write_lines(writer, lat_lons, [properties for _, properties in shape_lines.pop(shape.shape_id)])
+            # the route stories without a shape (or whose shape isn't in shapes.txt) follow their stops
+            for route_story, properties in progress([line for lines in shape_lines.values() for line in lines], 1000,
+                                                    'lines_without_shapes'):
+                lat_lons = [(float(g.stops[stop.stop_id].stop_lat), float(g.stops[stop.stop_id].stop_lon))
+                            for stop in route_story.stops]
+                write_lines(writer, lat_lons, [properties])
+            count('route_stories', writer.features)
+
+        with stage('flush tiles'):
+            tiles.close()
+        with open(g.at_path(os.path.join(tiles_folder, 'index.json')), 'w', encoding='utf8') as f:
+            json.dump({'zooms': sorted(zooms), 'stops_min_zoom': stops_min_zoom,
+                       'layers': ['stops', 'stations', 'route_stories']}, f)
+
+
+def write_line_tiles(tiles, zoom, points, properties):
+    """Writes the parts of a line (world points) in each tile it passes through: the runs of consecutive segments that
+    pass through the tile. properties is from properties_text."""
+    tiles_per_side = 1 << zoom
+    # tile -> list of runs of point indices
+    runs = {}
+    for i in range(len(points) - 1):
+        for tile in segment_tiles(points[i], points[i + 1], tiles_per_side):
+            tile_runs = runs.setdefault(tile, [])
+            if len(tile_runs) > 0 and tile_runs[-1][-1] == i:
+                tile_runs[-1].append(i + 1)
+            else:
+                tile_runs.append([i, i + 1])
+    lon_lats = world_lon_lats(points)
+    digits = coordinate_digits(zoom)
+    for (x, y), tile_runs in runs.items():
+        lines = [[lon_lats[i] for i in run] for run in tile_runs]
+        tiles.write((zoom, x, y), feature_text(line_text(lines, digits), properties))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the stops, train stations and route stories to GeoJSON files '
+                                                 'and map tiles')
+    parser.add_argument('folder', help='the extended gtfs folder')
+    parser.add_argument('--metrics', nargs='*', default=[], help='csv files with a stop_id column, to add to the stops')
+    parser.add_argument('--min-zoom', type=int, default=min(default_zooms))
+    parser.add_argument('--max-zoom', type=int, default=max(default_zooms))
+    parser.add_argument('--no-shapes', action='store_true', help='draw the route stories along their stops')
+    args = parser.parse_args()
+    export_map(ExtendedGTFS(args.folder), args.metrics, range(args.min_zoom, args.max_zoom + 1), not args.no_shapes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+ match observed vehicle arrivals (a SIRI-like feed, replayed from local files) to the planned trips, and compute the
+ delays at every stop and the missed train to bus connections at the train stations.
+
+ An observed arrival is a vehicle of a route, on the trip planned to start at trip_start_time on date, that arrived at
+ stop_id at arrival_time:
+
+   date,route_id,trip_start_time,stop_id,arrival_time
+   2016-06-09,16385,07:10:00,38725,07:31:12
+
+ or the same fields as json objects, one per line (.json / .jsonl files). Times are hh:mm:ss from the start of the
+ service date, like in the gtfs. These are the fields of the SIRI vehicle monitoring records that matter here (LineRef,
+ OriginAimedDepartureTime, StopPointRef and the actual arrival time), without the xml.
+
+ The records are matched as they stream in. The planned trips of a date are indexed by (route_id, start time) when its
+ first record arrives (from the frequency blocks if they're loaded), and the stops of every route story by stop_id;
+ only the last dates_kept dates are kept. If several trips of the route start at the same time (which the record
+ can't tell apart), the record is matched to the call at its stop with the nearest planned time. The delay of a record
+ (its arrival time minus the planned arrival at the stop) goes to a per stop histogram, so memory doesn't grow with
+ the number of records.
+
+ A planned connection is a train arrival at a station and a bus arriving at a stop near the station (up to
+ max_transfer_distance meters from it) min_transfer to max_transfer seconds later. The connection is missed if the
+ bus actually arrived less than min_transfer seconds after the train. The train and bus arrivals at each station are
+ kept for connection_horizon seconds after the latest arrival at the station, and every arrival is joined with the
+ kept arrivals of the other kind; connections with a vehicle that was never observed aren't counted.
+
+   python observed_arrivals.py data/gtfs/gtfs_2016_06_09 data/siri/2016-06-09.csv [--speed 60]
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import time
+from collections import namedtuple, defaultdict, deque, OrderedDict, Counter
+
+from ilgtfs import ExtendedGTFS, read_fields, parse_timestamp
+from instrumentation import stage, count, progress
+
+ObservedArrival = namedtuple('ObservedArrival', ['date', 'route_id', 'trip_start_time', 'stop_id', 'arrival_time'])
+
+observed_fields = ObservedArrival._fields
+
+min_transfer = 2 * 60
+max_transfer = 15 * 60
+max_transfer_distance = 300
+# arrivals later than this after a planned connection aren't expected to happen
+connection_horizon = max_transfer + 30 * 60
+dates_kept = 2
+
+# delay histogram: bins of delay_bin seconds, from min_delay to max_delay (delays outside are in the edge bins)
+delay_bin = 30
+min_delay = -10 * 60
+max_delay = 60 * 60
+
+
+# a feed has only a few dates, and strptime is the slowest part of parsing a record
+_parsed_dates = {}
+
+
+def parse_arrival(row):
+    date, route_id, trip_start_time, stop_id, arrival_time = row
+    parsed_date = _parsed_dates.get(date)
+    if parsed_date is None:
+        parsed_date = _parsed_dates[date] = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    return ObservedArrival(parsed_date, int(route_id), parse_timestamp(trip_start_time), int(stop_id),
+                           parse_timestamp(arrival_time))
+
+
+def read_arrivals(filename):
+    """Yields the ObservedArrival records of a csv or a json lines file"""
+    with open(filename, encoding='utf8') as f:
+        if os.path.splitext(filename)[1] in ('.json', '.jsonl'):
+            for line in f:
+                if line.strip() != '':
+                    record = json.loads(line)
+                    yield parse_arrival([str(record[field]) for field in observed_fields])
+        else:
+            for row in read_fields(f, observed_fields):
+                yield parse_arrival(row)
+
+
+def replay(arrivals, speed):
+    """Yields the arrivals at speed times the real pace (by their arrival times), like a live feed would"""
+    first_arrival, start = None, time.monotonic()
+    for arrival in arrivals:
+        if first_arrival is None:
+            first_arrival = arrival.arrival_time
+        wait = (arrival.arrival_time - first_arrival) / speed - (time.monotonic() - start)
+        if wait > 0:
+            time.sleep(wait)
+        yield arrival
+
+
+class DelayHistogram:
+    __slots__ = ['arrivals', 'total', 'max', 'bins']
+
+    def __init__(self):
+        self.arrivals = 0
+        self.total = 0
+        self.max = None
+        self.bins = [0] * ((max_delay - min_delay) // delay_bin + 1)
+
+    def add(self, delay):
+        self.arrivals += 1
+        self.total += delay
+        if self.max is None or delay > self.max:
+            self.max = delay
+        self.bins[(min(max(delay, min_delay), max_delay) - min_delay) // delay_bin] += 1
+
+    def mean(self):
+        return self.total / self.arrivals
+
+    def percentile(self, p):
+        """Returns the delay (rounded up to a bin) that p percent of the arrivals didn't exceed"""
+        needed = self.arrivals * p / 100
+        seen = 0
+        for i, arrivals in enumerate(self.bins):
+            seen += arrivals
+            if seen >= needed:
+                return min_delay + (i + 1) * delay_bin
+        return max_delay
+
+
+# a matched arrival: the planned and the actual arrival time
+MatchedArrival = namedtuple('MatchedArrival', ['planned', 'observed'])
+
+
+class ArrivalMatcher:
+    def __init__(self, g):
+        """g is an ExtendedGTFS with stops and trips (or frequency blocks) loaded"""
+        self.g = g
+        # date -> (route_id, start_time) -> list of (route story, route_type), for the last dates
+        self.planned_days = OrderedDict()
+        self.story_stops = {}  # route_story_id -> stop_id -> route story stops
+        self.stop_delays = defaultdict(DelayHistogram)
+        # the station of the stops that are near one, and the stations
+        self.stop_station = {stop.stop_id: stop.nearest_train_station_id for stop in g.stops.values()
+                             if stop.train_station_distance <= max_transfer_distance}
+        # (date, station) -> arrivals of trains and of buses in the last connection_horizon seconds, and the latest
+        # arrival time
+        self.recent = {}
+        self.connections = Counter()
+        self.missed = Counter()
+        self.dates = set()
+        self.unmatched = Counter()
+
+    def planned_trips(self, date):
+        trips = self.planned_days.get(date)
+        if trips is None:
+            with stage('index planned trips %s' % date):
+                trips = self.planned_days[date] = {}
+                for block in self.g.trip_blocks():
+                    service = block.service
+                    if service.start_date <= date <= service.end_date and date.weekday() in service.days:
+                        for start_time in block.start_times:
+                            trips.setdefault((block.route.route_id, start_time), []).append(
+                                (block.route_story, block.route.route_type))
+                count('planned_trips', len(trips))
+            self.dates.add(date)
+            while len(self.planned_days) > dates_kept:
+                old_date, _ = self.planned_days.popitem(last=False)
+                for key in [key for key in self.recent if key[0] == old_date]:
+                    del self.recent[key]
+        return trips
+
+    def stops_of(self, route_story):
+        stops = self.story_stops.get(route_story.route_story_id)
+        if stops is None:
+            stops = self.story_stops[route_story.route_story_id] = {}
+            for stop in route_story.stops:
+                stops.setdefault(stop.stop_id, []).append(stop)
+        return stops
+
+    def calls(self, arrival):
+        """Returns the planned calls the arrival may be, as a list of (route story, route story stop, planned arrival
+        time, route type): the calls at its stop of the trips of its route that start at its trip start time"""
+        planned_trips = self.planned_trips(arrival.date).get((arrival.route_id, arrival.trip_start_time))
+        if planned_trips is None:
+            self.unmatched['trip'] += 1
+            return []
+        res = [(route_story, stop, arrival.trip_start_time + stop.arrival_offset, route_type)
+               for route_story, route_type in planned_trips
+               for stop in self.stops_of(route_story).get(arrival.stop_id, ())]
+        if len(res) == 0:
+            self.unmatched['stop'] += 1
+        return res
+
+    def match(self, arrival):
+        """Returns the planned call of the arrival (see calls) nearest in time, or None if there's no such call.
+        Circular routes can stop at the same stop twice."""
+        res = None
+        for call in self.calls(arrival):
+            if res is None or abs(call[2] - arrival.arrival_time) < abs(res[2] - arrival.arrival_time):
+                res = call
+        return res
+
+    def add(self, arrival):
+        matched = self.match(arrival)
+        if matched is None:
+            return
+        _, _, planned, route_type = matched
+        self.stop_delays[arrival.stop_id].add(arrival.arrival_time - planned)
+        station = self.stop_station.get(arrival.stop_id)
+        if station is not None and route_type in (2, 3):
+            self.join(arrival.date, station, route_type == 2, MatchedArrival(planned, arrival.arrival_time))
+
+    def join(self, date, station, is_train, matched):
+        recent = self.recent.get((date, station))
+        if recent is None:
+            recent = self.recent[(date, station)] = [deque(), deque(), matched.observed]
+        trains, buses, latest = recent
+        for other in (buses if is_train else trains):
+            train, bus = (matched, other) if is_train else (other, matched)
+            if min_transfer <= bus.planned - train.planned <= max_transfer:
+                self.connections[station] += 1
+                if bus.observed - train.observed < min_transfer:
+                    self.missed[station] += 1
+        (trains if is_train else buses).append(matched)
+        if matched.observed > latest:
+            recent[2] = latest = matched.observed
+        # the arrivals are (roughly) in time order, so the oldest are first
+        for arrivals in (trains, buses):
+            while len(arrivals) > 0 and arrivals[0].observed < latest - connection_horizon:
+                arrivals.popleft()
+
+    def run(self, arrivals):
+        with stage('match observed arrivals'):
+            for arrival in progress(arrivals, 1000000):
+                self.add(arrival)
+            count('unmatched_trips', self.unmatched['trip'])
+            count('unmatched_stops', self.unmatched['stop'])
+            count('stops', len(self.stop_delays))
+            count('connections', sum(self.connections.values()))
+            count('missed_connections', sum(self.missed.values()))
+
+    def dates_suffix(self):
+        if len(self.dates) == 0:
+            raise ValueError('No arrivals were read, so the reports have no dates')
+        return '%s_%s' % (min(self.dates).strftime('%Y-%m-%d'), max(self.dates).strftime('%Y-%m-%d'))
+
+    def export_stop_delays(self, output_filename=None):
+        output_filename = output_filename or self.g.at_path('stop_delays_%s.txt' % self.dates_suffix())
+        with open(output_filename, 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['stop_id', 'stop_name', 'arrivals', 'mean_delay', 'median_delay', 'p90_delay',
+                             'max_delay'])
+            for stop_id, delays in sorted(self.stop_delays.items()):
+                writer.writerow([stop_id, self.g.stops[stop_id].stop_name, delays.arrivals, round(delays.mean()),
+                                 delays.percentile(50), delays.percentile(90), delays.max])
+        return output_filename
+
+    def export_missed_connections(self, output_filename=None):
+        output_filename = output_filename or self.g.at_path('missed_connections_%s.txt' % self.dates_suffix())
+        with open(output_filename, 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['station_id', 'station_name', 'connections', 'missed', 'missed_share'])
+            for station_id, connections in sorted(self.connections.items()):
+                writer.writerow([station_id, self.g.stops[station_id].stop_name, connections,
+                                 self.missed[station_id], round(self.missed[station_id] / connections, 3)])
+        return output_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match observed arrivals to the planned trips')
+    parser.add_argument('folder', help='the extended gtfs folder')
+    parser.add_argument('arrivals', nargs='+', help='csv or json lines files of observed arrivals, in time order')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay the arrivals at this multiple of real time (default: as fast as possible)')
+    args = parser.parse_args()
+    g = ExtendedGTFS(args.folder)
+    g.load_stops()
+    g.load_frequency_blocks()
+    arrivals = (arrival for filename in args.arrivals for arrival in read_arrivals(filename))
+    if args.speed is not None:
+        arrivals = replay(arrivals, args.speed)
+    matcher = ArrivalMatcher(g)
+    matcher.run(arrivals)
+    if len(matcher.dates) == 0:
+        print("No arrivals in %s, nothing to save" % ', '.join(args.arrivals))
+        return
+    print("Saved %s and %s" % (matcher.export_stop_delays(), matcher.export_missed_connections()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+"""
+ a local http/json service that answers questions about an extended gtfs snapshot without reloading it.
+
+ The snapshot is loaded once (extending it first if needed) and indexed by stop and by train station, and the results
+ are kept in an LRU cache. Requests are handled concurrently, a thread per request. POST /reload loads another snapshot
+ (by default the latest one in the archive folder) and swaps it in when it's ready: until then requests are answered
+ from the old snapshot, and every request is answered from a single snapshot.
+
+   GET  /status
+   GET  /stations/<station_id>/visits?start=2016-06-01[&end=2016-06-14][&kind=bus|train][&max_distance=500]
+   GET  /stops/<stop_id>/visits?start=2016-06-01[&end=2016-06-14][&day=6]
+   GET  /stations/<station_id>/transfers?start=2016-06-01[&end=2016-06-14][&day=6][&max_distance=300][&route=480]
+   POST /reload[?folder=data/gtfs/gtfs_2016_05_26]
+
+ Dates are yyyy-mm-dd; end defaults to the statistics period of archive_runner. Days are python weekdays like
+ Service.days (6 is sunday), and times are seconds from the start of the day.
+
+   python query_service.py data/gtfs/gtfs_2016_05_25
+   python query_service.py --archive data/gtfs            serves the latest snapshot, /reload takes the next one
+
+ LocalClient passes requests straight to the service, without a socket, for tests and notebooks.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import threading
+import traceback
+from collections import defaultdict, namedtuple, Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+import archive_runner
+import station_service_statistics
+import train_to_bus
+from instrumentation import stage, count, message
+
+default_host = '127.0.0.1'
+default_port = 8010
+default_cache_size = 1024
+
+# the distances used by station_service_statistics and by train_to_bus
+default_station_distance = 500
+default_transfer_distance = 300
+
+
+class QueryError(Exception):
+    def __init__(self, status, text):
+        super().__init__(text)
+        self.status = status
+
+
+class LRUCache:
+    """A thread safe map from key to value that keeps the max_size most recently used keys"""
+
+    def __init__(self, max_size=default_cache_size):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.values.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+
+class FeedIndex:
+    """A loaded snapshot, with its route stories and trips indexed by stop and by train station. It isn't changed
+    after it's built (except for memoized route story data), so requests can share it without locks."""
+
+    def __init__(self, folder):
+        with stage('index %s' % folder):
+            g = archive_runner.extend_snapshot(folder)
+            g.load_stops()
+            g.load_frequency_blocks()
+            self.g = g
+            self.folder = folder
+            self.loaded_at = datetime.datetime.now()
+
+            # route_story_id -> the frequency blocks of the route story
+            self.story_blocks = defaultdict(lambda: [])
+            for block in g.trip_blocks():
+                self.story_blocks[block.route_story.route_story_id].append(block)
+
+            # stop_id -> (route story, route story stop) of every stop of a route story at the stop
+            self.stop_stories = defaultdict(lambda: [])
+            for route_story_id in self.story_blocks:
+                route_story = g.route_stories[route_story_id]
+                for route_story_stop in route_story.stops:
+                    self.stop_stories[route_story_stop.stop_id].append((route_story, route_story_stop))
+
+            # station_id -> the stops that this is their nearest train station, nearest first
+            self.station_stops = defaultdict(lambda: [])
+            for stop in sorted(g.stops.values(), key=lambda s: s.train_station_distance):
+                self.station_stops[stop.nearest_train_station_id].append(stop.stop_id)
+            self.stations = {stop.stop_id for stop in g.train_stations}
+
+            # (route_story_id, max_distance) -> station_service_statistics.route_story_station_stops
+            self._story_station_stops = {}
+            count('route_stories', len(self.story_blocks))
+            count('stations', len(self.stations))
+
+    def station_name(self, station_id):
+        if station_id not in self.stations:
+            raise QueryError(404, 'Unknown train station %d' % station_id)
+        return self.g.stops[station_id].stop_name
+
+    def route_story_station_stops(self, route_story, max_distance):
+        key = (route_story.route_story_id, max_distance)
+        station_stops = self._story_station_stops.get(key)
+        if station_stops is None:
+            station_stops = self._story_station_stops[key] = station_service_statistics.route_story_station_stops(
+                self.g, route_story, max_distance)
+        return station_stops
+
+    def station_visits(self, station_id, start_date, end_date, kind='bus', max_distance=default_station_distance):
+        """Returns a counter of visits at the station by (day, hour), like station_service_statistics.bus_station_visits
+        or train_station_visits return for the station"""
+        g = self.g
+        route_type = {'bus': 3, 'train': 2}[kind]
+        # the route story stops that count as visits at the station
+        # (route_story_id, stop_sequence) -> (route story, route story stop)
+        station_stops = {}
+        for stop_id in self.station_stops[station_id]:
+            if kind == 'bus' and g.stops[stop_id].train_station_distance > max_distance:
+                break
+            for route_story, _ in self.stop_stories[stop_id]:
+                if kind == 'bus':
+                    stops = [stop for station, stop in self.route_story_station_stops(route_story, max_distance)
+                             if station == station_id]
+                else:
+                    stops = [stop for stop in route_story.stops if stop.stop_id == stop_id]
+                for stop in stops:
+                    station_stops[(route_story.route_story_id, stop.stop_sequence)] = (route_story, stop)
+        counter = Counter()
+        for route_story, route_story_stop in station_stops.values():
+            for block in self.story_blocks[route_story.route_story_id]:
+                if block.route.route_type != route_type or block.service.end_date < start_date or \
+                        block.service.start_date > end_date:
+                    continue
+                for hour, hour_trips in block.hourly_counts(route_story_stop.arrival_offset).items():
+                    for day in block.service.days:
+                        counter[(day, hour)] += hour_trips
+        return counter
+
+    def visits_at_stops(self, stop_ids, start_date, end_date, day=None):
+        """Returns a list of train_to_bus.VisitsAtStop of all the trips at the stops between the dates (on day, if
+        it isn't None), like train_to_bus.visits_at_stop"""
+        res = []
+        for stop_id in stop_ids:
+            for route_story, route_story_stop in self.stop_stories[stop_id]:
+                for block in self.story_blocks[route_story.route_story_id]:
+                    if block.service.end_date < start_date or block.service.start_date > end_date:
+                        continue
+                    days = block.service.days if day is None else block.service.days.intersection([day])
+                    for visit_day in days:
+                        for start_time in block.start_times:
+                            res.append(train_to_bus.VisitsAtStop(visit_day,
+                                                                 start_time + route_story_stop.arrival_offset,
+                                                                 start_time + route_story_stop.departure_offset,
+                                                                 block.route, stop_id))
+        res.sort(key=lambda v: (v.day, v.arrival, v.route.route_id))
+        return res
+
+    def transfers(self, station_id, start_date, end_date, day=train_to_bus.default_day,
+                  max_distance=default_transfer_distance):
+        """Returns a list of train_to_bus.TrainVisit for the train arrivals at the station on day, and the bus routes
+        stopping up to max_distance from the station"""
+        stop_ids = [stop_id for stop_id in self.station_stops[station_id]
+                    if self.g.stops[stop_id].train_station_distance < max_distance]
+        visits = self.visits_at_stops(stop_ids, start_date, end_date, day)
+        return train_to_bus.train_arrival_to_bus_visit(self.g, visits, day)
+
+
+Feed = namedtuple('Feed', ['index', 'cache'])
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+class QueryService:
+    # method, path, handler and whether the responses are cached
+    routes = [('GET', re.compile(r'/status$'), 'status', False),
+              ('GET', re.compile(r'/stations/(\d+)/visits$'), 'station_visits', True),
+              ('GET', re.compile(r'/stops/(\d+)/visits$'), 'stop_visits', True),
+              ('GET', re.compile(r'/stations/(\d+)/transfers$'), 'transfers', True),
+              ('POST', re.compile(r'/reload$'), 'reload', False)]
+
+    def __init__(self, folder=None, archive_folder=None, cache_size=default_cache_size):
+        """Serves the snapshot in folder, or the latest snapshot in archive_folder"""
+        self.archive_folder = archive_folder
+        self.cache_size = cache_size
+        self.feed = None  # type: Feed
+        self._reload_lock = threading.Lock()
+        self.load(folder)
+
+    def load(self, folder=None):
+        """Loads the snapshot in folder (by default, the latest in the archive) and swaps it in. Requests that are
+        being answered keep using the snapshot they started with. Returns the snapshot folder."""
+        with self._reload_lock:
+            if folder is None:
+                if self.archive_folder is None:
+                    raise QueryError(400, 'No folder, and the service has no archive')
+                snapshots = archive_runner.find_snapshots(self.archive_folder)
+                if len(snapshots) == 0:
+                    raise QueryError(404, 'No snapshots in %s' % self.archive_folder)
+                folder = snapshots[-1][1]
+            if not os.path.isdir(folder):
+                raise QueryError(404, 'No snapshot folder %s' % folder)
+            try:
+                index = FeedIndex(folder)
+            except FileNotFoundError as e:
+                raise QueryError(404, "Can't load %s: %s" % (folder, e))
+            except ValueError as e:  # a malformed gtfs file
+                raise QueryError(400, "Can't load %s: %s" % (folder, e))
+            # a new cache, since the cached results are of the old snapshot
+            self.feed = Feed(index, LRUCache(self.cache_size))
+            message('serving %s' % folder)
+            return folder
+
+    def handle(self, method, path, params):
+        """Answers a request. params is a map from query parameter to value. Returns the http status and the json
+        response, encoded."""
+        feed = self.feed
+        try:
+            for route_method, pattern, name, cached in self.routes:
+                match = pattern.match(path)
+                if match is not None and route_method == method:
+                    break
+            else:
+                raise QueryError(404, 'Unknown request %s %s' % (method, path))
+            if not cached:
+                return 200, self.encode(getattr(self, name)(feed, params))
+            key = (path, tuple(sorted(params.items())))
+            response = feed.cache.get(key)
+            if response is None:
+                response = self.encode(getattr(self, name)(feed.index, *(int(x) for x in match.groups()), params))
+                feed.cache.put(key, response)
+            return 200, response
+        except QueryError as e:
+            return e.status, self.encode({'error': str(e)})
+        except Exception as e:
+            # any other failure is a bug; the client still gets a response, and the service keeps serving
+            message('%s %s failed: %s' % (method, path, traceback.format_exc()))
+            return 500, self.encode({'error': 'Internal error: %s' % e})
+
+    @staticmethod
+    def encode(response):
+        return json.dumps(response, ensure_ascii=False).encode('utf8')
+
+    @staticmethod
+    def dates(params):
+        try:
+            start_date = parse_date(params['start'])
+            if 'end' in params:
+                return start_date, parse_date(params['end'])
+            return start_date, start_date + datetime.timedelta(days=archive_runner.default_statistics_days - 1)
+        except KeyError:
+            raise QueryError(400, 'start date is missing')
+        except ValueError as e:
+            raise QueryError(400, str(e))
+
+    @staticmethod
+    def int_param(params, name, default):
+        try:
+            return int(params[name]) if name in params else default
+        except ValueError:
+            raise QueryError(400, '%s should be an integer' % name)
+
+    @classmethod
+    def day_param(cls, params, default):
+        day = cls.int_param(params, 'day', default)
+        if day is not None and not 0 <= day <= 6:
+            raise QueryError(400, 'day should be 0 to 6 (python weekdays, 6 is sunday)')
+        return day
+
+    @staticmethod
+    def status(feed, params):
+        index, cache = feed
+        return {'folder': index.folder, 'loaded_at': index.loaded_at.isoformat(), 'stations': len(index.stations),
+                'cache_size': len(cache.values), 'cache_hits': cache.hits, 'cache_misses': cache.misses}
+
+    def station_visits(self, index, station_id, params):
+        start_date, end_date = self.dates(params)
+        kind = params.get('kind', 'bus')
+        if kind not in ('bus', 'train'):
+            raise QueryError(400, 'kind should be bus or train')
+        station_name = index.station_name(station_id)
+        counter = index.station_visits(station_id, start_date, end_date, kind,
+                                       self.int_param(params, 'max_distance', default_station_distance))
+        sun_thur = station_service_statistics.station_hourly_average_sun_to_thurs({station_id: counter})[station_id]
+        return {'station_id': station_id, 'station_name': station_name, 'kind': kind,
+                'hourly_visits': [{'day': day, 'hour': hour, 'visits': visits}
+                                  for (day, hour), visits in sorted(counter.items())],
+                'sun_thur_hourly_average': sun_thur}
+
+    def stop_visits(self, index, stop_id, params):
+        start_date, end_date = self.dates(params)
+        if stop_id not in index.g.stops:
+            raise QueryError(404, 'Unknown stop %d' % stop_id)
+        day = self.day_param(params, None)
+        visits = index.visits_at_stops([stop_id], start_date, end_date, day)
+        return {'stop_id': stop_id, 'stop_name': index.g.stops[stop_id].stop_name,
+                'visits': [{'day': visit.day, 'arrival': visit.arrival, 'departure': visit.departure,
+                            'route_id': visit.route.route_id, 'line_number': visit.route.line_number}
+                           for visit in visits]}
+
+    def transfers(self, index, station_id, params):
+        start_date, end_date = self.dates(params)
+        station_name = index.station_name(station_id)
+        day = self.day_param(params, train_to_bus.default_day)
+        train_visits = index.transfers(station_id, start_date, end_date, day,
+                                       self.int_param(params, 'max_distance', default_transfer_distance))
+        res = []
+        for train, bus_before, bus_after, bus_route_id in train_visits:
+            bus_route = index.g.routes[bus_route_id]
+            if 'route' in params and bus_route.line_number != params['route']:
+                continue
+            res.append({'arrival': train.arrival, 'train_route_id': train.route.route_id,
+                        'bus_route_id': bus_route_id, 'bus_line_number': bus_route.line_number,
+                        'last_bus_arrival': bus_before.arrival if bus_before is not None else None,
+                        'first_bus_departure': bus_after.departure if bus_after is not None else None,
+                        'wait': bus_after.departure - train.arrival if bus_after is not None else None})
+        return {'station_id': station_id, 'station_name': station_name, 'day': day, 'transfers': res}
+
+    def reload(self, feed, params):
+        return {'folder': self.load(params.get('folder'))}
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    def respond(self, method):
+        url = urlsplit(self.path)
+        status, body = self.server.service.handle(method, url.path, dict(parse_qsl(url.query)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def log_message(self, format, *args):
+        message('%s %s' % (self.address_string(), format % args))
+
+
+def make_server(service, host=default_host, port=default_port):
+    server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+    server.service = service
+    return server
+
+
+class LocalClient:
+    """Sends requests to a QueryService in the same process, without http"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def request(self, method, url):
+        url = urlsplit(url)
+        status, body = self.service.handle(method, url.path, dict(parse_qsl(url.query)))
+        return status, json.loads(body.decode('utf8'))
+
+    def get(self, url):
+        return self.request('GET', url)
+
+    def post(self, url):
+        return self.request('POST', url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve queries about an extended gtfs snapshot')
+    parser.add_argument('folder', nargs='?', default=None, help='the snapshot folder (default: the latest snapshot '
+                                                               'in --archive)')
+    parser.add_argument('--archive', default=None, help='an archive folder, like for archive_runner.py')
+    parser.add_argument('--host', default=default_host)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--cache-size', type=int, default=default_cache_size, help='number of cached responses')
+    args = parser.parse_args()
+    if args.folder is None and args.archive is None:
+        parser.error('either a folder or --archive is needed')
+    server = make_server(QueryService(args.folder, args.archive, args.cache_size), args.host, args.port)
+    message('listening on http://%s:%d' % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
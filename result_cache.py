@@ -0,0 +1,238 @@
+"""
+ an on-disk cache of the results of analysis functions, keyed by the feed, the function and its parameters.
+
+ An analysis function (whose first argument is the gtfs) decorated with @cached_result() saves its result to
+ <cache folder>/<function>-<feed hash>-<call hash>.pickle, and later calls on the same feed with the same arguments
+ (after applying the defaults) read it instead of computing it again. The feed hash is the hash of the content of the
+ gtfs zip and of the extended tables, so a snapshot that was re-extended with other parameters doesn't get stale
+ results; each file is hashed once per process and file version (size and mtime). The call hash covers the arguments
+ and the source of the function.
+
+ The cache is bounded by size: after a result is written, the least recently used results (by the file mtime, which is
+ updated on every hit) are removed until the cache is smaller than max_bytes. invalidate() removes the results of a
+ function, of a feed, or all of them:
+
+   python result_cache.py --invalidate station_service_statistics.bus_station_visits
+   python result_cache.py --clear
+
+ set_cache() changes the folder and the size, or disables the cache (benchmark.py disables it, so it times the
+ functions rather than the cache).
+"""
+
+import argparse
+import datetime
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+
+from ilgtfs import ExtendedGTFS
+from instrumentation import count, message
+
+default_cache_folder = 'data/cache'
+default_max_bytes = 1 << 30
+
+# the files the results of a feed depend on; the trips and frequency blocks are derived from the others, but they're
+# hashed too, since the functions read them and they may be rebuilt on their own
+feed_files = ['israel-public-transportation.zip', ExtendedGTFS.route_story_stops_files,
+              ExtendedGTFS.route_story_services_filename, ExtendedGTFS.full_routes_filename, 'full_stops.txt',
+              'full_trips.txt', ExtendedGTFS.trip_frequencies_filename]
+# the files of a snapshot loaded from a snapshot_store.SnapshotStore
+stored_feed_files = ['stops_manifest.txt.gz', 'services_manifest.txt.gz', 'route_stories_manifest.txt.gz',
+                     ExtendedGTFS.full_routes_filename + '.gz', ExtendedGTFS.route_story_services_filename + '.gz',
+                     'full_trips.txt.gz']
+
+
+class ResultCache:
+    def __init__(self, folder=default_cache_folder, max_bytes=default_max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def path(self, function_name, feed_hash, call_hash):
+        return os.path.join(self.folder, '%s-%s-%s.pickle' % (function_name, feed_hash, call_hash))
+
+    def get(self, path):
+        """Returns (True, result) if the result is in the cache, otherwise (False, None)"""
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (pickle.UnpicklingError, EOFError):
+            message('removing corrupt cached result %s' % path)
+            self.remove(path)
+            return False, None
+        except (AttributeError, ImportError):  # pickled with a class that was renamed or moved since
+            message('removing stale cached result %s' % path)
+            self.remove(path)
+            return False, None
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # evicted by another process meanwhile
+            return False, None
+        return True, result
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # removed by another process
+            pass
+
+    def put(self, path, result):
+        os.makedirs(self.folder, exist_ok=True)
+        # written under another name and renamed, so other processes never read half a result
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) of the cached results, least recently used first"""
+        if not os.path.isdir(self.folder):
+            return []
+        res = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.folder, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # removed by another process
+                    continue
+                res.append((st.st_mtime, st.st_size, path))
+        return sorted(res)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                count('evicted_results')
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, function_name=None, feed_hash=None):
+        """Removes the cached results of a function (by module.name), of a feed (by feed hash), or all of them.
+        Returns the number of results removed."""
+        removed = 0
+        for _, _, path in self.entries():
+            name, path_feed_hash, _ = os.path.basename(path)[:-len('.pickle')].rsplit('-', 2)
+            if (function_name is None or name == function_name) and (feed_hash is None or path_feed_hash == feed_hash):
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+_cache = ResultCache()
+
+
+def set_cache(cache):
+    """Sets the cache used by all the cached functions. None disables caching."""
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
+
+
+# (path, size, mtime) -> content hash
+_file_hashes = {}
+
+
+def file_hash(path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def feed_hash(g):
+    """Returns a hash of the content of the feed's files, or None if it has none of them. It isn't kept with the gtfs,
+    since the extender may rewrite its files (the hashes of the files are kept by version)."""
+    paths = [g.at_path(name) for name in feed_files + stored_feed_files if os.path.exists(g.at_path(name))]
+    if len(paths) == 0:
+        return None
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(('%s:%s\n' % (os.path.basename(path), file_hash(path))).encode('utf8'))
+    return h.hexdigest()[:16]
+
+
+def normalized(value):
+    """Returns a representation of an argument that's the same for equal values (sets aren't ordered)"""
+    if isinstance(value, (set, frozenset)):
+        return sorted(normalized(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [normalized(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((normalized(k), normalized(v)) for k, v in value.items())
+    if isinstance(value, (str, int, float, bool, datetime.date, type(None))):
+        return value
+    raise TypeError("Can't cache a call with a %s argument" % type(value).__name__)
+
+
+def cached_result(encode=None, decode=None):
+    """Decorates an analysis function, whose first argument is the gtfs, to cache its results. encode(result) and
+    decode(g, stored) convert results that refer to the objects of the feed (trips, route story stops) to and from
+    what's stored."""
+
+    def decorator(function):
+        function_name = '%s.%s' % (function.__module__, function.__qualname__)
+        signature = inspect.signature(function)
+        try:
+            source_hash = hashlib.sha1(inspect.getsource(function).encode('utf8')).hexdigest()
+        except (OSError, TypeError):
+            source_hash = hashlib.sha1(function.__code__.co_code).hexdigest()
+
+        @functools.wraps(function)
+        def wrapper(g, *args, **kwargs):
+            cache = _cache
+            h = feed_hash(g) if cache is not None else None
+            if h is None:
+                return function(g, *args, **kwargs)
+            arguments = signature.bind(g, *args, **kwargs)
+            arguments.apply_defaults()
+            parameters = list(arguments.arguments.items())[1:]
+            call = repr((source_hash, [(name, normalized(value)) for name, value in parameters]))
+            path = cache.path(function_name, h, hashlib.sha1(call.encode('utf8')).hexdigest()[:16])
+            found, stored = cache.get(path)
+            if found:
+                message('%s: cached result' % function.__name__)
+                return decode(g, stored) if decode is not None else stored
+            result = function(g, *args, **kwargs)
+            cache.put(path, encode(result) if encode is not None else result)
+            return result
+
+        wrapper.uncached = function
+        return wrapper
+
+    return decorator
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove cached analysis results')
+    parser.add_argument('--folder', default=default_cache_folder)
+    parser.add_argument('--invalidate', metavar='FUNCTION', help='the results of a function, like '
+                                                                 'station_service_statistics.bus_station_visits')
+    parser.add_argument('--feed', help='the results of a feed (by feed hash)')
+    parser.add_argument('--clear', action='store_true', help='all the results')
+    args = parser.parse_args()
+    if not (args.clear or args.invalidate or args.feed):
+        parser.error('nothing to remove')
+    print('Removed %d results' % ResultCache(args.folder).invalidate(args.invalidate, args.feed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+ group route stories with (nearly) the same stops into families.
+
+ Route alternatives (a route that skips a stop or two, a slower version with the same stops, a version that starts
+ or ends a stop later, the same line run by two route_ids) have different route stories, so counting visits by route
+ story counts the same "line" several times. Two route stories are similar if the Jaccard similarity of their sets of
+ consecutive stop pairs (shingles) is at least the threshold, and a family is a set of route stories linked by a chain
+ of similar pairs (single linkage). Consecutive pairs keep the direction, so the two directions of a line are different
+ families. Skipping one stop of a 20 stop story changes 2 of its 19 pairs (a similarity of 0.85), but a story that
+ only runs half of the line has a similarity of about 0.5 to it, so it's a family of its own at the default threshold.
+
+ Comparing all the pairs of stories is quadratic, so candidate pairs are found with MinHash signatures and locality
+ sensitive hashing: the signature is split into bands, and only stories with an equal band are compared (stories
+ with the same stops are linked without comparing them).
+
+ The families are exported to route_story_families.txt (route_story_id, family_id); the family id is the lowest
+ route story id in the family.
+"""
+
+import csv
+import random
+
+from ilgtfs import ExtendedGTFS, read_fields
+from instrumentation import stage, count
+
+route_story_families_filename = 'route_story_families.txt'
+
+default_threshold = 0.8
+# 8 bands of 4 hashes: stories with similarity 0.8 are compared with probability 0.98, 0.5 with 0.4
+signature_bands = 8
+band_rows = 4
+
+_hash_mask = (1 << 64) - 1
+
+
+def shingles(route_story):
+    """Returns the set of consecutive stop pairs of the route story (or its single stop)"""
+    stop_ids = [stop.stop_id for stop in route_story.stops]
+    if len(stop_ids) < 2:
+        return frozenset((stop_id, stop_id) for stop_id in stop_ids)
+    return frozenset(zip(stop_ids, stop_ids[1:]))
+
+
+def minhash_signature(story_shingles, masks):
+    """Returns the MinHash signature of a set of shingles: for each mask, the minimum of the shingle hashes xor-ed
+    with it"""
+    hashes = [hash(shingle) & _hash_mask for shingle in story_shingles]
+    return tuple(min(h ^ mask for h in hashes) for mask in masks)
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+def find_families(route_stories, threshold=default_threshold, seed=1):
+    """Returns a map from route story id to family id"""
+    rnd = random.Random(seed)
+    masks = [rnd.getrandbits(64) for _ in range(signature_bands * band_rows)]
+    story_shingles = {story_id: shingles(story) for story_id, story in route_stories.items()
+                      if len(story.stops) > 0}
+
+    # union find over the route story ids; the root of a family is its lowest id
+    parent = {story_id: story_id for story_id in route_stories}
+
+    def root(story_id):
+        while parent[story_id] != story_id:
+            parent[story_id] = parent[parent[story_id]]
+            story_id = parent[story_id]
+        return story_id
+
+    def union(a, b):
+        a, b = root(a), root(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    with stage('signatures'):
+        signatures = {story_id: minhash_signature(s, masks) for story_id, s in story_shingles.items()}
+
+    with stage('compare candidates'):
+        compared = 0
+        for band in range(signature_bands):
+            buckets = {}
+            for story_id, signature in signatures.items():
+                buckets.setdefault(signature[band * band_rows:(band + 1) * band_rows], []).append(story_id)
+            for bucket in buckets.values():
+                # stories with the same shingles are linked directly, so buckets of identical stories stay linear;
+                # the distinct ones are compared with each other, unless they're in the same family already
+                distinct = {}
+                for story_id in bucket:
+                    first = distinct.setdefault(story_shingles[story_id], story_id)
+                    if first != story_id:
+                        union(story_id, first)
+                distinct = list(distinct.values())
+                for i, story_id in enumerate(distinct):
+                    for other_id in distinct[:i]:
+                        if root(other_id) == root(story_id):
+                            continue
+                        compared += 1
+                        if jaccard(story_shingles[story_id], story_shingles[other_id]) >= threshold:
+                            union(story_id, other_id)
+        count('compared_pairs', compared)
+
+    families = {story_id: root(story_id) for story_id in route_stories}
+    count('route_stories', len(families))
+    count('families', len(set(families.values())))
+    return families
+
+
+def find_route_story_families(gtfs: ExtendedGTFS, threshold=default_threshold):
+    """Finds the route story families and exports them to route_story_families.txt"""
+    with stage('find_route_story_families'):
+        gtfs.load_route_stories()
+        families = find_families(gtfs.route_stories, threshold)
+        with stage('export'), open(gtfs.at_path(route_story_families_filename), 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['route_story_id', 'family_id'])
+            writer.writerows(sorted(families.items()))
+
+
+def load_route_story_families(gtfs: ExtendedGTFS):
+    """Returns a map from route story id to family id, from route_story_families.txt"""
+    with open(gtfs.at_path(route_story_families_filename), encoding='utf8') as f:
+        return {int(route_story_id): int(family_id)
+                for route_story_id, family_id in read_fields(f, ('route_story_id', 'family_id'))}
+
+
+if __name__ == '__main__':
+    find_route_story_families(ExtendedGTFS('data/gtfs/gtfs_2016_05_25'))
@@ -0,0 +1,207 @@
+"""
+ a compact, memory-mapped copy of the route stories.
+
+ load_route_stories reads route_story_stops.txt into a RouteStoryStop object for every stop of every story, sorts the
+ stories and attaches a set of services to each; for the whole country that's millions of objects before the first
+ question is answered. build_route_story_store (an extender pipeline stage) writes the same data to
+ route_stories.bin as flat columns:
+
+   route_story_id        the route story ids, sorted; route story i is row i of the columns below
+   stops_start           the stops of route story i are rows stops_start[i] to stops_start[i + 1] of the stop_*
+                         columns (stop_id, arrival_offset, departure_offset, pickup_type, drop_off_type), in the order
+                         of RouteStory.stops (by arrival offset, so the stop_sequence of a row is its index in the story
+                         plus one)
+   services_start        the services of route story i are rows services_start[i] to services_start[i + 1] of the
+                         service_id column
+
+ The file starts with a short header (a magic line, and a json line with the byte order and the (name, typecode,
+ byte offset, length) of every column); the columns are 8 byte aligned. MappedRouteStories maps the file read only, so
+ opening it takes no time and processes that map the same file share its pages in the page cache. It's a read only
+ dictionary from route_story_id to RouteStory, like sqlite_gtfs.SqliteTable: a RouteStory is created (once) when it's
+ accessed, and iterating over the keys doesn't create any.
+
+   g = MappedExtendedGTFS('data/gtfs/gtfs_2016_06_09')
+   g.route_stories[1234].stops
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import sys
+from array import array
+from collections.abc import Mapping
+
+from ilgtfs import ExtendedGTFS, RouteStory, RouteStoryStop, loads
+from instrumentation import stage, count, message
+
+route_story_store_filename = 'route_stories.bin'
+
+magic = b'route stories 1\n'
+
+# (column name, array typecode)
+columns = [('route_story_id', 'i'), ('stops_start', 'i'),
+           ('stop_id', 'i'), ('arrival_offset', 'i'), ('departure_offset', 'i'), ('pickup_type', 'b'),
+           ('drop_off_type', 'b'),
+           ('services_start', 'i'), ('service_id', 'i')]
+
+
+def flatten(route_stories):
+    """Returns a map from column name to an array of the column, for a map from route_story_id to RouteStory"""
+    res = {name: array(typecode) for name, typecode in columns}
+    res['stops_start'].append(0)
+    res['services_start'].append(0)
+    for route_story_id in sorted(route_stories):
+        route_story = route_stories[route_story_id]
+        res['route_story_id'].append(route_story_id)
+        for stop in route_story.stops:
+            res['stop_id'].append(stop.stop_id)
+            res['arrival_offset'].append(stop.arrival_offset)
+            res['departure_offset'].append(stop.departure_offset)
+            res['pickup_type'].append(stop.pickup_type)
+            res['drop_off_type'].append(stop.drop_off_type)
+        res['stops_start'].append(len(res['stop_id']))
+        res['service_id'].extend(sorted(service.service_id for service in route_story.services))
+        res['services_start'].append(len(res['service_id']))
+    return res
+
+
+def write_store(route_stories, filename):
+    arrays = flatten(route_stories)
+    layout = []
+    offset = 0
+    for name, typecode in columns:
+        a = arrays[name]
+        layout.append((name, typecode, offset, len(a)))
+        offset += (len(a) * a.itemsize + 7) // 8 * 8
+    header = magic + (json.dumps({'byteorder': sys.byteorder, 'columns': layout}) + '\n').encode('utf8')
+    header += b'\0' * (-len(header) % 8)
+    # written under another name and renamed, so processes that map the store never see half of it
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        f.write(header)
+        for name, typecode, column_offset, length in layout:
+            f.seek(len(header) + column_offset)
+            arrays[name].tofile(f)
+        f.truncate(len(header) + offset)
+    os.replace(temp_filename, filename)
+    return len(header) + offset
+
+
+def build_route_story_store(gtfs: ExtendedGTFS):
+    """Writes the route stories (read from the csv files) to the route story store"""
+    with stage('build_route_story_store'):
+        gtfs.load_route_stories()
+        size = write_store(gtfs.route_stories, gtfs.at_path(route_story_store_filename))
+        count('route_stories', len(gtfs.route_stories))
+        count('bytes', size)
+
+
+class MappedRouteStories(Mapping):
+    """A read only dictionary from route_story_id to RouteStory, backed by a memory-mapped route story store.
+
+    Route stories are created on first access and cached. services is the map from service_id to Service they refer to.
+    """
+
+    def __init__(self, filename, services):
+        self.services = services
+        self.cache = {}
+        with open(filename, 'rb') as f:
+            header = f.readline()
+            if header != magic:
+                raise ValueError('%s is not a route story store' % filename)
+            layout = json.loads(f.readline().decode('utf8'))
+            start = f.tell() + (-f.tell() % 8)
+            if layout['byteorder'] != sys.byteorder:
+                raise ValueError('%s was written on a %s endian machine' % (filename, layout['byteorder']))
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        buf = memoryview(self.mmap)
+        for name, typecode, offset, length in layout['columns']:
+            view = buf[start + offset:start + offset + length * array(typecode).itemsize].cast(typecode)
+            self.views.append(view)
+            setattr(self, name, view)
+        self.views.append(buf)
+
+    def close(self):
+        """Unmaps the store; the route stories that were created stay valid"""
+        # the views must be released before the file can be unmapped
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.mmap.close()
+
+    def row(self, route_story_id):
+        """Returns the row of a route story, or None if it's not in the store"""
+        row = bisect.bisect_left(self.route_story_id, route_story_id)
+        if row < len(self.route_story_id) and self.route_story_id[row] == route_story_id:
+            return row
+        return None
+
+    def make_route_story(self, row):
+        stops = [RouteStoryStop(self.arrival_offset[i], self.departure_offset[i], self.stop_id[i],
+                                self.pickup_type[i], self.drop_off_type[i], i - self.stops_start[row] + 1)
+                 for i in range(self.stops_start[row], self.stops_start[row + 1])]
+        services = {self.services[self.service_id[i]]
+                    for i in range(self.services_start[row], self.services_start[row + 1])}
+        return RouteStory(self.route_story_id[row], stops, services)
+
+    def __getitem__(self, route_story_id):
+        route_story = self.cache.get(route_story_id)
+        if route_story is None:
+            row = self.row(route_story_id)
+            if row is None:
+                raise KeyError(route_story_id)
+            route_story = self.cache[route_story_id] = self.make_route_story(row)
+        return route_story
+
+    def __contains__(self, route_story_id):
+        return route_story_id in self.cache or self.row(route_story_id) is not None
+
+    def __iter__(self):
+        return iter(self.route_story_id)
+
+    def __len__(self):
+        return len(self.route_story_id)
+
+    def stop_ids(self, route_story_id):
+        """Returns the stop_ids of a route story (a view of the store), without creating the RouteStory"""
+        row = self.row(route_story_id)
+        if row is None:
+            raise KeyError(route_story_id)
+        return self.stop_id[self.stops_start[row]:self.stops_start[row + 1]]
+
+
+class MappedExtendedGTFS(ExtendedGTFS):
+    """An ExtendedGTFS that maps the route stories from the route story store instead of reading the csv files"""
+
+    def store_filename(self):
+        return self.at_path(route_story_store_filename)
+
+    def store_is_up_to_date(self):
+        sources = [self.at_path(self.route_story_stops_files), self.at_path(self.route_story_services_filename)]
+        return os.path.exists(self.store_filename()) and \
+            all(os.path.getmtime(self.store_filename()) >= os.path.getmtime(f) for f in sources if os.path.exists(f))
+
+    @loads('route_stories', 'services')
+    def load_route_stories(self):
+        if not self.store_is_up_to_date():
+            message('%s is missing or older than the route story files, reading the csv files' %
+                    self.store_filename())
+            self.load_csv_route_stories()
+            return
+        with stage('map route stories'):
+            self.route_stories = MappedRouteStories(self.store_filename(), self.services)
+            count('route_stories', len(self.route_stories))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the route stories of an extended gtfs to the route story store')
+    parser.add_argument('folder', help='the extended gtfs folder')
+    args = parser.parse_args()
+    build_route_story_store(ExtendedGTFS(args.folder))
+
+
+if __name__ == '__main__':
+    main()
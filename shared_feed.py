@@ -0,0 +1,250 @@
+"""
+ publish a loaded ExtendedGTFS as read-only arrays in shared memory, for analyses that run in a process pool.
+
+ Pickling g.trips, g.route_stories and g.stops into every worker (or reloading the feed in each one) multiplies the
+ memory by the number of processes. Instead, the tables are flattened into columns of numbers, all in one
+ multiprocessing.shared_memory block:
+
+   stops           stop_id, stop_lat, stop_lon, nearest_train_station_id, train_station_distance
+   services        service_id, service_day_bits (bit d is python weekday d, like Service.days), start_date, end_date
+                   (date ordinals)
+   route stories   route_story_id, stops_start: the stops of route story i are rows stops_start[i] to
+                   stops_start[i + 1] of the story_stop_* columns (stop, arrival_offset, departure_offset, pickup_type,
+                   drop_off_type), in the order of RouteStory.stops
+   blocks          the frequency blocks (or one block per trip, see ExtendedGTFS.trip_blocks): route_id, route_type,
+                   service, route_story, start_time, end_time, headway, trips
+
+ References between the tables (story_stop_stop, block_service, block_route_story) are row numbers. The parent
+ publishes the feed and passes SharedFeed.handle (the block name and the column layout, a few hundred bytes) to the
+ workers; attaching maps the block and creates memoryviews over it, so nothing is copied:
+
+   with SharedFeed.publish(g) as feed, Pool(initializer=attach_worker, initargs=(feed.handle,)) as pool:
+       pool.map(analysis, ...)    # analysis uses shared_feed.worker_feed
+
+ station_visits_by_window is an example: the station visit counts of station_service_statistics for several date
+ windows, one window per process.
+"""
+
+from array import array
+from collections import namedtuple, defaultdict, Counter
+from multiprocessing import Pool, shared_memory
+
+from ilgtfs import hourly_counts
+from instrumentation import stage, count
+
+# (column name, array typecode)
+columns = [('stop_id', 'i'), ('stop_lat', 'd'), ('stop_lon', 'd'), ('nearest_train_station_id', 'i'),
+           ('train_station_distance', 'i'),
+           ('service_id', 'i'), ('service_day_bits', 'b'), ('start_date', 'i'), ('end_date', 'i'),
+           ('route_story_id', 'i'), ('stops_start', 'i'),
+           ('story_stop_stop', 'i'), ('story_stop_arrival_offset', 'i'), ('story_stop_departure_offset', 'i'),
+           ('story_stop_pickup_type', 'b'), ('story_stop_drop_off_type', 'b'),
+           ('block_route_id', 'i'), ('block_route_type', 'b'), ('block_service', 'i'), ('block_route_story', 'i'),
+           ('block_start_time', 'i'), ('block_end_time', 'i'), ('block_headway', 'i'), ('block_trips', 'i')]
+
+# the shared memory block name, and (column name, typecode, byte offset, length) of every column
+SharedFeedHandle = namedtuple('SharedFeedHandle', ['name', 'layout'])
+
+
+def flatten(g):
+    """Returns a map from column name to an array of the column, for a gtfs with stops, route stories and trips (or
+    frequency blocks) loaded"""
+    typecodes = dict(columns)
+    res = {name: array(typecode) for name, typecode in columns}
+
+    stop_index = {}
+    for i, stop in enumerate(g.stops.values()):
+        stop_index[stop.stop_id] = i
+        res['stop_id'].append(stop.stop_id)
+        res['stop_lat'].append(float(stop.stop_lat))
+        res['stop_lon'].append(float(stop.stop_lon))
+        res['nearest_train_station_id'].append(stop.nearest_train_station_id)
+        res['train_station_distance'].append(stop.train_station_distance)
+
+    service_index = {}
+    for i, service in enumerate(g.services.values()):
+        service_index[service.service_id] = i
+        res['service_id'].append(service.service_id)
+        res['service_day_bits'].append(sum(1 << day for day in service.days))
+        res['start_date'].append(service.start_date.toordinal())
+        res['end_date'].append(service.end_date.toordinal())
+
+    route_story_index = {}
+    res['stops_start'].append(0)
+    for i, route_story in enumerate(g.route_stories.values()):
+        route_story_index[route_story.route_story_id] = i
+        res['route_story_id'].append(route_story.route_story_id)
+        for stop in route_story.stops:
+            res['story_stop_stop'].append(stop_index[stop.stop_id])
+            res['story_stop_arrival_offset'].append(stop.arrival_offset)
+            res['story_stop_departure_offset'].append(stop.departure_offset)
+            res['story_stop_pickup_type'].append(stop.pickup_type)
+            res['story_stop_drop_off_type'].append(stop.drop_off_type)
+        res['stops_start'].append(len(res['story_stop_stop']))
+
+    for block in g.trip_blocks():
+        res['block_route_id'].append(block.route.route_id)
+        res['block_route_type'].append(block.route.route_type)
+        res['block_service'].append(service_index[block.service.service_id])
+        res['block_route_story'].append(route_story_index[block.route_story.route_story_id])
+        res['block_start_time'].append(block.start_time)
+        res['block_end_time'].append(block.end_time)
+        res['block_headway'].append(block.headway)
+        res['block_trips'].append(len(block))
+
+    assert all(res[name].typecode == typecode for name, typecode in typecodes.items())
+    return res
+
+
+class SharedFeed:
+    """The columns of a flattened feed in a shared memory block. Columns are read-only memoryviews, available as
+    attributes (feed.stop_id, feed.block_start_time...)."""
+
+    def __init__(self, shm, layout, owner):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.views = []
+        buf = shm.buf.toreadonly()
+        for name, typecode, offset, length in layout:
+            view = buf[offset:offset + length * array(typecode).itemsize].cast(typecode)
+            self.views.append(view)
+            setattr(self, name, view)
+        self.views.append(buf)
+
+    @classmethod
+    def publish(cls, g):
+        """Copies the gtfs (with stops, route stories and trips or frequency blocks loaded) to a new shared memory
+        block. The returned feed owns the block, and removes it when it's closed."""
+        with stage('publish shared feed'):
+            arrays = flatten(g)
+            layout = []
+            size = 0
+            for name, typecode in columns:
+                a = arrays[name]
+                layout.append((name, typecode, size, len(a)))
+                # keep every column 8 byte aligned
+                size += (len(a) * a.itemsize + 7) // 8 * 8
+            shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            for name, typecode, offset, length in layout:
+                data = arrays[name].tobytes()
+                shm.buf[offset:offset + len(data)] = data
+            count('bytes', size)
+            count('blocks', len(arrays['block_start_time']))
+            return cls(shm, layout, owner=True)
+
+    @classmethod
+    def attach(cls, handle):
+        """Attaches to a feed published by another process"""
+        return cls(shared_memory.SharedMemory(name=handle.name), handle.layout, owner=False)
+
+    @property
+    def handle(self):
+        return SharedFeedHandle(self.shm.name, self.layout)
+
+    def close(self):
+        # the views must be released before the block can be closed
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def route_story_stops(self, route_story):
+        """Returns the range of the story_stop rows of a route story (by row number)"""
+        return range(self.stops_start[route_story], self.stops_start[route_story + 1])
+
+    def service_days(self, service):
+        bits = self.service_day_bits[service]
+        return [day for day in range(7) if bits & (1 << day)]
+
+    def blocks(self, route_type, start_date, end_date):
+        """Yields the row numbers of the blocks of routes of route_type, active between the dates"""
+        start, end = start_date.toordinal(), end_date.toordinal()
+        for block, block_route_type in enumerate(self.block_route_type):
+            service = self.block_service[block]
+            if block_route_type == route_type and self.end_date[service] >= start and self.start_date[service] <= end:
+                yield block
+
+    def block_hourly_counts(self, block, offset):
+        return hourly_counts(self.block_start_time[block], self.block_end_time[block], self.block_headway[block],
+                             offset)
+
+
+def route_story_station_stops(feed, route_story, max_station_distance=500):
+    """Returns a list of (station_id, story_stop row) of the stops of the route story near train stations, like
+    station_service_statistics.route_story_station_stops"""
+    stop_of = feed.story_stop_stop
+    nearest, distance = feed.nearest_train_station_id, feed.train_station_distance
+    stops_near_station = [row for row in feed.route_story_stops(route_story)
+                          if distance[stop_of[row]] <= max_station_distance]
+    res = []
+    for station in {nearest[stop_of[row]] for row in stops_near_station}:
+        rows = [row for row in stops_near_station if nearest[stop_of[row]] == station]
+        nearest_stop = stop_of[min(rows, key=lambda row: distance[stop_of[row]])]
+        res += [(station, row) for row in rows if stop_of[row] == nearest_stop]
+    return res
+
+
+def bus_station_visits(feed, start_date, end_date, max_distance_from_station=500):
+    """Returns, for each station, a counter of bus visits by (day, hour), like
+    station_service_statistics.bus_station_visits"""
+    story_station_stops = {}
+    res = defaultdict(lambda: Counter())
+    for block in feed.blocks(3, start_date, end_date):
+        route_story = feed.block_route_story[block]
+        if route_story not in story_station_stops:
+            story_station_stops[route_story] = route_story_station_stops(feed, route_story, max_distance_from_station)
+        days = feed.service_days(feed.block_service[block])
+        for station, row in story_station_stops[route_story]:
+            for hour, trips in feed.block_hourly_counts(block, feed.story_stop_arrival_offset[row]).items():
+                for day in days:
+                    res[station][(day, hour)] += trips
+    return res
+
+
+def train_station_visits(feed, start_date, end_date):
+    """Returns, for each station, a counter of train arrivals by (day, hour), like
+    station_service_statistics.train_station_visits"""
+    res = defaultdict(lambda: Counter())
+    for block in feed.blocks(2, start_date, end_date):
+        days = feed.service_days(feed.block_service[block])
+        for row in feed.route_story_stops(feed.block_route_story[block]):
+            station = feed.nearest_train_station_id[feed.story_stop_stop[row]]
+            for hour, trips in feed.block_hourly_counts(block, feed.story_stop_arrival_offset[row]).items():
+                for day in days:
+                    res[station][(day, hour)] += trips
+    return res
+
+
+# the feed of a worker process, attached by attach_worker
+worker_feed = None  # type: SharedFeed
+
+
+def attach_worker(handle):
+    """Pool initializer: attaches the worker process to the shared feed"""
+    global worker_feed
+    worker_feed = SharedFeed.attach(handle)
+
+
+def _window_station_visits(args):
+    kind, start_date, end_date = args
+    visits = bus_station_visits if kind == 'bus' else train_station_visits
+    return dict(visits(worker_feed, start_date, end_date))
+
+
+def station_visits_by_window(g, windows, kind='bus', processes=None):
+    """Returns the station visits (see bus_station_visits and train_station_visits) of each (start_date, end_date)
+    window, computed in a process pool that shares one copy of the feed"""
+    with stage('station_visits_by_window'), SharedFeed.publish(g) as feed:
+        with Pool(processes, initializer=attach_worker, initargs=(feed.handle,)) as pool:
+            res = pool.map(_window_station_visits, [(kind, start_date, end_date) for start_date, end_date in windows])
+        count('windows', len(res))
+        return res
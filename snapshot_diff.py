@@ -0,0 +1,181 @@
+"""
+ find what changed between two extended gtfs snapshots: routes, route stories, stop positions, trip start times
+ and service calendars.
+
+ Records are matched with dictionaries (hash joins) on their ids or, for route stories, on a fingerprint of their
+ stops: route story ids are allocated separately in every snapshot, so the same story can have different ids. A story
+ whose fingerprint is only in the old snapshot is paired with one that's only in the new snapshot, of the same route
+ and with the same stop ids (a retimed story, or one whose pickup types changed), and reported as changed; the others
+ are removed or added.
+ diff_snapshots is a generator, so the changes can be exported without keeping them in memory.
+
+ The trip start times are read from the frequency blocks (g.trip_blocks()), so no FullTrip object is created: besides
+ the stops, routes, services and route stories of both snapshots, memory holds a set of start times for every (route,
+ route story, day), which is the number of distinct start times of a route story on a day of the week, not the number
+ of trips in the feed.
+"""
+
+import csv
+from collections import namedtuple, defaultdict
+
+from ilgtfs import ExtendedGTFS
+from instrumentation import stage, count
+
+# kind: route | route_story | stop | trip_start_time | service
+# change: added | removed | changed
+# key: the id of the changed object (for trip start times: (route_id, route story fingerprint id, day, start_time))
+# old, new: for route stories that were added or removed, the number of stops; for changed route stories, the stops
+# that changed, as <stop sequence>:<arrival offset>/<departure offset>/<pickup type>/<drop off type>
+Change = namedtuple('Change', ['kind', 'change', 'key', 'old', 'new'])
+
+
+def route_story_fingerprint(route_story):
+    """Returns a hashable fingerprint of the stops of a route story; equal stories have equal fingerprints"""
+    return tuple(stop.as_tuple() for stop in route_story.stops)
+
+
+def story_routes(g):
+    """Returns a map from route story id to the ids of the routes that have it"""
+    res = defaultdict(list)
+    for route in g.routes.values():
+        for route_story_id in route.route_story_ids:
+            res[route_story_id].append(route.route_id)
+    return res
+
+
+def changed_stops(old_story, new_story):
+    """Returns (old, new) tuples of the stops that differ between two route stories with the same stop ids"""
+    def text(sequence, stop):
+        return '%d:%d/%d/%s/%s' % (sequence, stop.arrival_offset, stop.departure_offset, stop.pickup_type,
+                                   stop.drop_off_type)
+    changed = [(text(i, old_stop), text(i, new_stop))
+               for i, (old_stop, new_stop) in enumerate(zip(old_story.stops, new_story.stops), 1)
+               if old_stop.as_tuple() != new_stop.as_tuple()]
+    return tuple(old for old, _ in changed), tuple(new for _, new in changed)
+
+
+def format_service(service):
+    return '%s-%s days=%s' % (service.start_date.strftime('%Y%m%d'), service.end_date.strftime('%Y%m%d'),
+                              ''.join(str(day) for day in sorted(service.days)))
+
+
+def diff_by_key(kind, old, new, old_value, new_value=None):
+    """Yields the changes between two dictionaries, comparing old_value(item) and new_value(item) of items with the
+    same key. new_value defaults to old_value."""
+    if new_value is None:
+        new_value = old_value
+    for key, old_item in old.items():
+        if key not in new:
+            yield Change(kind, 'removed', key, old_value(old_item), None)
+        else:
+            old_item_value, new_item_value = old_value(old_item), new_value(new[key])
+            if old_item_value != new_item_value:
+                yield Change(kind, 'changed', key, old_item_value, new_item_value)
+    for key, new_item in new.items():
+        if key not in old:
+            yield Change(kind, 'added', key, None, new_value(new_item))
+
+
+def diff_snapshots(old, new):
+    """Yields Change records between the old and the new ExtendedGTFS. Works on the frequency blocks if they are
+    loaded (or can be), otherwise on the trips."""
+    # fingerprint -> route story id, for each snapshot; the fingerprint of a story in the output is its id in the
+    # new snapshot if it exists there, otherwise 'old:<id in the old snapshot>'
+    old_stories = {route_story_fingerprint(story): story_id for story_id, story in old.route_stories.items()}
+    new_stories = {route_story_fingerprint(story): story_id for story_id, story in new.route_stories.items()}
+
+    # pair the stories that are only in one of the snapshots by (route, stop ids); old story id -> new story id
+    added_by_stops = defaultdict(list)
+    new_story_routes = story_routes(new)
+    for fingerprint, story_id in new_stories.items():
+        if fingerprint not in old_stories:
+            stop_ids = tuple(stop.stop_id for stop in new.route_stories[story_id].stops)
+            for route_id in new_story_routes[story_id]:
+                added_by_stops[(route_id, stop_ids)].append(story_id)
+    changed_stories = {}
+    paired = set()
+    old_story_routes = story_routes(old)
+    for fingerprint, story_id in old_stories.items():
+        if fingerprint in new_stories:
+            continue
+        stop_ids = tuple(stop.stop_id for stop in old.route_stories[story_id].stops)
+        candidates = (new_story_id for route_id in old_story_routes[story_id]
+                      for new_story_id in added_by_stops.get((route_id, stop_ids), []) if new_story_id not in paired)
+        new_story_id = next(candidates, None)
+        if new_story_id is not None:
+            changed_stories[story_id] = new_story_id
+            paired.add(new_story_id)
+
+    old_story_names = {story_id: str(new_stories[fingerprint]) if fingerprint in new_stories else
+                       str(changed_stories[story_id]) if story_id in changed_stories else 'old:%d' % story_id
+                       for fingerprint, story_id in old_stories.items()}
+    new_story_names = {story_id: str(story_id) for story_id in new.route_stories}
+
+    for fingerprint, story_id in old_stories.items():
+        if story_id in changed_stories:
+            new_story_id = changed_stories[story_id]
+            yield Change('route_story', 'changed', new_story_names[new_story_id],
+                         *changed_stops(old.route_stories[story_id], new.route_stories[new_story_id]))
+        elif fingerprint not in new_stories:
+            yield Change('route_story', 'removed', old_story_names[story_id], len(fingerprint), None)
+    for fingerprint, story_id in new_stories.items():
+        if fingerprint not in old_stories and story_id not in paired:
+            yield Change('route_story', 'added', new_story_names[story_id], None, len(fingerprint))
+
+    def route_value(story_names):
+        def value(route):
+            return (route.line_number, route.route_long_name, route.route_desc, route.route_type,
+                    ' '.join(sorted(story_names[story_id] for story_id in route.route_story_ids)))
+        return value
+
+    yield from diff_by_key('route', old.routes, new.routes, route_value(old_story_names),
+                           route_value(new_story_names))
+
+    yield from diff_by_key('stop', old.stops, new.stops, lambda stop: (str(stop.stop_lat), str(stop.stop_lon)))
+    yield from diff_by_key('service', old.services, new.services, format_service)
+
+    # trip start times: trip ids change between snapshots, so compare the sets of start times of every
+    # (route, route story, day)
+    def start_times(g, story_names):
+        res = defaultdict(lambda: set())
+        for block in g.trip_blocks():
+            story_name = story_names[block.route_story.route_story_id]
+            for day in block.service.days:
+                res[(block.route.route_id, story_name, day)].update(block.start_times)
+        return res
+
+    old_start_times = start_times(old, old_story_names)
+    new_start_times = start_times(new, new_story_names)
+    for key in old_start_times.keys() | new_start_times.keys():
+        old_times = old_start_times.get(key, set())
+        new_times = new_start_times.get(key, set())
+        for start_time in old_times - new_times:
+            yield Change('trip_start_time', 'removed', key + (start_time,), start_time, None)
+        for start_time in new_times - old_times:
+            yield Change('trip_start_time', 'added', key + (start_time,), None, start_time)
+
+
+def export_diff(changes, filename):
+    """Writes Change records to a csv file, returns the number of changes by (kind, change). The numbers are also
+    counted (as <kind>_<change>) in the export_diff stage."""
+    counts = defaultdict(lambda: 0)
+    with stage('export_diff'), open(filename, 'w', encoding='utf8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(Change._fields)
+        for change in changes:
+            counts[(change.kind, change.change)] += 1
+            writer.writerow(['' if value is None else
+                             (' '.join(str(v) for v in value) if isinstance(value, tuple) else value)
+                             for value in change])
+        for (kind, change), n in sorted(counts.items()):
+            count('%s_%s' % (kind, change), n)
+    return counts
+
+
+if __name__ == '__main__':
+    old_gtfs = ExtendedGTFS('data/gtfs/gtfs_2016_05_01')
+    new_gtfs = ExtendedGTFS('data/gtfs/gtfs_2016_05_25')
+    for gtfs in (old_gtfs, new_gtfs):
+        gtfs.load_stops()
+        gtfs.load_frequency_blocks()
+    export_diff(diff_snapshots(old_gtfs, new_gtfs), 'data/gtfs/diff_2016_05_01_2016_05_25.txt')
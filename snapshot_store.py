@@ -0,0 +1,271 @@
+"""
+ a deduplicated store for an archive of extended gtfs snapshots.
+
+ Consecutive snapshots share most of their stops, services and route stories, so each distinct record is kept only
+ once, in a table keyed by a hash of its content:
+
+   stops.txt                  full_stops records (the hash covers the whole record, including stop_id)
+   services.txt               calendar records (including service_id)
+   route_story_stops.txt      route story stops. Route story ids are allocated per snapshot, so the hash covers only
+                              the stops, and the same story has the same hash in every snapshot
+
+ Every table has an index file (<table>.idx: hash, byte offset, byte length) so records are read with a single seek.
+ Every snapshot has a folder snapshots/<yyyy-mm-dd> with manifests of the hashes it uses, and gzipped copies of
+ the tables that change every night (trips, routes, route story services and agencies).
+
+ StoredExtendedGTFS loads a snapshot from the store as a normal ExtendedGTFS. Snapshots loaded from the same
+ SnapshotStore object share their Stop, Service and RouteStoryStop objects.
+"""
+
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import zipfile
+from collections import defaultdict
+
+from ilgtfs import ExtendedGTFS, Agency, Service, FullStop, RouteStoryStop, RouteStory, read_fields, loads
+from instrumentation import stage, count
+
+stop_fields = ['stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon', 'location_type',
+               'parent_station', 'zone_id', 'nearest_train_station', 'train_station_distance', 'routes_here',
+               'nearest_stations', 'complex_id']
+service_fields = ['service_id', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+                  'start_date', 'end_date']
+route_story_stop_fields = ['arrival_offset', 'departure_offset', 'stop_id', 'pickup_type', 'drop_off_type']
+
+
+def content_hash(rows):
+    """Returns the hash of a list of csv rows (lists of strings)"""
+    h = hashlib.sha1()
+    for row in rows:
+        h.update(','.join(row).encode('utf8'))
+        h.update(b'\n')
+    return h.hexdigest()[:16]
+
+
+def write_csv_gz(filename, header, rows):
+    with gzip.open(filename, 'wt', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def read_csv_gz(filename):
+    """Returns the header and a list of the rows of a gzipped csv file"""
+    with gzip.open(filename, 'rt', encoding='utf8', newline='') as f:
+        reader = csv.reader(f)
+        return next(reader), list(reader)
+
+
+class HashedTable:
+    """An append-only csv table of records grouped by content hash, with a hash -> (offset, length) index"""
+
+    def __init__(self, folder, name, fields):
+        self.filename = os.path.join(folder, name + '.txt')
+        self.index_filename = os.path.join(folder, name + '.idx')
+        self.fields = fields
+        self.index = {}
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, encoding='utf8') as f:
+                for line in f:
+                    record_hash, offset, length = line.rstrip('\n').split(',')
+                    self.index[record_hash] = (int(offset), int(length))
+        elif not os.path.exists(self.filename):
+            with open(self.filename, 'w', encoding='utf8') as f:
+                f.write(','.join(fields) + '\n')
+
+    def __contains__(self, record_hash):
+        return record_hash in self.index
+
+    def add(self, groups):
+        """Appends the groups (a map from hash to a list of rows) that aren't in the table yet.
+        Returns the number of new groups."""
+        new_groups = [(record_hash, rows) for record_hash, rows in groups.items() if record_hash not in self.index]
+        if len(new_groups) == 0:
+            return 0
+        with open(self.filename, 'ab') as f, open(self.index_filename, 'a', encoding='utf8') as idx:
+            for record_hash, rows in new_groups:
+                out = io.StringIO()
+                csv.writer(out, lineterminator='\n').writerows(rows)
+                data = out.getvalue().encode('utf8')
+                offset = f.tell()
+                f.write(data)
+                self.index[record_hash] = (offset, len(data))
+                idx.write('%s,%d,%d\n' % (record_hash, offset, len(data)))
+        return len(new_groups)
+
+    def read(self, hashes):
+        """Returns a map from hash to a list of records (dicts from field name to value), for the given hashes"""
+        res = {}
+        with open(self.filename, 'rb') as f:
+            # reading in file order keeps the reads sequential
+            for record_hash in sorted(hashes, key=lambda h: self.index[h][0]):
+                offset, length = self.index[record_hash]
+                f.seek(offset)
+                lines = io.StringIO(f.read(length).decode('utf8'), newline='')
+                res[record_hash] = [dict(zip(self.fields, row)) for row in csv.reader(lines)]
+        return res
+
+
+class SnapshotStore:
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(os.path.join(folder, 'snapshots'), exist_ok=True)
+        self.stops = HashedTable(folder, 'stops', stop_fields)
+        self.services = HashedTable(folder, 'services', service_fields)
+        self.route_story_stops = HashedTable(folder, 'route_story_stops', route_story_stop_fields)
+        # objects shared between the snapshots loaded from this store, by hash
+        self.stop_objects = {}
+        self.service_objects = {}
+        self.route_story_stops_objects = {}
+
+    def snapshot_folder(self, snapshot_date):
+        return os.path.join(self.folder, 'snapshots', snapshot_date.strftime('%Y-%m-%d'))
+
+    def snapshots(self):
+        """Returns a sorted list of the dates of the snapshots in the store"""
+        return sorted(datetime.datetime.strptime(name, '%Y-%m-%d').date()
+                      for name in os.listdir(os.path.join(self.folder, 'snapshots')))
+
+    def add_snapshot(self, snapshot_date, gtfs_folder):
+        """Adds an extended gtfs snapshot (a folder with israel-public-transportation.zip, after running
+        gtfs_extender on it) to the store"""
+        with stage('add snapshot %s' % snapshot_date):
+            self._add_snapshot(snapshot_date, gtfs_folder)
+
+    def _add_snapshot(self, snapshot_date, gtfs_folder):
+        g = ExtendedGTFS(gtfs_folder)
+        out_folder = self.snapshot_folder(snapshot_date)
+        os.makedirs(out_folder, exist_ok=True)
+
+        def read_csv(f):
+            reader = csv.reader(f)
+            return next(reader), list(reader)
+
+        def by_fields(header, rows, fields):
+            positions = [header.index(field) for field in fields]
+            return [[row[i] for i in positions] for row in rows]
+
+        # stops and services: one record per hash
+        with open(g.full_stops_filename(), encoding='utf8') as f:
+            stops = {content_hash([row]): [row] for row in by_fields(*read_csv(f), stop_fields)}
+        with zipfile.ZipFile(g.filename) as z:
+            with z.open('calendar.txt') as f:
+                services = {content_hash([row]): [row]
+                            for row in by_fields(*read_csv(io.TextIOWrapper(f, 'utf8')), service_fields)}
+            with z.open('agency.txt') as f:
+                write_csv_gz(os.path.join(out_folder, 'agency.txt.gz'), *read_csv(io.TextIOWrapper(f, 'utf8')))
+
+        # route stories: the stops of each story, hashed without the route story id
+        story_rows = defaultdict(lambda: [])
+        with open(g.at_path(ExtendedGTFS.route_story_stops_files), encoding='utf8') as f:
+            header, rows = read_csv(f)
+            story_id_position = header.index('route_story_id')
+            for row, fields in zip(rows, by_fields(header, rows, route_story_stop_fields)):
+                story_rows[row[story_id_position]].append(fields)
+        route_story_hashes = {route_story_id: content_hash(rows) for route_story_id, rows in story_rows.items()}
+
+        count('new_stops', self.stops.add(stops))
+        count('new_services', self.services.add(services))
+        count('new_route_stories', self.route_story_stops.add({route_story_hashes[route_story_id]: rows
+                                                               for route_story_id, rows in story_rows.items()}))
+
+        write_csv_gz(os.path.join(out_folder, 'stops_manifest.txt.gz'), ['stop_hash'], ([h] for h in stops))
+        write_csv_gz(os.path.join(out_folder, 'services_manifest.txt.gz'), ['service_hash'], ([h] for h in services))
+        write_csv_gz(os.path.join(out_folder, 'route_stories_manifest.txt.gz'), ['route_story_id', 'route_story_hash'],
+                     sorted(route_story_hashes.items(), key=lambda x: int(x[0])))
+        for filename in [ExtendedGTFS.full_routes_filename, ExtendedGTFS.route_story_services_filename,
+                         os.path.basename(g.full_trips_filename())]:
+            with open(g.at_path(filename), encoding='utf8') as f:
+                write_csv_gz(os.path.join(out_folder, filename + '.gz'), *read_csv(f))
+
+    def load(self, snapshot_date):
+        """Returns a StoredExtendedGTFS for the snapshot"""
+        return StoredExtendedGTFS(self, snapshot_date)
+
+    def shared_objects(self, table, cache, hashes, make_object):
+        """Returns a list of the objects for hashes, creating (and caching) the ones that weren't loaded yet"""
+        missing = [h for h in hashes if h not in cache]
+        for record_hash, records in table.read(missing).items():
+            cache[record_hash] = make_object(records)
+        return [cache[h] for h in hashes]
+
+
+class StoredExtendedGTFS(ExtendedGTFS):
+    """An ExtendedGTFS loaded from a SnapshotStore"""
+
+    def __init__(self, store, snapshot_date):
+        super().__init__(store.snapshot_folder(snapshot_date))
+        self.store = store
+        self.snapshot_date = snapshot_date
+
+    def open_extended_file(self, filename):
+        return gzip.open(filename + '.gz', 'rt', encoding='utf8', newline='')
+
+    def has_extended_file(self, filename):
+        return os.path.exists(filename + '.gz')
+
+    def manifest(self, name):
+        return read_csv_gz(self.at_path(name + '_manifest.txt.gz'))[1]
+
+    @loads('agencies')
+    def load_agencies(self):
+        with stage('load agencies'), self.open_extended_file(self.at_path('agency.txt')) as f:
+            self.agencies = {agency.agency_id: agency for agency in
+                             (Agency.from_row(row) for row in read_fields(f, Agency.csv_fields))}
+            count('agencies', len(self.agencies))
+
+    @loads('services')
+    def load_services(self):
+        with stage('load services'):
+            hashes = [row[0] for row in self.manifest('services')]
+            services = self.store.shared_objects(self.store.services, self.store.service_objects, hashes,
+                                                 lambda records: Service.from_csv(records[0]))
+            self.services = {service.service_id: service for service in services}
+            count('services', len(self.services))
+
+    def load_extended_stops(self):
+        with stage('load full stops'):
+            hashes = [row[0] for row in self.manifest('stops')]
+            stops = self.store.shared_objects(self.store.stops, self.store.stop_objects, hashes,
+                                              lambda records: FullStop.from_csv(records[0]))
+            self.stops = {stop.stop_id: stop for stop in stops}
+            count('stops', len(self.stops))
+
+    @loads('route_stories', 'services')
+    def load_route_stories(self):
+        def make_stops(records):
+            # same order and stop_sequence as ExtendedGTFS.load_route_stories
+            stops = [RouteStoryStop(*(int(record[field]) if record[field] != '' else 0
+                                      for field in route_story_stop_fields)) for record in records]
+            stops.sort(key=lambda s: s.arrival_offset)
+            for stop_sequence, stop in enumerate(stops):
+                stop.stop_sequence = stop_sequence + 1
+            return stops
+
+        with stage('load route stories'):
+            manifest = self.manifest('route_stories')
+            stops = self.store.shared_objects(self.store.route_story_stops, self.store.route_story_stops_objects,
+                                              [row[1] for row in manifest], make_stops)
+            route_stories = {int(row[0]): RouteStory.from_tuple(int(row[0]), story_stops)
+                             for row, story_stops in zip(manifest, stops)}
+
+            with self.open_extended_file(self.at_path(self.route_story_services_filename)) as f:
+                for route_story_id, service_id in read_fields(f, ('route_story_id', 'service_id')):
+                    route_story_id, service_id = int(route_story_id), int(service_id)
+                    route_stories[route_story_id].services.add(self.services[service_id])
+
+            self.route_stories = route_stories
+
+            count('route_stories', len(self.route_stories))
+
+
+if __name__ == '__main__':
+    import archive_runner
+    archive_store = SnapshotStore('data/gtfs/store')
+    for date, folder in archive_runner.find_snapshots('data/gtfs'):
+        if date not in archive_store.snapshots():
+            archive_store.add_snapshot(date, folder)
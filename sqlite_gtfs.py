@@ -0,0 +1,250 @@
+"""
+ an sqlite backend for ExtendedGTFS.
+
+ import_extended_gtfs copies the gtfs tables we use and the extended tables into an sqlite database, indexed on
+ stop_id, route_story_id, service_id, route_id and nearest_train_station. SqliteExtendedGTFS serves stops, routes,
+ trips and route_stories from that database: objects are created (once) when they are accessed by id, so a script
+ that only needs a few stations starts immediately and stays small. Iterating over a table (values(), items()) reads
+ the whole table in one query, which is the bulk path for full network jobs.
+"""
+
+import csv
+import io
+import json
+import os
+import sqlite3
+import zipfile
+from collections.abc import Mapping
+
+from ilgtfs import ExtendedGTFS, Agency, Service, FullRoute, FullTrip, FullStop, RouteStoryStop, RouteStory
+from instrumentation import stage, count, message
+from train_to_bus import VisitsAtStop
+
+default_db_filename = 'extended_gtfs.sqlite'
+
+# table name -> (source file, list of (column, type)); sources in the zip file are marked with 'zip:'
+# columns with INTEGER type are the ids we join and index on; everything else is kept as the text in the csv file,
+# so the ilgtfs from_csv methods create the same objects as when reading the csv files
+tables = {
+    'agency': ('zip:agency.txt', [('agency_id', 'INTEGER'), ('agency_name', 'TEXT')]),
+    'calendar': ('zip:calendar.txt', [('service_id', 'INTEGER'), ('sunday', 'TEXT'), ('monday', 'TEXT'),
+                                      ('tuesday', 'TEXT'), ('wednesday', 'TEXT'), ('thursday', 'TEXT'),
+                                      ('friday', 'TEXT'), ('saturday', 'TEXT'), ('start_date', 'TEXT'),
+                                      ('end_date', 'TEXT')]),
+    'full_routes': (ExtendedGTFS.full_routes_filename,
+                    [('route_id', 'INTEGER'), ('agency_id', 'INTEGER'), ('route_short_name', 'TEXT'),
+                     ('route_long_name', 'TEXT'), ('route_desc', 'TEXT'), ('route_type', 'INTEGER'),
+                     ('route_stories', 'TEXT')]),
+    'full_trips': ('full_trips.txt', [('route_id', 'INTEGER'), ('service_id', 'INTEGER'), ('trip_id', 'TEXT'),
+                                      ('direction_id', 'TEXT'), ('shape_id', 'TEXT'), ('start_time', 'TEXT'),
+                                      ('route_story', 'INTEGER')]),
+    'full_stops': ('full_stops.txt', [('stop_id', 'INTEGER'), ('stop_code', 'TEXT'), ('stop_name', 'TEXT'),
+                                      ('stop_desc', 'TEXT'), ('stop_lat', 'TEXT'), ('stop_lon', 'TEXT'),
+                                      ('location_type', 'TEXT'), ('parent_station', 'TEXT'), ('zone_id', 'TEXT'),
+                                      ('nearest_train_station', 'INTEGER'), ('train_station_distance', 'INTEGER'),
+                                      ('routes_here', 'TEXT'), ('nearest_stations', 'TEXT'),
+                                      ('complex_id', 'INTEGER')]),
+    'route_story_stops': (ExtendedGTFS.route_story_stops_files,
+                          [('route_story_id', 'INTEGER'), ('arrival_offset', 'TEXT'), ('departure_offset', 'TEXT'),
+                           ('stop_id', 'INTEGER'), ('pickup_type', 'TEXT'), ('drop_off_type', 'TEXT')]),
+    'route_story_services': (ExtendedGTFS.route_story_services_filename,
+                             [('route_story_id', 'INTEGER'), ('service_id', 'INTEGER')]),
+}
+
+indexes = [
+    ('agency', 'agency_id', True),
+    ('calendar', 'service_id', True),
+    ('full_routes', 'route_id', True),
+    ('full_trips', 'trip_id', True),
+    ('full_trips', 'route_id', False),
+    ('full_trips', 'service_id', False),
+    ('full_trips', 'route_story', False),
+    ('full_stops', 'stop_id', True),
+    ('full_stops', 'nearest_train_station', False),
+    ('full_stops', 'complex_id', False),
+    ('route_story_stops', 'route_story_id', False),
+    ('route_story_stops', 'stop_id', False),
+    ('route_story_services', 'route_story_id', False),
+    ('route_story_services', 'service_id', False),
+]
+
+
+def import_extended_gtfs(folder, db_filename=None):
+    """Creates an sqlite database from the extended gtfs in folder (after running gtfs_extender on it).
+    Returns the database file name."""
+    g = ExtendedGTFS(folder)
+    db_filename = db_filename or g.at_path(default_db_filename)
+    if os.path.exists(db_filename):
+        os.remove(db_filename)
+    message("Importing %s into %s" % (folder, db_filename))
+    with stage('import_extended_gtfs'), sqlite3.connect(db_filename) as db, zipfile.ZipFile(g.filename) as z:
+        for table, (source, columns) in tables.items():
+            db.execute('CREATE TABLE %s (%s)' % (table, ', '.join('%s %s' % column for column in columns)))
+            if source.startswith('zip:'):
+                f = io.TextIOWrapper(z.open(source[len('zip:'):]), 'utf8')
+            else:
+                f = open(g.at_path(source), encoding='utf8')
+            with f:
+                reader = csv.reader(f)
+                header = next(reader)
+                # full_routes.txt header says route_stories while older files say trip_stories
+                header = ['route_stories' if field == 'trip_stories' else field for field in header]
+                positions = [header.index(name) for name, _ in columns]
+                db.executemany('INSERT INTO %s VALUES (%s)' % (table, ','.join('?' * len(columns))),
+                               ([row[i] for i in positions] for row in reader))
+            count('%s_records' % table, db.execute('SELECT count(*) FROM %s' % table).fetchone()[0])
+        for table, column, unique in indexes:
+            db.execute('CREATE %s INDEX %s_%s ON %s (%s)' % ('UNIQUE' if unique else '', table, column, table, column))
+    return db_filename
+
+
+class SqliteTable(Mapping):
+    """A read only dictionary from id to object, backed by an sqlite table.
+
+    Objects are created on first access and cached; iterating over the table loads all of it in one query.
+    """
+
+    def __init__(self, db, table, key, make_object, key_type=int):
+        self.db = db
+        self.table = table
+        self.key = key
+        self.make_object = make_object
+        self.key_type = key_type
+        self.cache = {}
+        self.fully_loaded = False
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            if self.fully_loaded:
+                raise KeyError(key)
+            rows = self.db.execute('SELECT * FROM %s WHERE %s = ?' % (self.table, self.key), (key,)).fetchall()
+            if len(rows) == 0:
+                raise KeyError(key)
+            self.cache[key] = self.make_object(rows)
+        return self.cache[key]
+
+    def get_many(self, keys):
+        """Returns a map from key to object for the keys that exist, querying all the missing keys together"""
+        missing = [key for key in set(keys) if key not in self.cache]
+        if len(missing) > 0 and not self.fully_loaded:
+            self.load_rows(self.db.execute('SELECT * FROM %s WHERE %s IN (SELECT value FROM json_each(?))' %
+                                           (self.table, self.key), (json.dumps(missing),)))
+        return {key: self.cache[key] for key in keys if key in self.cache}
+
+    def load_rows(self, rows):
+        rows_by_key = {}
+        for row in rows:
+            rows_by_key.setdefault(self.key_type(row[self.key]), []).append(row)
+        for key, key_rows in rows_by_key.items():
+            if key not in self.cache:
+                self.cache[key] = self.make_object(key_rows)
+
+    def load_all(self):
+        if not self.fully_loaded:
+            self.load_rows(self.db.execute('SELECT * FROM %s ORDER BY rowid' % self.table))
+            self.fully_loaded = True
+
+    def __iter__(self):
+        self.load_all()
+        return iter(self.cache)
+
+    def __len__(self):
+        if self.fully_loaded:
+            return len(self.cache)
+        return self.db.execute('SELECT count(DISTINCT %s) FROM %s' % (self.key, self.table)).fetchone()[0]
+
+    def __contains__(self, key):
+        if key in self.cache:
+            return True
+        if self.fully_loaded:
+            return False
+        return self.db.execute('SELECT 1 FROM %s WHERE %s = ? LIMIT 1' % (self.table, self.key),
+                               (key,)).fetchone() is not None
+
+
+class SqliteExtendedGTFS(ExtendedGTFS):
+    """An ExtendedGTFS whose tables are read lazily from an sqlite database created by import_extended_gtfs"""
+
+    def __init__(self, folder, db_filename=None):
+        super().__init__(folder)
+        self.db = sqlite3.connect(db_filename or self.at_path(default_db_filename), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+
+        def make_route_story(rows):
+            # same order and stop_sequence as ExtendedGTFS.load_route_stories
+            stops = [RouteStoryStop.from_csv(row)[1] for row in rows]
+            stops.sort(key=lambda s: s.arrival_offset)
+            for stop_sequence, stop in enumerate(stops):
+                stop.stop_sequence = stop_sequence + 1
+            route_story = RouteStory.from_tuple(rows[0]['route_story_id'], stops)
+            service_ids = self.db.execute('SELECT service_id FROM route_story_services WHERE route_story_id = ?',
+                                          (route_story.route_story_id,))
+            route_story.services.update(self.services[row[0]] for row in service_ids)
+            return route_story
+
+        self.agencies = SqliteTable(self.db, 'agency', 'agency_id', lambda rows: Agency.from_csv(rows[0]))
+        self.services = SqliteTable(self.db, 'calendar', 'service_id', lambda rows: Service.from_csv(rows[0]))
+        self.routes = SqliteTable(self.db, 'full_routes', 'route_id',
+                                  lambda rows: FullRoute.from_csv(rows[0], self.agencies))
+        self.stops = SqliteTable(self.db, 'full_stops', 'stop_id', lambda rows: FullStop.from_csv(rows[0]))
+        self.route_stories = SqliteTable(self.db, 'route_story_stops', 'route_story_id', make_route_story)
+        self.trips = SqliteTable(self.db, 'full_trips', 'trip_id',
+                                 lambda rows: FullTrip.from_csv(rows[0], self.routes, self.services,
+                                                                self.route_stories),
+                                 key_type=str)
+
+    # the tables are created in __init__, loading is done lazily by the tables themselves
+    def load_agencies(self):
+        pass
+
+    def load_services(self):
+        pass
+
+    def load_routes(self):
+        pass
+
+    def load_all(self):
+        """Bulk loads all the tables"""
+        for table in [self.agencies, self.services, self.routes, self.stops, self.route_stories, self.trips]:
+            table.load_all()
+
+    def station_stop_ids(self, station_id, max_distance_from_station=500):
+        """Returns the ids of the stops that their nearest train station is station_id, up to the given distance"""
+        rows = self.db.execute('SELECT stop_id FROM full_stops WHERE nearest_train_station = ? AND '
+                               'train_station_distance <= ?', (station_id, max_distance_from_station))
+        return {row[0] for row in rows}
+
+    def visits_at_stop(self, stop_ids, start_date, end_date):
+        """Like train_to_bus.visits_at_stop, but only reads the trips that stop at stop_ids"""
+        stop_ids = list(stop_ids)
+        story_ids = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT route_story_id FROM route_story_stops WHERE stop_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(stop_ids),))]
+        trip_ids = [row[0] for row in self.db.execute(
+            'SELECT trip_id FROM full_trips WHERE route_story IN (SELECT value FROM json_each(?))',
+            (json.dumps(story_ids),))]
+        trips = self.trips.get_many(trip_ids)
+
+        stop_ids = set(stop_ids)
+        result = []
+        for trip in trips.values():
+            if trip.service.end_date < start_date or trip.service.start_date > end_date:
+                continue
+            for day in trip.service.days:
+                for route_story_stop in trip.route_story.stops:
+                    if route_story_stop.stop_id in stop_ids:
+                        result.append(VisitsAtStop(day,
+                                                   trip.start_time + route_story_stop.arrival_offset,
+                                                   trip.start_time + route_story_stop.departure_offset,
+                                                   trip.route,
+                                                   route_story_stop.stop_id))
+        return result
+
+
+if __name__ == '__main__':
+    import datetime
+    import_extended_gtfs('data/gtfs/gtfs_2016_05_25')
+    gtfs = SqliteExtendedGTFS('data/gtfs/gtfs_2016_05_25')
+    # Tel Aviv Savidor center
+    stops = gtfs.station_stop_ids(37358, 300) | {37358}
+    print("%d visits" % len(gtfs.visits_at_stop(stops, datetime.date(2016, 6, 1), datetime.date(2016, 6, 7))))
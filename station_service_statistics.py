@@ -8,6 +8,8 @@ from datetime import date
 from collections import namedtuple
 import csv
 from geo import GeoPoint
+from instrumentation import stage, count
+from result_cache import cached_result
 
 StationStop = namedtuple('StationStop', ['station_stop_id', 'story_stop_sequence'])
 
@@ -21,6 +23,16 @@ def stops_distance(g, stop_id1, stop_id2):
     return p1.distance_to(p2)
 
 
+def nearest_station(g, stop_id, station_ids):
+    """Returns the nearest of station_ids to the stop, using the nearest stations of the stop in full_stops"""
+    station_id = g.stops[stop_id].nearest_of_stations(station_ids)
+    if station_id is None:
+        # the stop is too far from all of station_ids for them to be in its nearest stations
+        count('stops_far_from_stations')
+        station_id = min((stops_distance(g, station_id, stop_id), station_id) for station_id in station_ids)[1]
+    return station_id
+
+
 def train_station_stops(g, route_story, max_station_distance=500):
     """ Returns a map from station_id (stop_id of a  train station), for each station the bus passes by to the id of the
     nearest bus stop. route_story is expected to be a route story of a bus route.
@@ -57,11 +69,8 @@ def route_story_time_to_station(g, route_story):
     if len(station_to_stop) == 1:
         stations = list(station_to_stop.keys()) * len(route_story.stops)
     else:
-        stations = []
-        for route_story_stop in route_story.stops:
-            station_distances = sorted((stops_distance(g, station_id, route_story_stop.stop_id), station_id)
-                                       for station_id in station_to_stop)
-            stations.append(station_distances[0][1])
+        stations = [nearest_station(g, route_story_stop.stop_id, station_to_stop)
+                    for route_story_stop in route_story.stops]
 
     to_station = []
     for route_story_stop, station_id in zip(route_story.stops, stations):
@@ -80,60 +89,79 @@ def route_story_time_to_station(g, route_story):
     return to_station, stations
 
 
+@cached_result()
 def route_story_weekly_trip(g, start_date, end_date, weekdays_only):
     """Returns a map from route_story_id, to the weekly trips of that route_story, between the specified dates"""
-    res = defaultdict(lambda: 0)
-    for trip in g.trips.values():
-        if trip.service.end_date >= start_date and trip.service.start_date <= end_date:
+    res = defaultdict(int)
+    for block in g.trip_blocks():
+        if block.service.end_date >= start_date and block.service.start_date <= end_date:
             if weekdays_only:
-                days = len(trip.service.days.intersection(weekdays))
+                days = len(block.service.days.intersection(weekdays))
             else:
-                days = len(trip.service.days)
-            res[trip.route_story.route_story_id] += days
+                days = len(block.service.days)
+            res[block.route_story.route_story_id] += days * len(block)
     return res
 
 
 # and which stops in the trip story are the stops near the trains station?
+def route_story_station_stops(g, route_story, max_station_distance=500, ignore_stations=None):
+    """Returns a list of (station_id, route story stop) of the stops of the route story near train stations"""
+    stops_near_station = [stop for stop in route_story.stops
+                          if g.stops[stop.stop_id].train_station_distance <= max_station_distance]
+    # set of train stations that the trip passes
+    stations = {g.stops[stop.stop_id].nearest_train_station_id for stop in stops_near_station}
+    if ignore_stations is not None:
+        stations.difference_update(ignore_stations)
+    res = []
+    for station in stations:
+        # find all the trip stops near this train station
+        stops_near_this_station = [stop for stop in stops_near_station
+                                   if g.stops[stop.stop_id].nearest_train_station_id == station]
+        # sort by the distance from the the train station
+        sorted_stops = list(sorted(stops_near_this_station,
+                                   key=lambda s: g.stops[s.stop_id].train_station_distance))
+        # we want to only take the nearest stop to the train station
+        # however there are some weird corner cases of circular bus routes that stop at the same stop
+        # by a train station on both directions of the of on trip
+        # we want to return both those stops
+        res += [(station, stop) for stop in sorted_stops if stop.stop_id == sorted_stops[0].stop_id]
+    return res
+
+
+def _encode_train_trips(train_trips):
+    return {trip.trip_id: [(station_id, stop.stop_sequence) for station_id, stop in stops]
+            for trip, stops in train_trips.items()}
+
+
+def _decode_train_trips(g, stored):
+    res = {}
+    for trip_id, stops in stored.items():
+        trip = g.trips[trip_id]
+        res[trip] = [(station_id, trip.route_story.stops[stop_sequence - 1]) for station_id, stop_sequence in stops]
+    return res
+
+
+@cached_result(_encode_train_trips, _decode_train_trips)
 def by_train_trips(g, start_date, end_date, max_station_distance=500, ignore_stations=None):
     """Returns a map from trip to a list of StationStop objects"""
 
     def station_stops(trip):
-        stops_near_station = [stop for stop in trip.route_story.stops
-                              if g.stops[stop.stop_id].train_station_distance <= max_station_distance]
-        # set of train stations that the trip passes
-        stations = {g.stops[stop.stop_id].nearest_train_station_id for stop in stops_near_station}
-        if ignore_stations is not None:
-            stations.difference_update(ignore_stations)
-        res = []
-        for station in stations:
-            # find all the trip stops near this train station
-            stops_near_this_station = [stop for stop in stops_near_station
-                                       if g.stops[stop.stop_id].nearest_train_station_id == station]
-            # sort by the distance from the the train station
-            sorted_stops = list(sorted(stops_near_this_station,
-                                       key=lambda s: g.stops[s.stop_id].train_station_distance))
-            # we want to only take the nearest stop to the train station
-            # however there are some weird corner cases of circular bus routes that stop at the same stop
-            # by a train station on both directions of the of on trip
-            # we want to return both those stops
-            res += [(station, stop) for stop in sorted_stops if stop.stop_id == sorted_stops[0].stop_id]
-        return res
+        return route_story_station_stops(g, trip.route_story, max_station_distance, ignore_stations)
 
-    print("Running by_train_trips")
-    bus_trips = [trip for trip in g.trips.values() if trip.route.route_type == 3]
-    print('  number of bus trips: %d' % len(bus_trips))
-    bus_trips_in_dates = [trip for trip in bus_trips if
-                          trip.service.end_date >= start_date and trip.service.start_date <= end_date]
-    print('  number of bus trips in date range: %d' % len(bus_trips_in_dates))
-    trips_and_stops = ((trip, station_stops(trip)) for trip in bus_trips_in_dates)
+    with stage('by_train_trips'):
+        bus_trips = [trip for trip in g.trips.values() if trip.route.route_type == 3]
+        count('bus_trips', len(bus_trips))
+        bus_trips_in_dates = [trip for trip in bus_trips if
+                              trip.service.end_date >= start_date and trip.service.start_date <= end_date]
+        count('bus_trips_in_date_range', len(bus_trips_in_dates))
+        trips_and_stops = ((trip, station_stops(trip)) for trip in bus_trips_in_dates)
 
-    return {trip: stops for (trip, stops) in trips_and_stops if len(stops) > 0}
+        return {trip: stops for (trip, stops) in trips_and_stops if len(stops) > 0}
 
 
 # station_hourly_data Dict[int, Tuple[int, int]] - dictionary from station id to (hour, count)
 def export_station_hourly_data(g, station_hourly_data, output_filename):
-    print("Running export_station_hourly_data")
-    with open(output_filename, 'w', encoding='utf8') as f:
+    with stage('export_station_hourly_data'), open(output_filename, 'w', encoding='utf8') as f:
         field_names = ['station_stop_id', 'station_name', 'daily_total'] + [('h%d' % h) for h in range(26)]
         f.write(','.join(field_names) + '\n')
         for station_id in station_hourly_data:
@@ -148,7 +176,6 @@ def export_station_hourly_data(g, station_hourly_data, output_filename):
 #    for each station, a counter of (day, hour) pairs
 # returns -  dictionary from station id to (hour, count)
 def station_hourly_average_sun_to_thurs(counters):
-    print("Running station_hourly_average_sun_to_thurs")
     result = {}
     for station in counters:
         result[station] = []
@@ -158,35 +185,51 @@ def station_hourly_average_sun_to_thurs(counters):
     return result
 
 
+@cached_result()
 def bus_station_visits(g, start_date, end_date, max_distance_from_station=500):
-    print("Running bus_station_visits")
-    trips = by_train_trips(g, start_date, end_date, max_distance_from_station)
-    print("  number of bus trips that pass by stations: %d" % len(trips))
-    station_to_hourly_counter = defaultdict(lambda: Counter())
-    for trip, stops_near_stations in trips.items():
-        for station_id, route_story_stop in stops_near_stations:
-            hour = (trip.start_time + route_story_stop.arrival_offset) // 3600
-            for day in trip.service.days:
-                station_to_hourly_counter[station_id][(day, hour)] += 1
-    print("  done. found data for %d stations" % len(station_to_hourly_counter))
-    return station_to_hourly_counter
+    """Returns, for each station, a counter of bus visits by (day, hour). Works on the frequency blocks if they are
+    loaded, otherwise on the trips."""
+    with stage('bus_station_visits'):
+        blocks = [block for block in g.trip_blocks() if block.route.route_type == 3 and
+                  block.service.end_date >= start_date and block.service.start_date <= end_date]
+        story_station_stops = {}
+        trips = 0
+        station_to_hourly_counter = defaultdict(Counter)
+        for block in blocks:
+            route_story_id = block.route_story.route_story_id
+            if route_story_id not in story_station_stops:
+                story_station_stops[route_story_id] = route_story_station_stops(g, block.route_story,
+                                                                                max_distance_from_station)
+            if len(story_station_stops[route_story_id]) == 0:
+                continue
+            trips += len(block)
+            for station_id, route_story_stop in story_station_stops[route_story_id]:
+                for hour, hour_trips in block.hourly_counts(route_story_stop.arrival_offset).items():
+                    for day in block.service.days:
+                        station_to_hourly_counter[station_id][(day, hour)] += hour_trips
+        count('bus_trips_by_stations', trips)
+        count('stations', len(station_to_hourly_counter))
+        return station_to_hourly_counter
 
 
+@cached_result()
 def train_station_visits(g, start_date, end_date):
-    print("Running train_station_visits")
-    train_trips = (trip for trip in g.trips.values() if trip.route.route_type == 2)
-    train_trips = [trip for trip in train_trips if
-                   trip.service.end_date >= start_date and trip.service.start_date <= end_date]
-    print("There are %s trips in the date span" % len(train_trips))
-    print("Building hourly data dict")
-    station_to_hourly_counter = defaultdict(lambda: Counter())
-    for trip in train_trips:
-        for stop in trip.route_story.stops:
-            hour = (trip.start_time + stop.arrival_offset) // 3600
-            for day in trip.service.days:
-                station_to_hourly_counter[g.stops[stop.stop_id].nearest_train_station_id][(day, hour)] += 1
-    print("  done. found data for %d stations" % len(station_to_hourly_counter))
-    return station_to_hourly_counter
+    """Returns, for each station, a counter of train arrivals by (day, hour). Works on the frequency blocks if they
+    are loaded, otherwise on the trips."""
+    with stage('train_station_visits'):
+        train_blocks = (block for block in g.trip_blocks() if block.route.route_type == 2)
+        train_blocks = [block for block in train_blocks if
+                        block.service.end_date >= start_date and block.service.start_date <= end_date]
+        count('train_trips_in_date_range', sum(len(block) for block in train_blocks))
+        station_to_hourly_counter = defaultdict(Counter)
+        for block in train_blocks:
+            for stop in block.route_story.stops:
+                station_id = g.stops[stop.stop_id].nearest_train_station_id
+                for hour, hour_trips in block.hourly_counts(stop.arrival_offset).items():
+                    for day in block.service.days:
+                        station_to_hourly_counter[station_id][(day, hour)] += hour_trips
+        count('stations', len(station_to_hourly_counter))
+        return station_to_hourly_counter
 
 
 def export_bus_station_visits(g, station_to_hourly_counter, start_date, end_date):
@@ -202,13 +245,12 @@ def export_train_station_visits(g, station_to_hourly_counter, start_date, end_da
 
 
 def stops_connected_to_stations_map(g, start_date, end_date, ignore_stations, station_offset_range, min_daily_visits=5):
-    print("stops_connected_to_stations_map starting")
     ResultRecord = namedtuple('ResultRecord', ['station_id', 'weekly_visits', 'routes'])
 
     def build_stop_data():
         route_story_frequency = route_story_weekly_trip(g, start_date, end_date, weekdays_only=True)
-        print("   len(g.route_stories)=%d" % len(g.route_stories))
-        print("   len(route_story_frequency)=%d" % len(route_story_frequency))
+        count('route_stories', len(g.route_stories))
+        count('route_stories_with_trips', len(route_story_frequency))
 
         route_story_id_to_route = {route_story_id: route
                                    for route in g.routes.values()
@@ -244,9 +286,9 @@ def stops_connected_to_stations_map(g, start_date, end_date, ignore_stations, st
                                           {route_story_id_to_route[route_story_id]})
                 res[(route_story_stop.stop_id, station_id)] = record
 
-        print("   route_with_weekday_trips=%d" % route_with_weekday_trips)
-        print("   route_going_through_station=%d" % route_going_through_station)
-        print("   number of stops on those routes=%d" % len(res))
+        count('route_with_weekday_trips', route_with_weekday_trips)
+        count('route_going_through_station', route_going_through_station)
+        count('stops_on_those_routes', len(res))
         return res
 
     def select_station(built_stop_data):
@@ -255,23 +297,20 @@ def stops_connected_to_stations_map(g, start_date, end_date, ignore_stations, st
             tmp[stop_id].add(station_id)
         res = {}
         for stop_id in tmp.keys():
-            station_distances = sorted((stops_distance(g, stop_id, station_id), station_id)
-                                       for station_id in tmp[stop_id])
-            res[stop_id] = built_stop_data[(stop_id, station_distances[0][1])]
+            res[stop_id] = built_stop_data[(stop_id, nearest_station(g, stop_id, tmp[stop_id]))]
         return res
 
     def prepare_for_export(for_export):
-        print("   preparing for export, number of stops=%d" % len(for_export))
+        count('stops_before_filtering', len(for_export))
         res1 = {stop_id: record for (stop_id, record) in for_export.items() if record.station_id not in ignore_stations}
-        print("   stops near non ignore stations=%d" % len(res1))
+        count('stops_near_non_ignored_stations', len(res1))
         res2 = {stop_id: record for (stop_id, record) in for_export.items() if record.weekly_visits >= 25}
-        print("   stops with at least 25 weekly visits=%d" % len(res2))
+        count('stops_with_25_weekly_visits', len(res2))
         res = {stop_id: record for (stop_id, record) in res1.items() if stop_id in res2.keys()}
-        print("   stops fulfilling both conditions=%d" % len(res))
+        count('stops_for_export', len(res))
         return res
 
     def export(file_name, for_export):
-        print("   exporting")
         fields = ['station_id', 'station_name', 'stop_id', 'stop_name', 'line_numbers', 'daily_visits',
                   'latitude', 'longitude']
         with open(file_name, 'w', encoding='utf8') as f:
@@ -288,9 +327,14 @@ def stops_connected_to_stations_map(g, start_date, end_date, ignore_stations, st
                         'latitude': g.stops[stop_id].stop_lat,
                         'longitude': g.stops[stop_id].stop_lon}
                 writer.writerow(data)
-        print("Done.")
 
-    export(g.at_path('30_min_to_station.txt'), prepare_for_export(select_station(build_stop_data())))
+    with stage('stops_connected_to_stations_map'):
+        with stage('build stop data'):
+            stop_data = build_stop_data()
+        with stage('select station'):
+            stop_data = select_station(stop_data)
+        with stage('export'):
+            export(g.at_path('30_min_to_station.txt'), prepare_for_export(stop_data))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+"""
+ time of day dependent travel times between bus stops and the train stations they lead to.
+
+ route_story_time_to_station gives every stop of a route story a single offset to the station, whatever the time and
+ however often the route runs. Here every (stop, station) pair of a bus route story that stops near the station (the
+ stop nearest to the station, see station_service_statistics.route_story_station_stops), up to max_ride seconds apart,
+ gets two values for every time bin (bin_seconds long, from the start of the service day) over all the trips of the
+ date range:
+
+   to_station    the time from the start of the bin to the earliest arrival at the station, by a trip that leaves the
+                 stop in the bin or later (the wait and the ride)
+   from_station  the time from the latest departure from the station, by a trip that arrives at the stop by the end of
+                 the bin, to the end of the bin
+
+ Each is computed in one sweep: the (row, time at the first stop, time at the second stop) events of all the trips are
+ packed into integers and sorted, and each row is swept once (backwards for to_station, keeping the earliest arrival
+ so far; forwards for from_station, keeping the latest departure) while filling its bins. The values are 16 bit
+ seconds (no_trip where there's none), time_bins per row, by row order, so the travel times of all the pairs in a
+ time bin are the slice times[bin::time_bins]; a catchment map of a station at any time of day reads that slice.
+
+ The pairs are saved to station_travel_times_<start>_<end>.txt and the two arrays (to_station, then from_station) to
+ station_travel_times_<start>_<end>.bin.
+
+   python station_travel_times.py data/gtfs/gtfs_2016_06_09 2016-06-01 2016-06-14 [--catchment 07:30]
+"""
+
+import argparse
+import csv
+import datetime
+import itertools
+from array import array
+
+from ilgtfs import ExtendedGTFS, read_fields, parse_timestamp, format_timestamp
+from instrumentation import stage, count, progress
+from station_service_statistics import route_story_station_stops, weekdays
+from travel_time_profiles import TravelTimeProfiles
+
+bin_seconds = 15 * 60
+time_bins = 30 * 60 * 60 // bin_seconds
+default_max_ride = 60 * 60
+default_max_time = 30 * 60
+no_trip = 65535
+
+# an event is row << event_row_shift | first time << event_time_bits | second time
+event_time_bits = 18
+event_row_shift = 2 * event_time_bits
+event_time_mask = (1 << event_time_bits) - 1
+
+
+def time_bin(t):
+    return min(t // bin_seconds, time_bins - 1)
+
+
+def story_pairs(g, route_story, max_station_distance, max_ride):
+    """Returns two lists of (stop_id, station_id, stop index, station stop index) of a route story: the stops from
+    which the route goes to a station (boarding at the stop, alighting at the station) and the stops it goes to from a
+    station, max_ride seconds or less apart"""
+    to_station, from_station = [], []
+    stops = route_story.stops
+    for station_id, station_stop in route_story_station_stops(g, route_story, max_station_distance):
+        j = station_stop.stop_sequence - 1
+        for i, stop in enumerate(stops):
+            if stop.stop_id == station_stop.stop_id:
+                continue
+            if i < j and stop.pickup_type != 1 and station_stop.drop_off_type != 1 and \
+                    station_stop.arrival_offset - stop.departure_offset <= max_ride:
+                to_station.append((stop.stop_id, station_id, i, j))
+            elif i > j and station_stop.pickup_type != 1 and stop.drop_off_type != 1 and \
+                    stop.arrival_offset - station_stop.departure_offset <= max_ride:
+                from_station.append((stop.stop_id, station_id, i, j))
+    return to_station, from_station
+
+
+def stop_times(route_story, start_times, profiles=None):
+    """Returns the arrival and the departure times at every stop of the route story (as lists of arrays) of the trips
+    that start at start_times: planned, or from the travel time profiles (keeping the planned dwell times)"""
+    stops = route_story.stops
+    if profiles is None:
+        arrivals = [array('i', (start_time + stop.arrival_offset for start_time in start_times)) for stop in stops]
+    else:
+        arrivals = profiles.arrival_times(route_story, start_times)
+    departures = [times if stop.departure_offset == stop.arrival_offset else
+                  array('i', (t + stop.departure_offset - stop.arrival_offset for t in times))
+                  for stop, times in zip(stops, arrivals)]
+    return arrivals, departures
+
+
+def earliest_arrivals(events, rows):
+    """Returns the to_station array of sorted (row, departure, arrival) events"""
+    res = array('H', [no_trip]) * (rows * time_bins)
+    for row, row_events in itertools.groupby(reversed(events), lambda event: event >> event_row_shift):
+        base = row * time_bins
+        best = None
+        b = time_bins - 1
+        for event in row_events:
+            departure = (event >> event_time_bits) & event_time_mask
+            # the bins that start after this departure get the earliest arrival of the later departures
+            while b >= 0 and b * bin_seconds > departure:
+                if best is not None:
+                    res[base + b] = min(best - b * bin_seconds, no_trip - 1)
+                b -= 1
+            arrival = event & event_time_mask
+            if best is None or arrival < best:
+                best = arrival
+        while b >= 0:
+            res[base + b] = min(best - b * bin_seconds, no_trip - 1)
+            b -= 1
+    return res
+
+
+def latest_departures(events, rows):
+    """Returns the from_station array of sorted (row, arrival, departure) events"""
+    res = array('H', [no_trip]) * (rows * time_bins)
+    for row, row_events in itertools.groupby(events, lambda event: event >> event_row_shift):
+        base = row * time_bins
+        best = None
+        b = 0
+        for event in row_events:
+            arrival = (event >> event_time_bits) & event_time_mask
+            # the bins that end before this arrival get the latest departure of the earlier arrivals
+            while b < time_bins and (b + 1) * bin_seconds < arrival:
+                if best is not None:
+                    res[base + b] = min((b + 1) * bin_seconds - best, no_trip - 1)
+                b += 1
+            departure = event & event_time_mask
+            if best is None or departure > best:
+                best = departure
+        while b < time_bins:
+            res[base + b] = min((b + 1) * bin_seconds - best, no_trip - 1)
+            b += 1
+    return res
+
+
+class StationTravelTimes:
+    def __init__(self, pairs, to_station, from_station):
+        """pairs is a sorted list of (stop_id, station_id); to_station and from_station have time_bins values for
+        every pair, in the same order"""
+        self.pairs = pairs
+        self.to_station = to_station
+        self.from_station = from_station
+        self.pair_rows = {pair: row for row, pair in enumerate(pairs)}
+        self.station_rows = {}
+        for row, (_, station_id) in enumerate(pairs):
+            self.station_rows.setdefault(station_id, []).append(row)
+
+    def profile(self, stop_id, station_id, to_station=True):
+        """Returns the travel times of a pair in every time bin, or None if there's no such pair"""
+        row = self.pair_rows.get((stop_id, station_id))
+        if row is None:
+            return None
+        times = self.to_station if to_station else self.from_station
+        return times[row * time_bins:(row + 1) * time_bins]
+
+    def at_time(self, t, to_station=True):
+        """Returns the travel times of all the pairs (in pairs order) in the time bin of t"""
+        times = self.to_station if to_station else self.from_station
+        return times[time_bin(t)::time_bins]
+
+    def catchment(self, station_id, t, max_time=default_max_time, to_station=True):
+        """Returns a map from stop_id to the travel time to the station (or from it) in the time bin of t, for the
+        stops within max_time seconds"""
+        times = self.to_station if to_station else self.from_station
+        b = time_bin(t)
+        res = {}
+        for row in self.station_rows.get(station_id, ()):
+            if times[row * time_bins + b] <= max_time:
+                res[self.pairs[row][0]] = times[row * time_bins + b]
+        return res
+
+    def save(self, g, start_date, end_date):
+        name = filename(start_date, end_date)
+        with open(g.at_path(name + '.txt'), 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['stop_id', 'station_id'])
+            writer.writerows(self.pairs)
+        with open(g.at_path(name + '.bin'), 'wb') as f:
+            self.to_station.tofile(f)
+            self.from_station.tofile(f)
+
+    @classmethod
+    def load(cls, g, start_date, end_date):
+        name = filename(start_date, end_date)
+        with open(g.at_path(name + '.txt'), encoding='utf8') as f:
+            pairs = [(int(stop_id), int(station_id)) for stop_id, station_id in read_fields(f, ('stop_id',
+                                                                                                 'station_id'))]
+        to_station, from_station = array('H'), array('H')
+        with open(g.at_path(name + '.bin'), 'rb') as f:
+            to_station.fromfile(f, len(pairs) * time_bins)
+            from_station.fromfile(f, len(pairs) * time_bins)
+        return cls(pairs, to_station, from_station)
+
+
+def filename(start_date, end_date):
+    return 'station_travel_times_%s_%s' % (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+
+
+def build_station_travel_times(g, start_date, end_date, weekdays_only=True, max_station_distance=500,
+                               max_ride=default_max_ride, profiles=None):
+    """Returns the StationTravelTimes of the bus trips between the specified dates (on weekdays, if weekdays_only),
+    with planned times or, if profiles (a travel_time_profiles.TravelTimeProfiles) is given, realistic ones. Works on
+    the frequency blocks if they are loaded, otherwise on the trips."""
+    with stage('build_station_travel_times'):
+        blocks = [block for block in g.trip_blocks() if block.route.route_type == 3 and
+                  block.service.end_date >= start_date and block.service.start_date <= end_date and
+                  not (weekdays_only and block.service.days.isdisjoint(weekdays))]
+        count('bus_trips_in_date_range', sum(len(block) for block in blocks))
+
+        with stage('pairs'):
+            story_pair_lists = {}
+            for block in blocks:
+                route_story = block.route_story
+                if route_story.route_story_id not in story_pair_lists:
+                    story_pair_lists[route_story.route_story_id] = story_pairs(g, route_story, max_station_distance,
+                                                                               max_ride)
+            pairs = sorted({(stop_id, station_id) for to_station, from_station in story_pair_lists.values()
+                            for stop_id, station_id, _, _ in to_station + from_station})
+            rows = {pair: row for row, pair in enumerate(pairs)}
+            count('pairs', len(pairs))
+
+        with stage('events'):
+            to_events, from_events = [], []
+            for block in progress(blocks, 10000):
+                to_station, from_station = story_pair_lists[block.route_story.route_story_id]
+                if len(to_station) == 0 and len(from_station) == 0:
+                    continue
+                arrivals, departures = stop_times(block.route_story, block.start_times, profiles)
+                for stop_id, station_id, i, j in to_station:
+                    base = rows[(stop_id, station_id)] << event_row_shift
+                    to_events.extend([base | departure << event_time_bits | arrival
+                                      for departure, arrival in zip(departures[i], arrivals[j])])
+                for stop_id, station_id, i, j in from_station:
+                    base = rows[(stop_id, station_id)] << event_row_shift
+                    from_events.extend([base | arrival << event_time_bits | departure
+                                        for arrival, departure in zip(arrivals[i], departures[j])])
+            to_events.sort()
+            from_events.sort()
+            count('events', len(to_events) + len(from_events))
+
+        with stage('sweep'):
+            res = StationTravelTimes(pairs, earliest_arrivals(to_events, len(pairs)),
+                                     latest_departures(from_events, len(pairs)))
+        return res
+
+
+def export_catchment(g, travel_times, start_date, end_date, t, max_time=default_max_time, output_filename=None):
+    """Exports the stops within max_time seconds of each station (by to_station) at time t, with the travel times in
+    both directions"""
+    output_filename = output_filename or g.at_path('catchment_%s_%s_%s.txt' % (start_date.strftime('%Y-%m-%d'),
+                                                                            end_date.strftime('%Y-%m-%d'),
+                                                                            format_timestamp(t)[:5].replace(':', '')))
+    to_times, from_times = travel_times.at_time(t), travel_times.at_time(t, to_station=False)
+    fields = ['station_id', 'station_name', 'stop_id', 'stop_name', 'to_station', 'from_station', 'latitude',
+              'longitude']
+    with stage('export_catchment'), open(output_filename, 'w', encoding='utf8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(fields)
+        stops = 0
+        for (stop_id, station_id), to_time, from_time in zip(travel_times.pairs, to_times, from_times):
+            if to_time > max_time:
+                continue
+            stop = g.stops[stop_id]
+            writer.writerow([station_id, g.stops[station_id].stop_name, stop_id, stop.stop_name, to_time,
+                             '' if from_time == no_trip else from_time, stop.stop_lat, stop.stop_lon])
+            stops += 1
+        count('stops', stops)
+    return output_filename
+
+
+def main():
+    def parse_date(s):
+        return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+    parser = argparse.ArgumentParser(description='Build the time of day travel times between bus stops and the train '
+                                                 'stations they lead to')
+    parser.add_argument('folder', help='the extended gtfs folder')
+    parser.add_argument('start_date', type=parse_date)
+    parser.add_argument('end_date', type=parse_date)
+    parser.add_argument('--all-days', action='store_true', help='also the trips of weekend only services')
+    parser.add_argument('--max-ride', type=int, default=default_max_ride // 60, help='minutes')
+    parser.add_argument('--profiles', action='store_true',
+                        help='use the saved travel time profiles instead of the planned times')
+    parser.add_argument('--catchment', metavar='HH:MM', help='also export the stops near each station at this time')
+    parser.add_argument('--max-time', type=int, default=default_max_time // 60,
+                        help='minutes to the station of the exported catchment')
+    args = parser.parse_args()
+    g = ExtendedGTFS(args.folder)
+    g.load_stops()
+    g.load_frequency_blocks()
+    profiles = TravelTimeProfiles.load(g) if args.profiles else None
+    travel_times = build_station_travel_times(g, args.start_date, args.end_date, not args.all_days,
+                                              max_ride=args.max_ride * 60, profiles=profiles)
+    travel_times.save(g, args.start_date, args.end_date)
+    if args.catchment is not None:
+        t = parse_timestamp(args.catchment + ':00')
+        print('Saved %s' % export_catchment(g, travel_times, args.start_date, args.end_date, t, args.max_time * 60))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+ generate synthetic, israeli style gtfs files of configurable size, for testing and benchmarking.
+
+ The network is built from straight "corridors" of bus stops spread over the country, some of them crossing a train
+ line. Every route runs along part of a corridor, and has a few route stories (alternatives that skip a stop, and
+ slower versions of the main story). The output is deterministic for a given configuration and seed.
+"""
+
+import csv
+import datetime
+import io
+import os
+import random
+import zipfile
+from collections import namedtuple
+
+import gtfs_extender
+from ilgtfs import ExtendedGTFS
+
+# the sizes of the 1x network
+SyntheticConfig = namedtuple('SyntheticConfig', ['stops', 'routes', 'stories_per_route', 'trips_per_day', 'days',
+                                                 'train_stations', 'seed'])
+default_config = SyntheticConfig(stops=2000, routes=100, stories_per_route=2, trips_per_day=10, days=14,
+                                 train_stations=20, seed=1)
+
+first_stop_id = 1
+first_station_id = 30000
+default_start_date = datetime.date(2016, 6, 1)
+
+# bounding box of the area the stops are spread over (roughly the populated part of Israel)
+south, north, west, east = 31.2, 33.0, 34.6, 35.5
+# the train line runs from (south, train_line_west) to (north, train_line_west + train_line_slope)
+train_line_west, train_line_slope = 34.75, 0.3
+
+
+def scaled_config(scale, config=default_config):
+    """Returns a config with the stops and routes (and so the trips) multiplied by scale"""
+    return config._replace(stops=config.stops * scale, routes=config.routes * scale)
+
+
+def format_time(t):
+    return '%02d:%02d:%02d' % (t // 3600, t % 3600 // 60, t % 60)
+
+
+def write_table(z, name, fields, rows):
+    with z.open(name, 'w') as f, io.TextIOWrapper(f, 'utf8', newline='') as text:
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerow(fields)
+        writer.writerows(rows)
+
+
+def generate_gtfs(folder, config=default_config, start_date=default_start_date):
+    """Writes israel-public-transportation.zip to folder. Returns the number of stop time records."""
+    rnd = random.Random(config.seed)
+    os.makedirs(folder, exist_ok=True)
+    end_date = start_date + datetime.timedelta(days=config.days - 1)
+
+    # train stations, evenly spaced along the train line
+    stations = []
+    for i in range(config.train_stations):
+        lat = south + (north - south) * (i + 0.5) / config.train_stations
+        lon = train_line_west + train_line_slope * (lat - south) / (north - south)
+        stations.append((first_station_id + i, lat, lon))
+
+    # bus stop corridors; every other corridor starts near a train station
+    corridor_length = 40
+    corridors = []
+    for corridor_start in range(0, config.stops, corridor_length):
+        length = min(corridor_length, config.stops - corridor_start)
+        if len(corridors) % 2 == 0 and len(stations) > 0:
+            _, lat, lon = stations[rnd.randrange(len(stations))]
+            lat, lon = lat + rnd.uniform(-0.002, 0.002), lon + rnd.uniform(-0.002, 0.002)
+        else:
+            lat, lon = rnd.uniform(south, north), rnd.uniform(west, east)
+        d_lat, d_lon = rnd.uniform(-0.004, 0.004), rnd.uniform(-0.004, 0.004)
+        corridors.append([(first_stop_id + corridor_start + i,
+                           lat + d_lat * i + rnd.uniform(-0.0005, 0.0005),
+                           lon + d_lon * i + rnd.uniform(-0.0005, 0.0005)) for i in range(length)])
+
+    # routes: (route_id, agency_id, line number, route_type, list of stories); a story is a list of
+    # (stop_id, offset from the start of the trip)
+    routes = []
+    train_routes = max(1, config.routes // 50) if len(stations) > 1 else 0
+    for route_index in range(config.routes):
+        route_id = route_index + 1
+        if route_index < train_routes:
+            route_type, agency_id, line_number = 2, 2, ''
+            stops = [station[0] for station in (stations if route_index % 2 == 0 else reversed(stations))]
+            min_gap, max_gap = 300, 900
+        else:
+            route_type, agency_id, line_number = 3, 3 + route_index % 5, str(1 + route_index % 300)
+            corridor = corridors[rnd.randrange(len(corridors))]
+            length = rnd.randint(min(10, len(corridor)), len(corridor))
+            first = rnd.randint(0, len(corridor) - length)
+            stops = [stop[0] for stop in corridor[first:first + length]]
+            if route_index % 2 == 1:
+                stops.reverse()
+            min_gap, max_gap = 60, 180
+        gaps = [rnd.randint(min_gap, max_gap) for _ in stops[1:]]
+        stories = []
+        for story_index in range(config.stories_per_route):
+            story_stops, story_gaps = list(stops), list(gaps)
+            if story_index % 2 == 1 and len(story_stops) > 3:
+                # an alternative that skips a stop
+                skipped = rnd.randint(1, len(story_stops) - 2)
+                del story_stops[skipped]
+                story_gaps[skipped - 1] += story_gaps.pop(skipped)
+            elif story_index > 0:
+                # a slower version, for the rush hours
+                story_gaps = [gap + gap // 5 for gap in story_gaps]
+            offsets = [0]
+            for gap in story_gaps:
+                offsets.append(offsets[-1] + gap)
+            stories.append(list(zip(story_stops, offsets)))
+        routes.append((route_id, agency_id, line_number, route_type, stories))
+
+    # services: every route story runs on sunday to thursday, friday and saturday
+    service_days = [(1, 1, 1, 1, 1, 0, 0), (0, 0, 0, 0, 0, 1, 0), (0, 0, 0, 0, 0, 0, 1)]
+    services = []
+    trips = []
+    stop_times_count = 0
+    for route_id, _, _, route_type, stories in routes:
+        for story_index, story in enumerate(stories):
+            for days_index, days in enumerate(service_days):
+                service_id = len(services) + 1
+                services.append((service_id,) + days)
+                trips_per_day = config.trips_per_day // (2 if days_index > 0 else 1)
+                # constant headway from 05:00 to 24:00, with some trips moved a bit
+                headway = 19 * 3600 // max(trips_per_day, 1) // 60 * 60
+                for trip_index in range(trips_per_day):
+                    start_time = 5 * 3600 + trip_index * headway
+                    if rnd.random() < 0.2:
+                        start_time += rnd.choice([-5, 5, 10]) * 60
+                    trip_id = '%d_%s' % (len(trips) + 1, start_date.strftime('%d%m%y'))
+                    trips.append((route_id, service_id, trip_id, story_index % 2, route_id * 10 + story_index,
+                                  start_time, story))
+                    stop_times_count += len(story)
+
+    with zipfile.ZipFile(os.path.join(folder, 'israel-public-transportation.zip'), 'w', zipfile.ZIP_DEFLATED) as z:
+        write_table(z, 'agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang',
+                                      'agency_phone', 'agency_fare_url'],
+                    [(agency_id, 'agency %d' % agency_id, 'http://www.gov.il', 'Asia/Jerusalem', 'he', '', '')
+                     for agency_id in range(2, 8)])
+        write_table(z, 'calendar.txt', ['service_id', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday',
+                                        'friday', 'saturday', 'start_date', 'end_date'],
+                    [(service_id, sunday, monday, tuesday, wednesday, thursday, friday, saturday,
+                      start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+                     for service_id, sunday, monday, tuesday, wednesday, thursday, friday, saturday in services])
+        write_table(z, 'routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc',
+                                      'route_type', 'route_color'],
+                    [(route_id, agency_id, line_number, 'route %d' % route_id, '%d-1-#' % route_id, route_type, '')
+                     for route_id, agency_id, line_number, route_type, _ in routes])
+        all_stops = stations + [stop for corridor in corridors for stop in corridor]
+        write_table(z, 'stops.txt', ['stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon',
+                                     'location_type', 'parent_station', 'zone_id'],
+                    [(stop_id, stop_id + 10000, 'stop %d' % stop_id, '', '%.6f' % lat, '%.6f' % lon, 0, '', '')
+                     for stop_id, lat, lon in all_stops])
+        stop_locations = {stop_id: (lat, lon) for stop_id, lat, lon in all_stops}
+        write_table(z, 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+                    ((route_id * 10 + story_index, '%.6f' % stop_locations[stop_id][0],
+                      '%.6f' % stop_locations[stop_id][1], sequence + 1)
+                     for route_id, _, _, _, stories in routes
+                     for story_index, story in enumerate(stories)
+                     for sequence, (stop_id, _) in enumerate(story)))
+        write_table(z, 'trips.txt', ['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id'],
+                    (trip[:5] for trip in trips))
+        write_table(z, 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+                                          'pickup_type', 'drop_off_type'],
+                    ((trip_id, format_time(start_time + offset), format_time(start_time + offset), stop_id,
+                      sequence + 1, 1 if sequence == len(story) - 1 else 0, 1 if sequence == 0 else 0)
+                     for _, _, trip_id, _, _, start_time, story in trips
+                     for sequence, (stop_id, offset) in enumerate(story)))
+    return stop_times_count
+
+
+def generate_extended_gtfs(folder, config=default_config, start_date=default_start_date):
+    """Generates the gtfs zip and runs the gtfs extender on it"""
+    generate_gtfs(folder, config, start_date)
+    gtfs_extender.build_route_stories(ExtendedGTFS(folder))
+    gtfs_extender.extend_routes(ExtendedGTFS(folder))
+    gtfs_extender.extend_stops(ExtendedGTFS(folder))
+
+
+if __name__ == '__main__':
+    generate_extended_gtfs('data/synthetic/gtfs_2016_06_01')
@@ -4,14 +4,19 @@ For each visit of a train in a station, when do the buses visit the same station
 
 
 import csv
-from collections import namedtuple
+import os
+from collections import namedtuple, OrderedDict
 import datetime
-from ilgtfs import GTFS
-from csv import DictWriter
+from ilgtfs import GTFS, format_timestamp
+from instrumentation import stage, count, progress
 
 default_day = 6
 minimum_seconds_to_bus = 0
 
+# the per station export keeps at most this many files open (there are ~60 train stations, so normally all of them)
+max_open_files = 64
+write_buffer_size = 1 << 16
+
 VisitsAtStop = namedtuple('StoppingAtStop', ['day', 'arrival', 'departure', 'route', 'stop_id'])
 
 TrainVisit = namedtuple('TrainVisit', ['train_visit', 'last_bus_before', 'first_bus_after', 'bus_route_id'])
@@ -22,20 +27,20 @@ TrainVisit = namedtuple('TrainVisit', ['train_visit', 'last_bus_before', 'first_
 def visits_at_stop(g, stop_ids, start_date, end_date):
     trip_story_to_stops = {}
     # find trip stories that go through target stops
-    for trip_story_id, trip_story in g.trip_stories.items():
-        for stop_sequence, trip_story_stop in enumerate(trip_story):
+    for trip_story_id, trip_story in g.route_stories.items():
+        for stop_sequence, trip_story_stop in enumerate(trip_story.stops):
             if trip_story_stop.stop_id in stop_ids:
                 trip_story_to_stops.setdefault(trip_story_id, []).append(trip_story_stop)
 
     result = []
     for trip in g.trips.values():
-        if trip.trip_story_id not in trip_story_to_stops:
+        if trip.route_story.route_story_id not in trip_story_to_stops:
             continue
         if trip.service.end_date < start_date or trip.service.start_date > end_date:
             continue
 
         for day in trip.service.days:
-            for trip_story_stop in trip_story_to_stops[trip.trip_story_id]:
+            for trip_story_stop in trip_story_to_stops[trip.route_story.route_story_id]:
                 arrival = trip.start_time + trip_story_stop.arrival_offset
                 departure = trip.start_time + trip_story_stop.departure_offset
                 result.append(VisitsAtStop(day, arrival, departure, trip.route, trip_story_stop.stop_id))
@@ -65,7 +70,7 @@ def train_arrival_to_bus_visit(g, visits, day=default_day):
         for visit in visits:
             if visit.route.route_type == 3 and visit.day == day:  # buses only
                 stop = g.stops[visit.stop_id]
-                station_routes = stations_to_route_to_visits.setdefault(stop.nearest_train_station.stop_id, {})
+                station_routes = stations_to_route_to_visits.setdefault(stop.nearest_train_station_id, {})
                 station_routes.setdefault(visit.route.route_id, []).append(visit)
 
         for d in stations_to_route_to_visits.values():
@@ -77,7 +82,7 @@ def train_arrival_to_bus_visit(g, visits, day=default_day):
     s2r2bs = station_to_route_to_visits()
     result = []
     for train_visit in (v for v in visits if v.route.route_type == 2 and v.day == day):
-        for bus_route_id, bus_visits in s2r2bs[train_visit.stop_id].items():
+        for bus_route_id, bus_visits in s2r2bs.get(train_visit.stop_id, {}).items():
             result.append(TrainVisit(train_visit,
                                      arrival_before(train_visit, bus_visits),
                                      departures_after(train_visit, bus_visits),
@@ -97,62 +102,127 @@ def filter_train_visits_by_train_station_and_bus_short_name(g, train_visits, tra
             (v.train_visit.stop_id, g.routes[v.bus_route_id].route_short_name) in train_station_and_bus_name]
 
 
+train_visit_fields = ['day', 'arrival', 'departure', 'train_route_id', 'train_station_id', 'train_station_name',
+                      'train_route_name', 'bus_route_id', 'bus_route_name', 'bus_route_long_name',
+                      'bus_route_description', 'agency_id', 'last_bus_arrival', 'first_bus_departure',
+                      'formatted_train_time', 'formatted_last_arrival', 'formatted_first_departure']
+
+
+class _LastLine:
+    """A file-like object that keeps the last line written to it, so csv.writer formats a row just once"""
+    def __init__(self):
+        self.line = None
+
+    def write(self, line):
+        self.line = line
+
+
+class PartitionedCsvWriter:
+    """Writes csv lines to many files in a single pass. A line is formatted once and can go to several files.
+
+    At most max_open_files are open at a time; when another file is needed the least recently used one is closed, and
+    it's reopened for appending if it gets more lines. Every file starts with the header."""
+
+    def __init__(self, header, max_open=max_open_files):
+        self.max_open = max_open
+        self.open_files = OrderedDict()  # filename -> file, least recently used first
+        self.started = set()
+        self._last_line = _LastLine()
+        self._writer = csv.writer(self._last_line, lineterminator='\n')
+        self.header = self.format_row(header)
+
+    def format_row(self, row):
+        self._writer.writerow(row)
+        return self._last_line.line
+
+    def file(self, filename):
+        f = self.open_files.get(filename)
+        if f is not None:
+            self.open_files.move_to_end(filename)
+            return f
+        if len(self.open_files) >= self.max_open:
+            self.open_files.popitem(last=False)[1].close()
+            count('closed_files')
+        if filename in self.started:
+            f = open(filename, 'a', encoding='utf8', buffering=write_buffer_size)
+        else:
+            f = open(filename, 'w', encoding='utf8', buffering=write_buffer_size)
+            f.write(self.header)
+            self.started.add(filename)
+        self.open_files[filename] = f
+        return f
+
+    def write_line(self, filename, line):
+        self.file(filename).write(line)
+
+    def create(self, filename):
+        """Makes sure the file exists (with just the header, if nothing was written to it)"""
+        if filename not in self.started:
+            self.file(filename)
+
+    def close(self):
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def train_visit_row(g, visit):
+    train, bus_before, bus_after, bus_route_id = visit
+    stop = g.stops[train.stop_id]
+    bus_route = g.routes[bus_route_id]
+    return (train.day, train.arrival, train.departure, train.route.route_id, train.stop_id, stop.stop_name,
+            train.route.route_long_name, bus_route.route_id, bus_route.route_short_name, bus_route.route_long_name,
+            bus_route.route_desc, bus_route.agency_id,
+            bus_before.arrival if bus_before is not None else '',
+            bus_after.departure if bus_after is not None else '',
+            format_timestamp(train.arrival),
+            format_timestamp(bus_before.arrival) if bus_before is not None else '',
+            format_timestamp(bus_after.departure) if bus_after is not None else '')
+
+
 # export a list of TrainVisit objects
 def export_train_and_bus(filename, g, visits):
-    def format_time(t):
-        return '%02d:%02d:%02d' % (t / 3600, t % 3600 / 60, t % 60)
-
-    writer = DictWriter(open(filename, 'w', encoding='utf8'),
-                        fieldnames=['day', 'arrival', 'departure', 'train_route_id', 'train_station_id',
-                                    'train_station_name', 'train_route_name',
-                                    'bus_route_id', 'bus_route_name', 'bus_route_long_name',
-                                    'bus_route_description', 'agency_id',
-                                    'last_bus_arrival', 'first_bus_departure',
-                                    'formatted_train_time', 'formatted_last_arrival', 'formatted_first_departure'],
-                        lineterminator='\n')
-    writer.writeheader()
-    for train, bus_before, bus_after, bus_route_id in visits:
-        stop = g.stops[train.stop_id]
-        bus_route = g.routes[bus_route_id]
-        v = {'day': train.day,
-             'arrival': train.arrival,
-             'departure': train.departure,
-             'train_route_id': train.route.route_id,
-             'train_station_id': train.stop_id,
-             'train_station_name': stop.stop_name,
-             'train_route_name': train.route.route_long_name,
-             'bus_route_id': bus_route.route_id,
-             'bus_route_name': bus_route.route_short_name,
-             'bus_route_long_name': bus_route.route_long_name,
-             'bus_route_description': bus_route.route_desc,
-             'agency_id': bus_route.agency_id,
-             'last_bus_arrival': bus_before.arrival if bus_before is not None else "",
-             'first_bus_departure': bus_after.departure if bus_after is not None else "",
-             'formatted_train_time': format_time(train.arrival),
-             'formatted_last_arrival': format_time(bus_before.arrival) if bus_before is not None else '',
-             'formatted_first_departure': format_time(bus_after.departure) if bus_after is not None else ''}
-        writer.writerow(v)
-
-
-# export a list of TrainVisit objects, and also individual station files
-def export_all_train_visits(g, train_visits):
-    export_train_and_bus('data/gtfs_2016_05_01/train_visits.txt', g, train_visits)
-    for train_station in g.train_stations:
-        export_train_and_bus('data/gtfs_2016_05_01/stations_0/train_visits_%d_%s.txt' %
-                             (train_station.stop_id, g.stops[train_station.stop_id].stop_name),
-                             g,
-                             filter_train_visits_by_train_station(train_visits, train_station.stop_id))
+    with PartitionedCsvWriter(train_visit_fields) as writer:
+        f = writer.file(filename)
+        for visit in visits:
+            f.write(writer.format_row(train_visit_row(g, visit)))
+
+
+# export a list of TrainVisit objects, and also individual station files, in one pass over the visits
+def export_all_train_visits(g, train_visits, folder='data/gtfs_2016_05_01'):
+    stations_folder = os.path.join(folder, 'stations_0')
+    os.makedirs(stations_folder, exist_ok=True)
+    station_filenames = {stop.stop_id: os.path.join(stations_folder, 'train_visits_%d_%s.txt' %
+                                                    (stop.stop_id, stop.stop_name))
+                         for stop in g.train_stations}
+    all_visits_filename = os.path.join(folder, 'train_visits.txt')
+    with stage('export_all_train_visits'), PartitionedCsvWriter(train_visit_fields) as writer:
+        for visit in progress(train_visits, 100000):
+            line = writer.format_row(train_visit_row(g, visit))
+            writer.write_line(all_visits_filename, line)
+            station_filename = station_filenames.get(visit.train_visit.stop_id)
+            if station_filename is not None:
+                writer.write_line(station_filename, line)
+        # stations without visits get a file with just the header
+        for station_filename in station_filenames.values():
+            writer.create(station_filename)
 
 
 # export only stations \ bus lines in the kavrazif configuration file
 def export_kavrazif_train_visits(g, train_visits):
-    with open('data/kavrazif_lines_south.txt', 'r', encoding='utf8') as f:
+    with stage('export_kavrazif_train_visits'), open('data/kavrazif_lines_south.txt', 'r', encoding='utf8') as f:
         reader = csv.DictReader(f)
         train_station_and_bus_name = set((int(r['station_id']), r['route_short_name']) for r in reader)
-        print("There are %d train station and bus pairs to read" % len(train_station_and_bus_name))
+        count('train_station_and_bus_pairs', len(train_station_and_bus_name))
         train_visits = filter_train_visits_by_train_station_and_bus_short_name(g, train_visits,
                                                                                train_station_and_bus_name)
-        print("%d train visits left after filtering" % len(train_visits))
+        count('filtered_train_visits', len(train_visits))
         export_train_and_bus('data/gtfs_2016_05_01/kavrazif_train_visits.txt', g, train_visits)
 
 
@@ -160,10 +230,12 @@ def main():
     g = GTFS('data/gtfs_2016_05_01/israel-public-transportation.zip')
     g.find_distance_from_train_station()
     stop_ids = set(stop.stop_id for stop in g.stops.values() if stop.distance_from_train_station < 300)
-    visits = visits_at_stop(g, stop_ids, datetime.date(2016, 5, 2), datetime.date(2016, 5, 8))
-    print("There are %d visits" % len(visits))
-    train_visits = train_arrival_to_bus_visit(g, visits)
-    print("There are %d train visits" % len(train_visits))
+    with stage('visits_at_stop'):
+        visits = visits_at_stop(g, stop_ids, datetime.date(2016, 5, 2), datetime.date(2016, 5, 8))
+        count('visits', len(visits))
+    with stage('train_arrival_to_bus_visit'):
+        train_visits = train_arrival_to_bus_visit(g, visits)
+        count('train_visits', len(train_visits))
     export_kavrazif_train_visits(g, train_visits)
 
 
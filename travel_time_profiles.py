@@ -0,0 +1,273 @@
+"""
+ time of day dependent travel times between consecutive stops.
+
+ A route story has the same travel times between its stops at any time of day. A segment is a pair of consecutive
+ stops (of any route story); its profile is the travel time from the arrival at the first stop to the arrival at the
+ second, for each hour of the service day, by the time of the arrival at the first stop (times after midnight are in
+ hours 24 to 29, like in the gtfs; later times are in the last bin).
+
+ Every bin of a profile comes from the first source that has it:
+   observed   the mean travel time of at least min_samples observed trips (observed_arrivals records of the same trip
+              at consecutive stops)
+   speed      the distance between the stops (along the trip's shape if the shapes are loaded, otherwise the straight
+              line distance times detour_factor) at the speed of the route type's speed profile in that hour
+
+ The profiles are kept as one array of 16 bit travel times for all the segments, time_bins values per segment, and
+ saved to travel_time_profiles.bin, with the segments (and the number of observed bins of each) in
+ travel_time_profiles.txt. TravelTimeProfiles.arrival_times returns the realistic arrival times of many trips of a
+ route story at once.
+
+   python travel_time_profiles.py data/gtfs/gtfs_2016_06_09 [data/siri/2016-06-09.csv ...]
+"""
+
+import argparse
+import csv
+import math
+from array import array
+
+from ilgtfs import ExtendedGTFS, read_fields
+from instrumentation import stage, count, progress
+from observed_arrivals import ArrivalMatcher, read_arrivals
+
+travel_time_profiles_filename = 'travel_time_profiles.txt'
+travel_time_profiles_bin_filename = 'travel_time_profiles.bin'
+
+time_bins = 30
+default_min_samples = 3
+detour_factor = 1.3
+# observed trips without records for this long are assumed to be over
+trip_timeout = 2 * 60 * 60
+
+# km/h for every hour of the day, by route type
+default_speed_profiles = {
+    # buses: slow in the morning and afternoon peaks
+    3: [32, 32, 32, 32, 32, 30, 24, 17, 16, 19, 21, 21, 21, 21, 20, 18, 16, 16, 18, 21, 24, 26, 28, 30],
+    2: [70] * 24,
+}
+default_speed_profile = [25] * 24
+
+meters_per_degree = 111320
+# how far past the nearest shape point found so far the search for the shape point of a stop goes
+shape_search_slack = 500
+
+
+def planar(lat, lon):
+    """Returns approximate x, y coordinates in meters; good enough for distances between nearby points"""
+    return lon * math.cos(math.radians(lat)) * meters_per_degree, lat * meters_per_degree
+
+
+def shape_offsets(shape):
+    """Returns the planar points of a shape, and the distance along the shape of each point"""
+    points = [planar(*shape.coordinates[sequence]) for sequence in sorted(shape.coordinates)]
+    offsets = [0.0]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        offsets.append(offsets[-1] + math.hypot(x2 - x1, y2 - y1))
+    return points, offsets
+
+
+def stop_shape_offsets(points, offsets, stop_points):
+    """Returns the distance along the shape of each stop: the offset of the shape point nearest to the stop, searching
+    forward from the point of the previous stop"""
+    res = []
+    start = 0
+    for x, y in stop_points:
+        best, best_distance = start, None
+        for i in range(start, len(points)):
+            distance = math.hypot(points[i][0] - x, points[i][1] - y)
+            if best_distance is None or distance < best_distance:
+                best, best_distance = i, distance
+            elif distance > best_distance + shape_search_slack:
+                break
+        res.append(offsets[best])
+        start = best
+    return res
+
+
+def segment_distances(g):
+    """Returns a map from segment (from stop_id, to stop_id) to (distance in meters, route type), for the consecutive
+    stops of the route stories that have trips"""
+    res = {}
+    shapes = {}
+    seen = set()
+    with stage('segment distances'):
+        for block in g.trip_blocks():
+            route_story = block.route_story
+            if (route_story.route_story_id, block.shape_id) in seen:
+                continue
+            seen.add((route_story.route_story_id, block.shape_id))
+            stop_points = [planar(float(g.stops[stop.stop_id].stop_lat), float(g.stops[stop.stop_id].stop_lon))
+                           for stop in route_story.stops]
+            if g.is_loaded('shapes') and block.shape_id in g.shapes:
+                if block.shape_id not in shapes:
+                    shapes[block.shape_id] = shape_offsets(g.shapes[block.shape_id])
+                along_shape = stop_shape_offsets(*shapes[block.shape_id], stop_points)
+                distances = [b - a for a, b in zip(along_shape, along_shape[1:])]
+            else:
+                count('stories_without_shapes')
+                distances = [math.hypot(x2 - x1, y2 - y1) * detour_factor
+                             for (x1, y1), (x2, y2) in zip(stop_points, stop_points[1:])]
+            for stop1, stop2, distance in zip(route_story.stops, route_story.stops[1:], distances):
+                if (stop1.stop_id, stop2.stop_id) not in res:
+                    res[(stop1.stop_id, stop2.stop_id)] = (distance, block.route.route_type)
+        count('segments', len(res))
+    return res
+
+
+def time_bin(t):
+    return min(t // 3600, time_bins - 1)
+
+
+def observed_segment_times(g, arrivals):
+    """Returns a map from (segment, time bin) to (number of observed trips, total travel time), for the segments that
+    observed trips (see observed_arrivals) passed with records at both stops"""
+    matcher = ArrivalMatcher(g)
+    # (date, route_id, trip_start_time, route_story_id) -> (stop sequence, arrival time) of the last record of the trip;
+    # the route story tells apart trips of the route that start at the same time
+    last_calls = {}
+    res = {}
+    with stage('observed segment times'):
+        for i, arrival in enumerate(progress(arrivals, 1000000)):
+            calls = matcher.calls(arrival)
+            if len(calls) == 0:
+                continue
+            # the records can't tell apart trips of the route that start at the same time, so prefer the call that
+            # continues a trip seen at the previous stop of its route story, then a trip that wasn't seen yet, then the
+            # nearest call
+            last_call, unseen = None, None
+            for route_story, stop, _, _ in calls:
+                call = last_calls.get((arrival.date, arrival.route_id, arrival.trip_start_time,
+                                       route_story.route_story_id))
+                if call is None:
+                    unseen = unseen or (route_story, stop)
+                elif call[0] + 1 == stop.stop_sequence:
+                    last_call = call
+                    break
+            else:
+                route_story, stop = unseen or matcher.match(arrival)[:2]
+            trip = (arrival.date, arrival.route_id, arrival.trip_start_time, route_story.route_story_id)
+            if last_call is not None:
+                travel_time = arrival.arrival_time - last_call[1]
+                if travel_time >= 0:
+                    previous_stop = route_story.stops[stop.stop_sequence - 2]
+                    key = ((previous_stop.stop_id, stop.stop_id), time_bin(last_call[1]))
+                    samples, total = res.get(key, (0, 0))
+                    res[key] = (samples + 1, total + travel_time)
+            last_calls[trip] = (stop.stop_sequence, arrival.arrival_time)
+            if i % 100000 == 0:
+                # forget the trips that are over, so memory doesn't grow with the number of records
+                last_calls = {trip: call for trip, call in last_calls.items()
+                              if trip[0] >= arrival.date and call[1] >= arrival.arrival_time - trip_timeout}
+        count('observed_bins', len(res))
+    return res
+
+
+class TravelTimeProfiles:
+    def __init__(self, segments, distances, times, observed_bins):
+        """segments is a list of (from stop_id, to stop_id); times has time_bins travel times for every segment, in
+        the same order"""
+        self.segment_rows = {segment: row for row, segment in enumerate(segments)}
+        self.segments = segments
+        self.distances = distances
+        self.times = times
+        self.observed_bins = observed_bins
+
+    def profile(self, from_stop_id, to_stop_id):
+        """Returns the travel times of the segment in every time bin, or None if there's no such segment"""
+        row = self.segment_rows.get((from_stop_id, to_stop_id))
+        if row is None:
+            return None
+        return self.times[row * time_bins:(row + 1) * time_bins]
+
+    def travel_time(self, from_stop_id, to_stop_id, t):
+        """Returns the travel time of a segment from time t at the first stop, or None if there's no such segment"""
+        row = self.segment_rows.get((from_stop_id, to_stop_id))
+        return None if row is None else self.times[row * time_bins + time_bin(t)]
+
+    def arrival_times(self, route_story, start_times):
+        """Returns a list with an array for every stop of the route story: the realistic arrival times at the stop of
+        the trips that start at start_times. Segments without a profile take their planned time."""
+        stops = route_story.stops
+        times = array('i', (start_time + stops[0].arrival_offset for start_time in start_times))
+        res = [times]
+        for stop1, stop2 in zip(stops, stops[1:]):
+            profile = self.profile(stop1.stop_id, stop2.stop_id)
+            if profile is None:
+                planned = stop2.arrival_offset - stop1.arrival_offset
+                times = array('i', (t + planned for t in times))
+            else:
+                last_bin = time_bins - 1
+                times = array('i', (t + profile[min(t // 3600, last_bin)] for t in times))
+            res.append(times)
+        return res
+
+    def save(self, g):
+        with open(g.at_path(travel_time_profiles_filename), 'w', encoding='utf8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['from_stop_id', 'to_stop_id', 'distance', 'observed_bins'])
+            for (from_stop_id, to_stop_id), distance, observed_bins in zip(self.segments, self.distances,
+                                                                           self.observed_bins):
+                writer.writerow([from_stop_id, to_stop_id, round(distance), observed_bins])
+        with open(g.at_path(travel_time_profiles_bin_filename), 'wb') as f:
+            self.times.tofile(f)
+
+    @classmethod
+    def load(cls, g):
+        segments, distances, observed_bins = [], [], array('B')
+        with open(g.at_path(travel_time_profiles_filename), encoding='utf8') as f:
+            for from_stop_id, to_stop_id, distance, observed in read_fields(f, ('from_stop_id', 'to_stop_id',
+                                                                                 'distance', 'observed_bins')):
+                segments.append((int(from_stop_id), int(to_stop_id)))
+                distances.append(int(distance))
+                observed_bins.append(int(observed))
+        times = array('H')
+        with open(g.at_path(travel_time_profiles_bin_filename), 'rb') as f:
+            times.fromfile(f, len(segments) * time_bins)
+        return cls(segments, distances, times, observed_bins)
+
+
+def build_profiles(g, arrivals=None, speed_profiles=None, min_samples=default_min_samples):
+    """Returns the TravelTimeProfiles of a gtfs with stops and trips (or frequency blocks) loaded, from the observed
+    arrivals (an iterator of observed_arrivals.ObservedArrival, optional) and the speed profiles (a map from route
+    type to 24 hourly speeds in km/h)"""
+    speed_profiles = speed_profiles or default_speed_profiles
+    with stage('build_travel_time_profiles'):
+        distances = segment_distances(g)
+        observed = observed_segment_times(g, arrivals) if arrivals is not None else {}
+        segments = sorted(distances)
+        times = array('H')
+        observed_bins = array('B')
+        for segment in segments:
+            distance, route_type = distances[segment]
+            speeds = speed_profiles.get(route_type, default_speed_profile)
+            segment_observed_bins = 0
+            for i in range(time_bins):
+                samples, total = observed.get((segment, i), (0, 0))
+                if samples >= min_samples:
+                    travel_time = total / samples
+                    segment_observed_bins += 1
+                else:
+                    travel_time = distance / (speeds[i % 24] / 3.6)
+                times.append(min(round(travel_time), 65535))
+            observed_bins.append(segment_observed_bins)
+        count('segments', len(segments))
+        count('observed_bins', sum(observed_bins))
+        return TravelTimeProfiles(segments, [distances[segment][0] for segment in segments], times, observed_bins)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build time of day travel time profiles of the segments between stops')
+    parser.add_argument('folder', help='the extended gtfs folder')
+    parser.add_argument('arrivals', nargs='*', help='csv or json lines files of observed arrivals, in time order')
+    parser.add_argument('--min-samples', type=int, default=default_min_samples,
+                        help='observed trips needed for an observed time bin')
+    args = parser.parse_args()
+    g = ExtendedGTFS(args.folder)
+    g.load_stops()
+    g.load_frequency_blocks()
+    g.load_shapes()
+    arrivals = (arrival for filename in args.arrivals for arrival in read_arrivals(filename)) if args.arrivals else None
+    build_profiles(g, arrivals, min_samples=args.min_samples).save(g)
+
+
+if __name__ == '__main__':
+    main()